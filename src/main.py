@@ -1,10 +1,11 @@
+import atexit
 import os
 from time import sleep
 import json
 import time
 import traceback
 from types import TracebackType
-from typing import Literal, Type
+from typing import Any, Callable, Literal, Type
 from modules import tools
 import subprocess
 import sys
@@ -16,6 +17,9 @@ import shutil
 import threading
 from tkinter import filedialog
 from modules import logging
+from modules import edl_ports
+from modules import rawprogram
+from modules import backup
 
 version: list = [2, 8, 1]
 
@@ -23,17 +27,41 @@ if not os.path.exists('logs/'):
     os.mkdir('logs')
 
 debug: bool = False
+jsonl: bool = False
+profile: bool = False
+shell_session: bool = False
+adb_client: bool = False
 
 for i in sys.argv:
     if i == '--debug':
         debug = True
+    elif i == '--jsonl':
+        jsonl = True
+    elif i == '--profile':
+        profile = True
+    elif i == '--shell-session':
+        shell_session = True
+    elif i == '--adb-client':
+        adb_client = True
+    elif i == '--native-sahara':
+        tools.QT.native_sahara = True
+    elif i == '--native-firehose':
+        tools.QT.native_firehose = True
 
 os.system(f'title XTCEasyRootPlus v{version[0]}.{version[1]}.{version[2]}')
 console = Console()
 status = console.status('')
 print = console.print
 
-logging.set_config(f'logs/{time.strftime("%Y_%m_%d_%H-%M-%S", time.localtime())}.log', print=console.log, level=(logging.level.debug if debug else logging.level.info))
+log_name = f'logs/{time.strftime("%Y_%m_%d_%H-%M-%S", time.localtime())}'
+logging.set_config(f'{log_name}.log', print=console.log, level=(logging.level.debug if debug else logging.level.info), spill_dir=f'{log_name}_spill/', timing_filename=f'{log_name}.timing.txt', jsonl_filename=('logs/xtceasyrootplus.jsonl' if jsonl else None), ring_size=2000, ring_filename=f'{log_name}.crash.log')
+
+def write_profile():
+    tools.profiler.write_report(f'{log_name}.profile.txt')
+    if profile and tools.profiler.stats:
+        tools.profiler.print_report()
+
+atexit.register(write_profile)
 
 def global_exception_handler(exc_type: Type[BaseException], exc_value: BaseException, exc_traceback: TracebackType):
     exc_traceback_str = '全局错误\n' + \
@@ -123,12 +151,14 @@ if notice.status_code == 200:
 else:
     notice = '[red]公告获取失败！[/red]'
 
+registry = tools.DeviceRegistry('bin/adb.exe', persistent_shell=shell_session, use_client=adb_client)
+
 while True:
     # 清屏并停止状态指示
     status.stop()
     os.system('cls')
 
-    adb = tools.ADB('bin/adb.exe')
+    adb = tools.ADB('bin/adb.exe', persistent_shell=shell_session, use_client=adb_client)
 
     # 主菜单
     tools.print_logo(version)
@@ -180,6 +210,7 @@ while True:
             sdk_version = adb.get_version_of_sdk()
             model = tools.xtc_models[info['innermodel']]
             android_version = info['version_of_android_from_sdk']
+            logging.set_context(model=model, android_version=android_version, version_of_system=info['version_of_system'], serial=info['serial'])
             table = Table()
             table.add_column("型号", width=12)
             table.add_column("代号")
@@ -372,10 +403,8 @@ while True:
                               'bin/fh_loader.exe', port, f'data/{model}/mbn.mbn')
                 try:
                     qt.intosahara()
-                    qt.read_partition('boot')
+                    qt.read_partition('boot', output='tmp/boot.img')
                     logging.info('读取boot分区成功!')
-                    shutil.copy('boot.img', 'tmp/')
-                    os.remove('boot.img')
                 except qt.QSaharaServerError:
                     status.stop()
                     tools.logging_traceback('进入Sahara模式失败')
@@ -744,7 +773,7 @@ while True:
                               'bin/fh_loader.exe', port, 'bin/msm8937.mbn')
                 try:
                     qt.intosahara()
-                    qt.read_partition('boot')
+                    qt.read_partition('boot', output='tmp/boot.img')
                 except qt.QSaharaServerError:
                     status.stop()
                     tools.logging_traceback('进入Sahara模式失败')
@@ -761,8 +790,6 @@ while True:
                     break
 
                 logging.info('读取boot分区成功!')
-                shutil.copy('boot.img', 'tmp/')
-                os.remove('boot.img')
 
                 try:
                     logging.info('开始修补boot分区')
@@ -799,7 +826,7 @@ while True:
                 try:
                     logging.info('刷入aboot,recovery')
                     status.update('刷入aboot,recovery')
-                    qt.fh_loader(rf'--port=\\.\COM{port} --memoryname=emmc --search_path=data/{model}/ --sendxml=data/{model}/rawprogram0.xml --noprompt')
+                    qt.send_xml(['rawprogram0.xml'], f'data/{model}/')
                 except qt.FHLoaderError:
                     status.stop()
                     tools.logging_traceback('刷入aboot,recovery失败')
@@ -1293,21 +1320,14 @@ while True:
                     else:
                         fh_loader = 'xtcfh_loader.exe'
 
-                    sendxml: str = ''
                     sendxml_list: list[str] = []
                     mbn = ''
                     for i in os.listdir(f'data/superrecovery/{model}_{sr_version}/'):
-                        if i[:5] == 'patch' and i[-3:] == 'xml':
-                            sendxml_list.append(i)
-                        elif i[:10] == 'rawprogram' and i[-3:] == 'xml':
+                        if rawprogram.is_rawprogram(i):
                             sendxml_list.append(i)
                         if i[:4] == 'prog' and i[-3:] == 'mbn':
                             mbn = f'data/superrecovery/{model}_{sr_version}/{i}'
 
-                    for i in sendxml_list:
-                        sendxml = sendxml + i + ','
-                    sendxml = sendxml[:-1]
-
                     status.update('等待连接')
                     status.start()
                     logging.info('等待连接')
@@ -1320,24 +1340,42 @@ while True:
                     port = tools.wait_for_edl()
                     logging.info('连接成功!')
 
-                    qt = tools.QT('bin/QSaharaServer.exe',
-                                f'bin/{fh_loader}', port, mbn)
+                    def superrecovery_flow(qt: tools.QT, on_line: Callable[[str], Any] | None = None) -> None:
+                        logging.info('进入sahara模式')
+                        try:
+                            qt.intosahara()
+                        except qt.QSaharaServerError:
+                            logging.warning('进入sahara模式失败,可能已经进入!尝试直接超恢')
+
+                        logging.info('开始超恢')
+                        logging.info('提示: 此过程耗时较长,请耐心等待')
+                        with logging.span(f'超级恢复{model}_{sr_version}'):
+                            qt.send_xml(sendxml_list, f'data/superrecovery/{model}_{sr_version}', on_line)
+                        sleep(0.5)
+                        qt.set_active_partition(0)
+                        sleep(0.5)
+                        qt.exit9008()
 
-                    logging.info('进入sahara模式')
-                    status.update('进入sahara模式')
-                    try:
-                        qt.intosahara()
-                    except qt.QSaharaServerError:
-                        logging.warning('进入sahara模式失败,可能已经进入!尝试直接超恢')
-
-                    logging.info('开始超恢')
-                    logging.info('提示: 此过程耗时较长,请耐心等待')
-                    status.update('超级恢复中')
-                    qt.fh_loader(rf'--port="\\.\COM{port}" --sendxml={sendxml} --search_path="data/superrecovery/{model}_{sr_version}" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""')
-                    sleep(0.5)
-                    qt.fh_loader(rf'--port="\\.\COM{port}" --setactivepartition="0" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""')
-                    sleep(0.5)
-                    qt.exit9008()
+                    ports = [i.port for i in edl_ports.get_monitor().snapshot().values() if not i.port is None]
+                    status.stop()
+                    if len(ports) > 1 and input(f'检测到{len(ports)}台9008设备,是否同时为全部设备超恢{model}_{sr_version}?(请确认机型相同)[y/N]') == 'y':
+                        status.update(f'正在为{len(ports)}台设备超级恢复')
+                        status.start()
+                        results = tools.EDLScheduler(
+                            lambda port, workspace: tools.QT('bin/QSaharaServer.exe', f'bin/{fh_loader}', port, mbn, workspace=workspace),
+                            superrecovery_flow).run(ports)  # type: ignore
+                        status.stop()
+                        tools.print_device_results('超级恢复', {f'COM{k}': v for k, v in results.items()})
+                        failed = [f'COM{k}' for k, v in results.items() if isinstance(v, Exception)]
+                        if failed:
+                            logging.error(f'{len(failed)}台设备超恢失败: {",".join(failed)}')
+                            input(f'{len(results) - len(failed)}台设备超恢成功, {len(failed)}台失败({",".join(failed)})!按下回车键回到主界面')
+                            break
+                    else:
+                        status.update('超级恢复中')
+                        status.start()
+                        superrecovery_flow(tools.QT('bin/QSaharaServer.exe',
+                                                    f'bin/{fh_loader}', port, mbn), tools.status_progress(status, '超级恢复中'))
                     status.stop()
                     logging.info('超恢成功!')
                     logging.info('提示:若未开机可直接长按电源键开机进入系统')
@@ -1362,6 +1400,19 @@ while True:
             if not apk:
                 print('[red]未选择安装包文件！[/red]')
                 input('按回车回到主界面')
+            elif len(devices := registry.connected()) > 1:
+                logging.info(f'检测到{len(devices)}台设备, 同时安装')
+                status.update(f'正在为{len(devices)}台设备安装')
+                status.start()
+
+                def install_apks(device: tools.ADB) -> None:
+                    for i in apk:
+                        logging.info(f'安装{i.split('/')[-1]}')
+                        device.install(i)
+                results = tools.run_on_devices(devices, install_apks)
+                status.stop()
+                tools.print_device_results('安装应用', results)
+                input('安装完毕!按回车返回主界面')
             else:
                 if not adb.is_connect():
                     status.update('等待连接')
@@ -1393,6 +1444,23 @@ while True:
             if not modules:
                 print('[red]未选择压缩包文件！[/red]')
                 input('按回车回到主界面')
+            elif len(devices := registry.connected()) > 1:
+                logging.info(f'检测到{len(devices)}台设备, 同时安装')
+                status.update(f'正在为{len(devices)}台设备安装')
+                status.start()
+
+                def install_modules(device: tools.ADB) -> None:
+                    android_version = device.get_version_of_android_from_sdk()
+                    for i in modules:
+                        logging.info(f'安装{i.split('/')[-1]}')
+                        if android_version == '7.1':
+                            device.install_module(i)
+                        else:
+                            device.install_module_new(i)
+                results = tools.run_on_devices(devices, install_modules)
+                status.stop()
+                tools.print_device_results('安装模块', results)
+                input('安装完毕!按回车返回主界面')
             else:
                 if not adb.is_connect():
                     status.update('等待连接')
@@ -1574,11 +1642,6 @@ while True:
                         fh_loader = {True: 'xtcfh_loader.exe', False: 'fh_loader.exe'}[
                             noneprompt.ConfirmPrompt('是否使用小天才加密fh_loader?', default_choice=False).prompt()]
 
-                        sendxml = ''
-                        for i in sendxml_list:
-                            sendxml = sendxml + i.split('/')[-1] + ','
-                        sendxml = sendxml[:-1]
-
                         status.update('等待连接')
                         status.start()
                         logging.info('等待连接')
@@ -1601,11 +1664,9 @@ while True:
 
                         qt.intosahara()
 
-                        qt.fh_loader(rf'bin/{fh_loader} --port="\\.\COM{port}" --sendxml={sendxml} --search_path="{search_path}" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""')
+                        qt.send_xml([os.path.basename(i) for i in sendxml_list], search_path, tools.status_progress(status, '刷入固件'))
                         sleep(0.5)
-                        qt.fh_loader(rf'bin/{fh_loader} --port="\\.\COM{port}" --setactivepartition="0" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""')
-                        sleep(0.5)
-                        qt.fh_loader(rf'bin/{fh_loader} --port="\\.\COM{port}" --reset --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""')
+                        qt.set_active_partition(0)
                         sleep(0.5)
                         qt.exit9008()
 
@@ -1659,50 +1720,53 @@ while True:
                             elif partition == '#.备份全部(全分区备份)':
                                 skipuserdata = noneprompt.ConfirmPrompt(
                                     '是否跳过备份Userdata?(提示:Userdata是用户数据,备份耗时较久且很占空间)', default_choice=True).prompt()
+                                backup_format = {'1.压缩备份包(体积最小,推荐)': 'xbak', '2.sparse镜像(空白区域不占空间)': 'sparse', '3.原始镜像': 'raw'}[noneprompt.ListPrompt(
+                                    '请选择备份格式', [noneprompt.Choice('1.压缩备份包(体积最小,推荐)'), noneprompt.Choice('2.sparse镜像(空白区域不占空间)'), noneprompt.Choice('3.原始镜像')]).prompt().name]
                                 if not os.path.exists('backup/'):
                                     os.mkdir('backup')
                                 status.update('读取全部分区')
                                 status.start()
                                 logging.info('开始读取全部分区')
-                                for i in list(partitions.keys()):
-                                    if i == 'userdata' and skipuserdata:
-                                        logging.info('跳过读取userdata')
-                                        continue
-                                    logging.info(f'读取{i}')
-                                    if i == 'system' or i == 'userdata':
-                                        logging.info(
-                                            f'提示:读取{i}可能需要耗费较长的时间,请耐心等待')
-                                    output = qt.read_partition(i)
-                                    if not output == 'success':
-                                        status.stop()
-                                        tools.print_error(f'读取{i}失败!', output)
-                                        qt.exit9008()
-                                        input()
-                                        break
-                                    shutil.copy(f"{i}.img", 'backup/')
-                                    os.remove(f"{i}.img")
+                                selected = {i: partitions[i] for i in partitions if not (i == 'userdata' and skipuserdata)}
+                                if 'userdata' in partitions and skipuserdata:
+                                    logging.info('跳过读取userdata')
+                                if 'system' in selected or 'userdata' in selected:
+                                    logging.info('提示:读取system和userdata可能需要耗费较长的时间,请耐心等待')
+                                try:
+                                    if backup_format == 'xbak':
+                                        qt.backup_partitions(selected, f'backup/backup_{time.strftime("%Y%m%d_%H%M%S")}{backup.EXTENSION}', on_line=tools.status_progress(status, '读取全部分区'))
+                                    else:
+                                        qt.read_partitions(selected, 'backup/', on_line=tools.status_progress(status, '读取全部分区'), as_sparse=backup_format == 'sparse')
+                                except qt.ReadPartitionError as e:
+                                    status.stop()
+                                    tools.print_error('读取全部分区失败!', str(e))
+                                    qt.exit9008()
+                                    input()
+                                    break
                                 status.stop()
                                 input(f'读取全分区完毕!文件保存在{os.getcwd()}\\backup\n按回车回到分区界面')
                             elif partition == '#.批量写入(可用于写入备份的全分区)':
                                 logging.info('选择文件')
                                 files = filedialog.askopenfilenames(
-                                    title='选择镜像文件(提示:是多选哦)', filetypes=[('镜像文件', '*.img;*.bin')])
+                                    title='选择镜像文件或备份包(提示:是多选哦)', filetypes=[('镜像文件', f'*.img;*.bin;*{backup.EXTENSION}')])
                                 partitions = qt.get_partition_list()
 
                                 logging.info('开始批量写入')
                                 status.update('批量写入')
                                 status.start()
-                                for i in files:
-                                    if i.split('/')[-1][:-4] in list(partitions.keys()):
-                                        logging.info(
-                                            f'写入{i.split('/')[-1][:-4]}')
-                                        output = qt.write_partition(
-                                            i, i.split('/')[-1][:-4])
-                                        if not output == 'success':
-                                            status.stop()
-                                            tools.print_error(
-                                                f'刷入{i.split('/')[-1][:-4]}失败', output)
-                                            tools.exit_after_enter()
+                                selected = {i.split('/')[-1][:-4]: {'file': i} for i in files if i.split('/')[-1][:-4] in list(partitions.keys())}
+                                logging.info(f'写入{",".join(selected)}')
+                                try:
+                                    if selected:
+                                        qt.write_partitions(selected, on_line=tools.status_progress(status, '批量写入'))  # type: ignore
+                                    for i in files:
+                                        if i.endswith(backup.EXTENSION):
+                                            logging.info(f'从{i}还原分区')
+                                            qt.restore_partitions(i, on_line=tools.status_progress(status, '还原备份包'))
+                                except qt.WritePartitionError as e:
+                                    status.stop()
+                                    tools.print_error('批量写入失败', str(e))
+                                    tools.exit_after_enter()
                                 status.stop()
                                 logging.info('全部刷入成功!')
                                 input('按回车回到分区管理界面')
@@ -0,0 +1,379 @@
+"""
+adb server(默认127.0.0.1:5037)协议的纯Python客户端, 执行命令时不需要启动adb.exe
+支持host:devices, host:transport, shell:, exec:以及sync:文件传输
+协议参考AOSP中adb的OVERVIEW.TXT, SERVICES.TXT, SYNC.TXT
+"""
+import os
+import socket
+import stat
+import struct
+import subprocess
+import threading
+import time
+from typing import Callable
+from modules import logging
+
+
+class ADBClientError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+_SYNC_DATA_MAX = 64 * 1024
+
+_SHELL_STDOUT = 1
+_SHELL_STDERR = 2
+_SHELL_EXIT = 3
+
+
+class ADBClient:
+    def __init__(self, host: str = '127.0.0.1', port: int = 5037, serial: str | None = None, timeout: int | float | None = 10, adb_path: str | None = None) -> None:
+        """
+        host, port: adb server地址
+        serial: 设备序列号, 留空则使用唯一连接的设备(与不加-s的adb.exe相同)
+        timeout: 连接和等待回复的超时时间(秒), 不影响shell命令本身的运行时间
+        adb_path: adb路径, 连接不上adb server时用它启动server, 留空则不自动启动
+        """
+        self.host = host
+        self.port = port
+        self.serial = serial
+        self.timeout = timeout
+        self.adb_path = adb_path
+
+    def _connect(self) -> socket.socket:
+        try:
+            return socket.create_connection((self.host, self.port), self.timeout)
+        except ConnectionRefusedError:
+            if self.adb_path is None:
+                raise ADBClientError(f'无法连接adb server {self.host}:{self.port}')
+        logging.debug('adb server未运行, 启动adb server')
+        subprocess.run(f'{self.adb_path} start-server', stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            return socket.create_connection((self.host, self.port), self.timeout)
+        except OSError as e:
+            raise ADBClientError(f'无法连接adb server {self.host}:{self.port}: {e}')
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, size: int, allow_eof: bool = False) -> bytes:
+        """
+        allow_eof: 为True时, 在读到任何数据前连接关闭则返回空bytes
+        """
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                if allow_eof and not data:
+                    return b''
+                raise ADBClientError('adb server提前关闭了连接')
+            data += chunk
+        return bytes(data)
+
+    def _request(self, sock: socket.socket, request: str) -> None:
+        """
+        发送一个请求(4位十六进制长度+内容)并检查OKAY/FAIL
+        """
+        payload = request.encode()
+        sock.sendall(b'%04x' % len(payload) + payload)
+        status = self._recv_exactly(sock, 4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise ADBClientError(self._read_string(sock).decode(errors='replace'))
+        raise ADBClientError(f'adb server返回了未知的状态{status!r}')
+
+    def _read_string(self, sock: socket.socket) -> bytes:
+        return self._recv_exactly(sock, int(self._recv_exactly(sock, 4), 16))
+
+    def query(self, request: str) -> bytes:
+        """
+        执行一个host服务并读取回复, 例如"host:version"
+        """
+        started = time.perf_counter()
+        with self._connect() as sock:
+            self._request(sock, request)
+            output = self._read_string(sock)
+        logging.debug('adb server请求%s耗时%.3f秒', request, time.perf_counter() - started)
+        return output
+
+    def version(self) -> int:
+        return int(self.query('host:version'), 16)
+
+    def devices(self) -> list[tuple[str, str]]:
+        """
+        return: [(序列号, 状态), ...], 状态例如device, offline, unauthorized
+        """
+        return list(parse_devices(self.query('host:devices').decode(errors='replace')).items())
+
+    def transport(self, service: str) -> socket.socket:
+        """
+        连接到设备并打开一个设备端服务, 返回的socket由调用者关闭
+        service: 例如"shell:ls", "exec:cat /proc/version", "sync:"
+        """
+        sock = self._connect()
+        try:
+            self._request(sock, 'host:transport-any' if self.serial is None else f'host:transport:{self.serial}')
+            self._request(sock, service)
+        except BaseException:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    @staticmethod
+    def _read_all(sock: socket.socket) -> bytes:
+        chunks: list[bytes] = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def shell(self, command: str) -> tuple[int | None, bytes]:
+        """
+        执行shell命令, stderr合并到输出中
+        设备支持shell v2协议时可以取得返回值, 否则返回值为None
+        return: 返回值, 输出
+        """
+        started = time.perf_counter()
+        try:
+            sock = self.transport(f'shell,v2,raw:{command}')
+        except ADBClientError:
+            with self.transport(f'shell:{command}') as sock:
+                output = self._read_all(sock)
+            logging.debug('adb server执行shell %s耗时%.3f秒(无返回值)', command, time.perf_counter() - started)
+            return None, output
+        output = bytearray()
+        returncode: int | None = None
+        with sock:
+            while True:
+                header = self._recv_exactly(sock, 5, allow_eof=True)
+                if not header:
+                    break
+                packet_id, size = struct.unpack('<BI', header)
+                data = self._recv_exactly(sock, size)
+                if packet_id in (_SHELL_STDOUT, _SHELL_STDERR):
+                    output += data
+                elif packet_id == _SHELL_EXIT:
+                    returncode = data[0]
+                    break
+        logging.debug('adb server执行shell %s耗时%.3f秒', command, time.perf_counter() - started)
+        return returncode, bytes(output)
+
+    def exec_out(self, command: str) -> bytes:
+        """
+        执行命令并取得原始二进制输出(不经过pty, 不转换换行符)
+        """
+        with self.transport(f'exec:{command}') as sock:
+            return self._read_all(sock)
+
+    def reboot(self, mode: str = '') -> None:
+        """
+        mode: 留空为正常重启, 或edl, bootloader等
+        """
+        with self.transport(f'reboot:{mode}') as sock:
+            self._read_all(sock)
+
+    @staticmethod
+    def _sync_request(sock: socket.socket, id: bytes, data: bytes) -> None:
+        sock.sendall(id + struct.pack('<I', len(data)) + data)
+
+    def _sync_fail(self, sock: socket.socket, size: int) -> ADBClientError:
+        return ADBClientError(self._recv_exactly(sock, size).decode(errors='replace'))
+
+    def _stat(self, sock: socket.socket, remote: str) -> tuple[int, int, int]:
+        self._sync_request(sock, b'STAT', remote.encode())
+        id, mode, size, mtime = struct.unpack('<4sIII', self._recv_exactly(sock, 16))
+        if id != b'STAT':
+            raise ADBClientError(f'sync STAT返回了未知的回复{id!r}')
+        return mode, size, mtime
+
+    def stat(self, remote: str) -> tuple[int, int, int]:
+        """
+        return: (mode, size, mtime), 文件不存在时都为0
+        """
+        with self.transport('sync:') as sock:
+            output = self._stat(sock, remote)
+            self._sync_request(sock, b'QUIT', b'')
+        return output
+
+    def _send_file(self, sock: socket.socket, local: str, remote: str, buffer: bytearray, on_progress: Callable[[int, int], object] | None) -> int:
+        info = os.stat(local)
+        view = memoryview(buffer)
+        sent = 0
+        self._sync_request(sock, b'SEND', f'{remote},{stat.S_IFREG | stat.S_IMODE(info.st_mode)}'.encode())
+        with open(local, 'rb') as f:
+            while True:
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                sock.sendall(b'DATA' + struct.pack('<I', size))
+                sock.sendall(view[:size])
+                sent += size
+                if not on_progress is None:
+                    on_progress(sent, info.st_size)
+        sock.sendall(b'DONE' + struct.pack('<I', int(info.st_mtime)))
+        id, size = struct.unpack('<4sI', self._recv_exactly(sock, 8))
+        if id == b'FAIL':
+            raise self._sync_fail(sock, size)
+        if id != b'OKAY':
+            raise ADBClientError(f'sync SEND返回了未知的回复{id!r}')
+        return sent
+
+    def push(self, local: str, remote: str, on_progress: Callable[[int, int], object] | None = None) -> None:
+        """
+        与adb push相同: remote以/结尾或是已存在的目录时推送到该目录下, local为目录时推送整个目录
+        所有文件共用一个sync连接
+        local: 本地文件或目录
+        remote: 设备上的路径
+        on_progress: 每发送一块数据后调用, 参数为(当前文件已发送字节数, 当前文件总字节数)
+        """
+        started = time.perf_counter()
+        buffer = bytearray(_SYNC_DATA_MAX)
+        sent = 0
+        with self.transport('sync:') as sock:
+            if remote.endswith('/') or stat.S_ISDIR(self._stat(sock, remote)[0]):
+                remote = remote.rstrip('/') + '/' + os.path.basename(os.path.normpath(local))
+            if os.path.isdir(local):
+                for root, _, files in os.walk(local):
+                    for i in files:
+                        relative = os.path.relpath(os.path.join(root, i), local).replace(os.sep, '/')
+                        sent += self._send_file(sock, os.path.join(root, i), f'{remote}/{relative}', buffer, on_progress)
+            else:
+                sent = self._send_file(sock, local, remote, buffer, on_progress)
+            self._sync_request(sock, b'QUIT', b'')
+        elapsed = time.perf_counter() - started
+        logging.debug('推送%s到%s: %d字节, 耗时%.3f秒, %.1fMB/s', local, remote, sent, elapsed, sent / 1048576 / max(elapsed, 1e-6))
+
+    def pull(self, remote: str, local: str, on_progress: Callable[[int], object] | None = None) -> int:
+        """
+        remote: 设备上的文件路径
+        local: 保存到的本地文件
+        on_progress: 每收到一块数据后调用, 参数为已接收字节数
+        return: 文件大小
+        """
+        started = time.perf_counter()
+        received = 0
+        with self.transport('sync:') as sock, open(local, 'wb') as f:
+            self._sync_request(sock, b'RECV', remote.encode())
+            while True:
+                id, size = struct.unpack('<4sI', self._recv_exactly(sock, 8))
+                if id == b'DONE':
+                    break
+                if id == b'FAIL':
+                    raise self._sync_fail(sock, size)
+                if id != b'DATA':
+                    raise ADBClientError(f'sync RECV返回了未知的回复{id!r}')
+                f.write(self._recv_exactly(sock, size))
+                received += size
+                if not on_progress is None:
+                    on_progress(received)
+            self._sync_request(sock, b'QUIT', b'')
+        logging.debug('从%s拉取到%s: %d字节, 耗时%.3f秒', remote, local, received, time.perf_counter() - started)
+        return received
+
+
+def has_device(devices: dict[str, str], serial: str | None = None) -> bool:
+    """
+    serial: 留空则为任意设备
+    """
+    return any(state == 'device' and (serial is None or i == serial) for i, state in devices.items())
+
+
+def parse_devices(output: str) -> dict[str, str]:
+    """
+    解析host:devices/host:track-devices的输出
+    return: {序列号: 状态}
+    """
+    return dict(i.split('\t', 1) for i in output.splitlines() if '\t' in i)  # type: ignore
+
+
+class DeviceWatcher:
+    """
+    在后台线程中订阅adb server的host:track-devices, 设备连接状态变化时立即得到通知, 不需要轮询adb devices
+    与adb server的连接断开后(例如server重启)会自动重新订阅
+    """
+    def __init__(self, client: ADBClient, retry_interval: int | float = 1) -> None:
+        """
+        client: 用于连接adb server的客户端
+        retry_interval: 连接adb server失败后的重试间隔(秒)
+        """
+        self.client = client
+        self.retry_interval = retry_interval
+        self.devices: dict[str, str] = {}
+        self.ready = False
+        self._condition = threading.Condition()
+        self._socket: socket.socket | None = None
+        self._stopped = False
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='adb-track-devices', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        if not self._socket is None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        with self._condition:
+            self._condition.notify_all()
+
+    def _update(self, devices: dict[str, str], ready: bool) -> None:
+        with self._condition:
+            if devices != self.devices:
+                logging.debug('设备状态变化: %s -> %s', self.devices, devices)
+            self.devices = devices
+            self.ready = ready
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            try:
+                sock = self.client._connect()
+                self._socket = sock
+                with sock:
+                    self.client._request(sock, 'host:track-devices')
+                    sock.settimeout(None)
+                    while not self._stopped:
+                        self._update(parse_devices(self.client._read_string(sock).decode(errors='replace')), True)
+            except (ADBClientError, OSError) as e:
+                if self._stopped:
+                    break
+                logging.debug('订阅adb设备状态失败, %s秒后重试: %s', self.retry_interval, e)
+                self._update({}, False)
+                time.sleep(self.retry_interval)
+
+    def wait(self, predicate: Callable[[dict[str, str]], bool], timeout: int | float | None = None) -> bool:
+        """
+        等待直到predicate(当前设备列表)为True
+        timeout: 超时时间(秒), 留空则一直等待
+        return: 是否在超时前满足条件
+        """
+        self.start()
+        with self._condition:
+            return self._condition.wait_for(lambda: self._stopped or (self.ready and predicate(self.devices)), timeout) and not self._stopped
+
+    def wait_for_device(self, serial: str | None = None, timeout: int | float | None = None) -> bool:
+        return self.wait(lambda devices: has_device(devices, serial), timeout)
+
+    def wait_for_disconnect(self, serial: str | None = None, timeout: int | float | None = None) -> bool:
+        return self.wait(lambda devices: not has_device(devices, serial), timeout)
+
+
+_watchers: dict[tuple[str, int], DeviceWatcher] = {}
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(client: ADBClient) -> DeviceWatcher:
+    """
+    获取client所连adb server的DeviceWatcher, 同一个server在进程内只有一个(一个后台线程和一个连接)
+    订阅的是全部设备的状态, 与client.serial无关
+    """
+    key = (client.host, client.port)
+    with _watchers_lock:
+        if not key in _watchers:
+            _watchers[key] = DeviceWatcher(ADBClient(client.host, client.port, adb_path=client.adb_path))
+        return _watchers[key]
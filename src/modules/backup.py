@@ -0,0 +1,283 @@
+"""
+压缩的分区备份包(.xbak)
+分区数据按固定大小分块, 由多个线程并行压缩(zlib压缩时会释放GIL), 再由一个线程按顺序写入文件, 读取设备的线程只负责分块
+文件末尾是分块索引(JSON)和固定长度的文件尾, 还原单个分区或其中一段时只需解压用到的块
+
+文件结构: MAGIC | 压缩块... | 索引(zlib压缩的JSON) | 文件尾(索引位置, 索引长度, MAGIC)
+"""
+import json
+import os
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Iterator, NamedTuple
+
+
+class BackupError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+MAGIC = b'XTCBAK01'
+EXTENSION = '.xbak'
+
+_FOOTER = struct.Struct('<QQ8s')
+
+
+class Chunk(NamedTuple):
+    offset: int
+    """
+    压缩数据在备份包中的位置
+    """
+    compressed_size: int
+    size: int
+    """
+    解压后的大小
+    """
+    crc: int
+    """
+    解压后数据的CRC32
+    """
+
+
+class Partition(NamedTuple):
+    name: str
+    start: int
+    """
+    起始扇区
+    """
+    sectors: int
+    chunk_size: int
+    chunks: list[Chunk]
+
+    @property
+    def size(self) -> int:
+        return sum(i.size for i in self.chunks)
+
+
+class _PartitionStream:
+    """
+    BackupWriter.partition()返回的可写对象, 按chunk_size分块后交给压缩线程
+    """
+    def __init__(self, writer: 'BackupWriter', partition: Partition) -> None:
+        self._writer = writer
+        self.partition = partition
+        self._buffer = bytearray()
+
+    def write(self, data: bytes | memoryview) -> int:
+        size = len(data)
+        with memoryview(data) as view:
+            offset = 0
+            chunk_size = self.partition.chunk_size
+            if self._buffer:
+                offset = min(size, chunk_size - len(self._buffer))
+                self._buffer += view[:offset]
+                if len(self._buffer) < chunk_size:
+                    return size
+                self._writer._submit(self.partition, bytes(self._buffer))
+                self._buffer.clear()
+            while size - offset >= chunk_size:
+                self._writer._submit(self.partition, bytes(view[offset:offset + chunk_size]))
+                offset += chunk_size
+            self._buffer += view[offset:]
+        return size
+
+    def close(self) -> None:
+        if self._buffer:
+            self._writer._submit(self.partition, bytes(self._buffer))
+            self._buffer.clear()
+
+    def __enter__(self) -> '_PartitionStream':
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+def _compress(data: bytes, level: int) -> tuple[bytes, int]:
+    return zlib.compress(data, level), zlib.crc32(data)
+
+
+class BackupWriter:
+    def __init__(self, filename: str, chunk_size: int = 4 * 1024 * 1024, level: int = 1, workers: int | None = None, max_pending: int | None = None) -> None:
+        """
+        chunk_size: 分块大小(字节), 应为扇区大小的整数倍
+        level: zlib压缩等级, 越小越快
+        workers: 压缩线程数, 留空则为CPU核数
+        max_pending: 最多有多少块在等待压缩或写入(限制内存占用), 留空则为压缩线程数的4倍
+        """
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.level = level
+        self.partitions: list[Partition] = []
+        self._file = open(filename, 'wb')
+        self._file.write(MAGIC)
+        workers = workers or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='backup-compress')
+        self._queue: queue.Queue[tuple[Partition, Future[tuple[bytes, int]], int] | None] = queue.Queue(max_pending or workers * 4)
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._write_loop, name='backup-writer', daemon=True)
+        self._thread.start()
+
+    def _submit(self, partition: Partition, data: bytes) -> None:
+        if not self._error is None:
+            raise BackupError(f'写入{self.filename}失败: {self._error}')
+        self._queue.put((partition, self._pool.submit(_compress, data, self.level), len(data)))
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if not self._error is None:
+                continue
+            partition, future, size = item
+            try:
+                compressed, crc = future.result()
+                partition.chunks.append(Chunk(self._file.tell(), len(compressed), size, crc))
+                self._file.write(compressed)
+            except BaseException as e:
+                self._error = e
+
+    def partition(self, name: str, start: int, sectors: int) -> _PartitionStream:
+        """
+        开始写入一个分区, 返回的对象可直接作为FirehoseClient.read的output
+        start: 起始扇区
+        sectors: 扇区数
+        """
+        partition = Partition(name, start, sectors, self.chunk_size, [])
+        self.partitions.append(partition)
+        return _PartitionStream(self, partition)
+
+    def add_file(self, name: str, start: int, sectors: int, filename: str, buffer_size: int = 4 * 1024 * 1024) -> None:
+        """
+        把已经读出的镜像文件加入备份包
+        """
+        with open(filename, 'rb') as f, self.partition(name, start, sectors) as stream:
+            while True:
+                data = f.read(buffer_size)
+                if not data:
+                    break
+                stream.write(data)
+
+    def _stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self._pool.shutdown()
+
+    def abort(self) -> None:
+        """
+        停止写入并删除不完整的备份包
+        """
+        self._stop()
+        self._file.close()
+        os.remove(self.filename)
+
+    def close(self) -> None:
+        """
+        等待全部块写入后写入索引和文件尾, 出错时删除备份包
+        """
+        self._stop()
+        if not self._error is None:
+            self._file.close()
+            os.remove(self.filename)
+            raise BackupError(f'写入{self.filename}失败: {self._error}')
+        try:
+            index = zlib.compress(json.dumps({
+                'version': 1,
+                'partitions': [{'name': i.name, 'start': i.start, 'sectors': i.sectors, 'chunk_size': i.chunk_size, 'chunks': [list(j) for j in i.chunks]} for i in self.partitions],
+            }, ensure_ascii=False).encode())
+            offset = self._file.tell()
+            self._file.write(index)
+            self._file.write(_FOOTER.pack(offset, len(index), MAGIC))
+        finally:
+            self._file.close()
+
+    def __enter__(self) -> 'BackupWriter':
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+class BackupReader:
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            if self._file.read(len(MAGIC)) != MAGIC:
+                raise BackupError(f'{filename}不是备份包')
+            self._file.seek(-_FOOTER.size, os.SEEK_END)
+            offset, size, magic = _FOOTER.unpack(self._file.read(_FOOTER.size))
+            if magic != MAGIC:
+                raise BackupError(f'{filename}不完整(没有文件尾)')
+            self._file.seek(offset)
+            index = json.loads(zlib.decompress(self._file.read(size)))
+        except (OSError, ValueError, zlib.error, struct.error) as e:
+            self._file.close()
+            raise BackupError(f'无法读取{filename}的索引: {e}')
+        except BackupError:
+            self._file.close()
+            raise
+        self.partitions: dict[str, Partition] = {i['name']: Partition(i['name'], i['start'], i['sectors'], i['chunk_size'], [Chunk(*j) for j in i['chunks']]) for i in index['partitions']}
+
+    def _chunk(self, chunk: Chunk) -> bytes:
+        self._file.seek(chunk.offset)
+        try:
+            data = zlib.decompress(self._file.read(chunk.compressed_size))
+        except zlib.error:
+            data = b''
+        if len(data) != chunk.size or zlib.crc32(data) != chunk.crc:
+            raise BackupError(f'{self.filename}中位于{chunk.offset}的数据块已损坏')
+        return data
+
+    def iter_range(self, name: str, offset: int = 0, length: int | None = None) -> Iterator[bytes]:
+        """
+        按顺序返回分区中一段数据, 只解压用到的块
+        offset: 在分区中的位置(字节)
+        length: 长度(字节), 留空则到分区末尾
+        """
+        if not name in self.partitions:
+            raise BackupError(f'{self.filename}中没有分区{name}')
+        partition = self.partitions[name]
+        end = partition.size if length is None else min(partition.size, offset + length)
+        first = offset // partition.chunk_size
+        for i in range(first, -(-end // partition.chunk_size)):
+            chunk_start = i * partition.chunk_size
+            data = self._chunk(partition.chunks[i])
+            yield data[max(offset - chunk_start, 0):end - chunk_start]
+
+    def read(self, name: str, offset: int = 0, length: int | None = None) -> bytes:
+        return b''.join(self.iter_range(name, offset, length))
+
+    def extract(self, name: str, output: str | BinaryIO, offset: int = 0, length: int | None = None, on_progress: Callable[[int, int], Any] | None = None) -> int:
+        """
+        把分区(或其中一段)解压到文件
+        output: 文件名或可写对象
+        return: 写入的字节数
+        """
+        partition = self.partitions.get(name)
+        total = 0 if partition is None else (partition.size if length is None else min(partition.size - offset, length))
+        f = open(output, 'wb') if type(output) == str else output
+        try:
+            written = 0
+            for data in self.iter_range(name, offset, length):
+                f.write(data)  # type: ignore
+                written += len(data)
+                if not on_progress is None:
+                    on_progress(written, total)
+            return written
+        finally:
+            if type(output) == str:
+                f.close()  # type: ignore
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> 'BackupReader':
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
@@ -0,0 +1,179 @@
+"""
+用模拟设备(modules.edl_simulator)回归测试并测速QT的内置Sahara/Firehose流程
+依次执行: 进入Sahara(上传引导程序), 读取分区表(完整读取/使用缓存), 写入后读回分区并比较, 备份到.xbak并还原
+任何一步结果不正确时返回值非0, 可以在修改tools/sahara/firehose后运行
+
+python -m modules.edl_benchmark [--dir=tmp/edl_benchmark] [--size=4G] [--latency=0.001] [--bandwidth=20M] [--socket] [--keep]
+"""
+import os
+import shutil
+import struct
+import sys
+import time
+from typing import Any, Callable
+from modules import backup
+from modules import edl_simulator
+from modules import gpt
+from modules import logging
+from modules import tools
+
+PARTITIONS = ['boot', 'misc', 'persist', 'cache']
+"""
+备份和还原的分区
+"""
+
+
+class BenchmarkError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+def create_programmer(path: str, size: int = 256 * 1024) -> None:
+    """
+    生成一个只有一个段的32位ELF, 代替真实的prog*.mbn
+    """
+    header = struct.pack('<4sBBBB8sHHIIIIIHHHHHH', b'\x7fELF', 1, 1, 1, 0, bytes(8), 2, 40, 1, 0, 52, 0, 0, 52, 32, 1, 0, 0, 0)
+    program_header = struct.pack('<IIIIIIII', 1, 84, 0, 0, size, size, 5, 0x1000)
+    with open(path, 'wb') as f:
+        f.write(header + program_header + os.urandom(size))
+
+
+def _data(size: int) -> bytes:
+    """
+    一半随机数据一半全0, 接近真实分区
+    """
+    return os.urandom(size // 2) + bytes(size - size // 2)
+
+
+class Benchmark:
+    def __init__(self, directory: str, transport: str = edl_simulator.DEFAULT_TRANSPORT, **kwargs: Any) -> None:
+        """
+        kwargs: 传给SimulatedDevice
+        """
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        self.directory = directory
+        self.port = edl_simulator.start(1, os.path.join(directory, 'device'), transport, **kwargs)[0]
+        self.mbn = os.path.join(directory, 'prog_emmc_firehose.mbn')
+        create_programmer(self.mbn)
+        self.results: list[tuple[str, float, int]] = []
+        """
+        (步骤, 耗时秒, 传输字节数)
+        """
+
+    def qt(self) -> tools.QT:
+        qt = tools.QT('', '', self.port.name, self.mbn, workspace=os.path.join(self.directory, 'workspace'), native_sahara=True, native_firehose=True)  # type: ignore
+        qt.partition_cache = gpt.PartitionTableCache(os.path.join(self.directory, 'gpt_cache'))
+        return qt
+
+    def step(self, name: str, call: Callable[[], Any], size: int = 0) -> Any:
+        started = time.perf_counter()
+        result = call()
+        self.results.append((name, time.perf_counter() - started, size))
+        return result
+
+    def read_image(self, start: int, size: int) -> bytes:
+        with open(self.port.device.image, 'rb') as f:
+            f.seek(start * self.port.device.sector_size)
+            return f.read(size * self.port.device.sector_size)
+
+    def write_image(self, start: int, data: bytes) -> None:
+        with open(self.port.device.image, 'r+b') as f:
+            f.seek(start * self.port.device.sector_size)
+            f.write(data)
+
+    def run(self) -> None:
+        sector_size = self.port.device.sector_size
+        qt = self.qt()
+        try:
+            self.step('intosahara', qt.intosahara, os.path.getsize(self.mbn))
+            if self.port.device.programmer[:4] != b'\x7fELF':
+                raise BenchmarkError('设备没有收到完整的引导程序')
+
+            partitions = self.step('get_partition_list(完整读取)', qt.get_partition_list)
+            if list(partitions) != [i for i, _ in edl_simulator.DEFAULT_PARTITIONS]:
+                raise BenchmarkError(f'分区表不正确: {list(partitions)}')
+            qt.close()
+            qt = self.qt()
+            if self.step('get_partition_list(使用缓存)', qt.get_partition_list) != partitions:
+                raise BenchmarkError('缓存的分区表与设备不一致')
+
+            boot = partitions['boot']
+            data = _data(boot['size'] * sector_size)
+            source = os.path.join(self.directory, 'boot.img')
+            with open(source, 'wb') as f:
+                f.write(data)
+            self.step('write_partition(boot)', lambda: qt.write_partition(source, 'boot'), len(data))
+            if self.read_image(boot['start'], boot['size']) != data:
+                raise BenchmarkError('写入boot后设备上的内容不正确')
+            readback = os.path.join(self.directory, 'boot.read.img')
+            self.step('read_partition(boot)', lambda: qt.read_partition('boot', output=readback), len(data))
+            with open(readback, 'rb') as f:
+                if f.read() != data:
+                    raise BenchmarkError('读出的boot与写入的不一致')
+
+            selected = {i: partitions[i] for i in PARTITIONS}
+            total = sum(i['size'] for i in selected.values()) * sector_size
+            for i in selected.values():
+                self.write_image(i['start'], _data(i['size'] * sector_size))
+            original = {i: self.read_image(selected[i]['start'], selected[i]['size']) for i in selected}
+            archive = os.path.join(self.directory, f'backup{backup.EXTENSION}')
+            self.step('backup_partitions', lambda: qt.backup_partitions(selected, archive), total)
+            for i in selected.values():
+                self.write_image(i['start'], b'\xff' * (i['size'] * sector_size))
+            self.step('restore_partitions', lambda: qt.restore_partitions(archive), total)
+            for i in selected:
+                if self.read_image(selected[i]['start'], selected[i]['size']) != original[i]:
+                    raise BenchmarkError(f'还原后分区{i}的内容不正确')
+            logging.info('备份包大小%d字节, 原始大小%d字节', os.path.getsize(archive), total)
+
+            self.step('exit9008', qt.exit9008)
+            if self.port.device.resets != 1:
+                raise BenchmarkError('设备没有重启')
+        finally:
+            qt.close()
+
+    def report(self) -> str:
+        lines = ['  耗时(秒)  速度(MB/s)  步骤']
+        for name, elapsed, size in self.results:
+            lines.append(f'{elapsed:>10.3f}{(f"{size / 1048576 / max(elapsed, 1e-6):.1f}" if size else "-"):>12}  {name}')
+        return '\n'.join(lines)
+
+    def close(self, keep: bool = False) -> None:
+        self.port.close()
+        if not keep:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    directory = 'tmp/edl_benchmark'
+    options: dict[str, Any] = {}
+    transport = edl_simulator.DEFAULT_TRANSPORT
+    keep = False
+    for i in sys.argv[1:]:
+        if i.startswith('--dir='):
+            directory = i.split('=', 1)[1]
+        elif i.startswith('--size='):
+            options['size'] = edl_simulator.parse_size(i.split('=', 1)[1])
+        elif i.startswith('--latency='):
+            options['latency'] = float(i.split('=', 1)[1])
+        elif i.startswith('--bandwidth='):
+            options['bandwidth'] = edl_simulator.parse_size(i.split('=', 1)[1])
+        elif i == '--socket':
+            transport = 'socket'
+        elif i == '--keep':
+            keep = True
+    logging.set_config(print=print, level=logging.level.info)
+    benchmark = Benchmark(directory, transport, **options)
+    failed = False
+    try:
+        benchmark.run()
+    except (BenchmarkError, tools.RunProgramException) as e:
+        print(f'失败: {e}')
+        failed = True
+    finally:
+        print(benchmark.report())
+        benchmark.close(keep)
+        logging.logger.close()  # type: ignore
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,224 @@
+"""
+EDL(9008)端口监视
+Windows上通过注册表HARDWARE\\DEVICEMAP\\SERIALCOMM的变化通知得知串口插拔, 其他系统或通知不可用时定时扫描
+"""
+import re
+import sys
+import threading
+from typing import Callable, NamedTuple
+import serial.tools.list_ports
+from serial.tools.list_ports_common import ListPortInfo
+from modules import logging
+
+
+class EDLPort(NamedTuple):
+    device: str
+    """
+    设备名, 例如"COM10"
+    """
+    port: int | None
+    """
+    COM端口号, 例如10, 非COM端口为None
+    """
+    location: str | None
+    """
+    USB路径(由USB口决定, 同一个口插拔后不变)
+    """
+    serial_number: str | None
+    description: str
+
+
+def is_edl(info: ListPortInfo) -> bool:
+    if info.vid == 0x05C6 and info.pid == 0x9008:
+        return True
+    return 'Qualcomm' in info.description and '9008' in info.description
+
+
+def scan() -> dict[str, EDLPort]:
+    """
+    扫描一次当前连接的全部9008端口
+    return: {设备名: EDLPort}
+    """
+    output: dict[str, EDLPort] = {}
+    for i in serial.tools.list_ports.comports():
+        if is_edl(i):
+            match = re.fullmatch(r'COM(\d+)', i.device, re.I)
+            output[i.device] = EDLPort(i.device, None if match is None else int(match.group(1)), i.location, i.serial_number, i.description)
+    return output
+
+
+class _PollWaiter:
+    def __init__(self) -> None:
+        self._event = threading.Event()
+
+    def arm(self) -> None:
+        pass
+
+    def wait(self, timeout: float) -> None:
+        self._event.wait(timeout)
+        self._event.clear()
+
+    def wake(self) -> None:
+        self._event.set()
+
+    def close(self) -> None:
+        pass
+
+
+class _RegistryWaiter:
+    """
+    SERIALCOMM记录了当前存在的全部串口, 串口插拔时该键会变化
+    """
+    def __init__(self) -> None:
+        import ctypes
+        import winreg
+        self._advapi32 = ctypes.WinDLL('advapi32')
+        self._kernel32 = ctypes.WinDLL('kernel32')
+        self._kernel32.CreateEventW.restype = ctypes.c_void_p
+        self._kernel32.SetEvent.argtypes = [ctypes.c_void_p]
+        self._kernel32.WaitForSingleObject.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+        self._kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+        self._advapi32.RegNotifyChangeKeyValue.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_int]
+        self._key = winreg.CreateKeyEx(winreg.HKEY_LOCAL_MACHINE, r'HARDWARE\DEVICEMAP\SERIALCOMM', 0, winreg.KEY_NOTIFY | winreg.KEY_READ)
+        self._event = self._kernel32.CreateEventW(None, False, False, None)
+        if not self._event:
+            raise OSError('CreateEventW失败')
+
+    def arm(self) -> None:
+        # REG_NOTIFY_CHANGE_NAME | REG_NOTIFY_CHANGE_LAST_SET, 每次通知后需要重新注册
+        result = self._advapi32.RegNotifyChangeKeyValue(self._key.handle, False, 0x1 | 0x4, self._event, True)
+        if result != 0:
+            raise OSError(f'RegNotifyChangeKeyValue失败: {result}')
+
+    def wait(self, timeout: float) -> None:
+        self._kernel32.WaitForSingleObject(self._event, int(timeout * 1000))
+
+    def wake(self) -> None:
+        self._kernel32.SetEvent(self._event)
+
+    def close(self) -> None:
+        self._key.Close()
+        self._kernel32.CloseHandle(self._event)
+
+
+class EDLPortMonitor:
+    """
+    在后台线程中维护当前连接的全部9008端口, 端口变化时唤醒等待者
+    """
+    def __init__(self, poll_interval: int | float = 0.5, fallback_interval: int | float = 5) -> None:
+        """
+        poll_interval: 无法监听插拔时定时扫描的间隔(秒)
+        fallback_interval: 能监听插拔时仍然定时扫描的间隔(秒), 作为兜底
+        """
+        self.poll_interval = poll_interval
+        self.fallback_interval = fallback_interval
+        self.ports: dict[str, EDLPort] = {}
+        self.ready = False
+        self.listeners: list[Callable[[dict[str, EDLPort], dict[str, EDLPort]], object]] = []
+        """
+        端口变化时调用, 参数为(变化前, 变化后)
+        """
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread: threading.Thread | None = None
+        self._waiter: _PollWaiter | _RegistryWaiter | None = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='edl-port-monitor', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        if not self._waiter is None:
+            self._waiter.wake()
+        with self._condition:
+            self._condition.notify_all()
+
+    def _create_waiter(self) -> _PollWaiter | _RegistryWaiter:
+        if sys.platform == 'win32':
+            try:
+                return _RegistryWaiter()
+            except OSError as e:
+                logging.debug('无法监听串口插拔, 改为定时扫描: %s', e)
+        return _PollWaiter()
+
+    def _run(self) -> None:
+        self._waiter = waiter = self._create_waiter()
+        try:
+            while not self._stopped:
+                try:
+                    waiter.arm()
+                except OSError as e:
+                    logging.debug('无法监听串口插拔, 改为定时扫描: %s', e)
+                    waiter.close()
+                    self._waiter = waiter = _PollWaiter()
+                self._update(scan())
+                waiter.wait(self.fallback_interval if type(waiter) == _RegistryWaiter else self.poll_interval)
+        finally:
+            waiter.close()
+
+    def _update(self, ports: dict[str, EDLPort]) -> None:
+        with self._condition:
+            old = self.ports
+            self.ports = ports
+            self.ready = True
+            self._condition.notify_all()
+        if ports != old:
+            logging.debug('9008端口变化: %s -> %s', list(old), list(ports))
+            for i in self.listeners:
+                i(old, ports)
+
+    def snapshot(self) -> dict[str, EDLPort]:
+        """
+        return: 当前的全部9008端口(第一次扫描完成前会等待)
+        """
+        self.start()
+        with self._condition:
+            self._condition.wait_for(lambda: self.ready or self._stopped)
+            return dict(self.ports)
+
+    def wait_for(self, predicate: Callable[[EDLPort], bool], timeout: int | float | None = None) -> EDLPort | None:
+        """
+        等待直到出现满足条件的端口
+        timeout: 超时时间(秒), 留空则一直等待
+        return: 满足条件的端口, 超时返回None
+        """
+        self.start()
+        found: list[EDLPort] = []
+
+        def check() -> bool:
+            if self._stopped:
+                return True
+            if self.ready:
+                found.extend(i for i in self.ports.values() if predicate(i))
+            return bool(found)
+        with self._condition:
+            self._condition.wait_for(check, timeout)
+        return found[0] if found else None
+
+    def wait_for_new(self, known: set[str] | None = None, location: str | None = None, timeout: int | float | None = None) -> EDLPort | None:
+        """
+        等待一个新插入的9008端口
+        known: 视为已存在的设备名, 留空则为调用时已存在的全部端口
+        location: 只等待指定USB路径上的端口
+        """
+        if known is None:
+            known = set(self.snapshot())
+        return self.wait_for(lambda i: not i.device in known and (location is None or i.location == location), timeout)
+
+
+_monitor: EDLPortMonitor | None = None
+_monitor_lock = threading.Lock()
+
+
+def get_monitor() -> EDLPortMonitor:
+    """
+    获取全局共用的EDLPortMonitor(首次调用时启动)
+    """
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = EDLPortMonitor()
+            _monitor.start()
+        return _monitor
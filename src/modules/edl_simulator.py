@@ -0,0 +1,574 @@
+"""
+模拟9008模式的设备, 用于在没有手表的Linux电脑上测试和测速EDL相关流程(QT的读写分区、超级恢复等)
+设备先以Sahara协议接收引导程序, 然后以Firehose协议读写"eMMC"; eMMC是一个带有真实GPT的稀疏文件
+端口可以是pty(例如/dev/pts/3, 仅Linux/macOS)或TCP(例如socket://127.0.0.1:40000), 都可以直接作为QT/sahara/firehose的port
+只模拟内置的Sahara/Firehose客户端会用到的命令, QSaharaServer.exe和fh_loader.exe仍需要真实设备
+
+python -m modules.edl_simulator [--count=2] [--dir=tmp/edl_simulator] [--size=4G] [--latency=0.001] [--bandwidth=20M] [--socket]
+"""
+import os
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+import zlib
+from typing import Any, BinaryIO, Callable
+from xml.sax.saxutils import quoteattr
+from modules import logging
+from modules import sahara
+
+if sys.platform != 'win32':
+    import fcntl
+    import termios
+    import tty
+
+DEFAULT_PARTITIONS: list[tuple[str, int]] = [
+    ('modem', 65536),
+    ('sbl1', 512),
+    ('sbl1bak', 512),
+    ('rpm', 512),
+    ('rpmbak', 512),
+    ('tz', 1024),
+    ('tzbak', 1024),
+    ('devinfo', 1),
+    ('fsg', 1536),
+    ('sec', 16),
+    ('aboot', 1024),
+    ('abootbak', 1024),
+    ('misc', 1024),
+    ('modemst1', 1536),
+    ('modemst2', 1536),
+    ('fsc', 1),
+    ('ssd', 8),
+    ('persist', 32768),
+    ('boot', 32768),
+    ('recovery', 32768),
+    ('cache', 262144),
+    ('system', 1572864),
+    ('userdata', 0),
+]
+"""
+默认分区表: (分区名, 大小KiB), 大小为0表示占用剩余全部空间(只能是最后一项)
+"""
+
+_BASIC_DATA = uuid.UUID('EBD0A0A2-B9E5-4433-87C0-68B6B72699C7')
+_ENTRY_COUNT = 128
+_ENTRY_SIZE = 128
+_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+_ENTRY = struct.Struct('<16s16sQQQ72s')
+
+_TIOCPKT_FLUSHREAD = 0x01
+
+DEFAULT_TRANSPORT = 'socket' if sys.platform == 'win32' else 'pty'
+
+
+class SimulatorError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+def parse_size(value: str) -> int:
+    """
+    解析"4G", "512M", "20m"这样的大小(1024进制)
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', value, re.I)
+    if match is None:
+        raise SimulatorError(f'无法解析大小: {value}')
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+
+def build_gpt(disk_sectors: int, partitions: list[tuple[str, int]] = DEFAULT_PARTITIONS, sector_size: int = 512) -> tuple[bytes, bytes, bytes, bytes]:
+    """
+    生成GPT, 分区从第34扇区开始依次紧密排列
+    disk_sectors: 存储的总扇区数
+    partitions: [(分区名, 大小KiB), ...]
+    return: 保护性MBR, 主GPT头(第1扇区), 分区项(主GPT在第2扇区, 备份在倒数第33扇区), 备份GPT头(最后一个扇区)
+    """
+    entries_sectors = _ENTRY_COUNT * _ENTRY_SIZE // sector_size
+    first_usable = 2 + entries_sectors
+    last_usable = disk_sectors - 2 - entries_sectors
+    entries = bytearray(_ENTRY_COUNT * _ENTRY_SIZE)
+    start = first_usable
+    for i, (name, size) in enumerate(partitions):
+        sectors = last_usable + 1 - start if size == 0 else size * 1024 // sector_size
+        if sectors <= 0 or start + sectors - 1 > last_usable:
+            raise SimulatorError(f'存储空间不足, 无法放下分区{name}')
+        _ENTRY.pack_into(entries, i * _ENTRY_SIZE, _BASIC_DATA.bytes_le, uuid.uuid4().bytes_le, start, start + sectors - 1, 0, name.encode('utf-16-le'))
+        start += sectors
+    entries_crc = zlib.crc32(entries)
+    disk_guid = uuid.uuid4().bytes_le
+
+    def header(current: int, backup: int, entries_lba: int) -> bytes:
+        fields = [b'EFI PART', 0x00010000, _HEADER.size, 0, 0, current, backup, first_usable, last_usable, disk_guid, entries_lba, _ENTRY_COUNT, _ENTRY_SIZE, entries_crc]
+        fields[3] = zlib.crc32(_HEADER.pack(*fields))
+        return _HEADER.pack(*fields).ljust(sector_size, b'\0')
+
+    mbr = bytearray(sector_size)
+    struct.pack_into('<B3sB3sII', mbr, 446, 0, b'\x00\x02\x00', 0xEE, b'\xff\xff\xff', 1, min(disk_sectors - 1, 0xFFFFFFFF))
+    mbr[510:512] = b'\x55\xaa'
+    return bytes(mbr), header(1, disk_sectors - 1, 2), bytes(entries), header(disk_sectors - 1, 1, disk_sectors - 1 - entries_sectors)
+
+
+def create_image(path: str, size: int, partitions: list[tuple[str, int]] = DEFAULT_PARTITIONS, sector_size: int = 512) -> None:
+    """
+    创建稀疏的eMMC镜像并写入GPT, 除GPT外不占用磁盘空间
+    size: 存储大小(字节)
+    """
+    disk_sectors = size // sector_size
+    mbr, primary, entries, backup = build_gpt(disk_sectors, partitions, sector_size)
+    with open(path, 'wb') as f:
+        f.truncate(disk_sectors * sector_size)
+        f.write(mbr + primary + entries)
+        f.seek((disk_sectors - 1) * sector_size - len(entries))
+        f.write(entries + backup)
+
+
+class _Closed(Exception):
+    """
+    主机关闭或重新打开了端口, 当前会话结束
+    """
+
+
+class _Stream:
+    """
+    主机到设备的字节流, 由传输层填充
+    """
+    def __init__(self, write: Callable[[bytes], object]) -> None:
+        self._write = write
+        self._buffer = bytearray()
+        self._condition = threading.Condition()
+        self.closed = False
+
+    def feed(self, data: bytes) -> None:
+        with self._condition:
+            self._buffer += data
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def read(self, size: int) -> bytes:
+        """
+        读取最多size字节, 没有数据时等待
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._buffer or self.closed)
+            if self.closed:
+                raise _Closed
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    def wait(self, timeout: float) -> bool:
+        """
+        等待主机发来数据
+        return: timeout秒内是否收到了数据
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._buffer or self.closed, timeout)
+            if self.closed:
+                raise _Closed
+            return bool(self._buffer)
+
+    def read_exactly(self, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            data += self.read(size - len(data))
+        return bytes(data)
+
+    def find(self, marker: bytes) -> bytes:
+        """
+        读取到marker(包括marker)为止
+        """
+        with self._condition:
+            while True:
+                self._condition.wait_for(lambda: marker in self._buffer or self.closed)
+                if self.closed:
+                    raise _Closed
+                end = self._buffer.find(marker) + len(marker)
+                data = bytes(self._buffer[:end])
+                del self._buffer[:end]
+                return data
+
+    def write(self, data: bytes) -> None:
+        if self.closed:
+            raise _Closed
+        self._write(data)
+
+
+class SimulatedDevice:
+    def __init__(self, image: str, size: int = 4 * 1024 ** 3, partitions: list[tuple[str, int]] = DEFAULT_PARTITIONS, sector_size: int = 512, latency: int | float = 0, bandwidth: int | None = None, max_payload: int = 1048576, hello_interval: int | float = 0.5) -> None:
+        """
+        image: eMMC镜像文件, 不存在时按size和partitions创建
+        latency: 设备每次回复前的延迟(秒)
+        bandwidth: 原始数据(引导程序、分区数据)的传输速度(字节/秒), 留空则不限速
+        max_payload: 设备支持的最大MaxPayloadSizeToTargetInBytes
+        hello_interval: 主机没有回复时重发Sahara HELLO的间隔(秒)
+        """
+        if not os.path.exists(image):
+            create_image(image, size, partitions, sector_size)
+        self.image = image
+        self.sector_size = sector_size
+        self.disk_sectors = os.path.getsize(image) // sector_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_payload = max_payload
+        self.hello_interval = hello_interval
+        self.mode = 'sahara'
+        self.programmer = b''
+        """
+        最近一次通过Sahara收到的引导程序
+        """
+        self.commands: list[str] = []
+        """
+        收到的全部Firehose命令名
+        """
+        self.bootable_drive: int | None = None
+        self.resets = 0
+
+    def _delay(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _throttle(self, size: int) -> None:
+        if not self.bandwidth is None:
+            time.sleep(size / self.bandwidth)
+
+    def serve(self, stream: _Stream) -> None:
+        """
+        处理一次主机打开端口到关闭端口之间的通信
+        """
+        try:
+            if self.mode == 'sahara':
+                self._sahara(stream)
+            self._firehose(stream)
+        except _Closed:
+            pass
+
+    # Sahara
+
+    def _sahara_packet(self, stream: _Stream, command: int, body: bytes = b'') -> None:
+        self._delay()
+        stream.write(struct.pack('<II', command, 8 + len(body)) + body)
+
+    def _sahara_read(self, stream: _Stream, offset: int, length: int) -> bytes:
+        self._sahara_packet(stream, sahara.READ_DATA, struct.pack('<III', sahara.PROGRAMMER_IMAGE_ID, offset, length))
+        data = stream.read_exactly(length)
+        self._throttle(length)
+        return data
+
+    def _sahara(self, stream: _Stream) -> None:
+        # 主机打开端口时(pyserial的socket://会清空输入缓冲)可能丢掉HELLO, 所以在主机回复前定时重发, 收到RESET_STATE_MACHINE时也重发
+        while True:
+            self._sahara_packet(stream, sahara.HELLO, struct.pack('<IIIIII24s', 2, 1, 0x1000, sahara.MODE_IMAGE_TX_PENDING, 0, 0, b''))
+            if not stream.wait(self.hello_interval):
+                continue
+            command, length = struct.unpack('<II', stream.read_exactly(8))
+            stream.read_exactly(length - 8)
+            if command != sahara.RESET_STATE_MACHINE:
+                break
+        if command != sahara.HELLO_RESP:
+            raise SimulatorError(f'期望收到HELLO_RESP, 实际收到命令{command:#x}')
+        # 与真实设备一样先读ELF头, 再按程序头读取各个段
+        header = self._sahara_read(stream, 0, 52)
+        segments: list[tuple[int, int]] = []
+        if header[:4] == b'\x7fELF':
+            if header[4] == 2:
+                header += self._sahara_read(stream, 52, 12)
+                phoff, = struct.unpack_from('<Q', header, 32)
+                phentsize, phnum = struct.unpack_from('<HH', header, 54)
+                layout = struct.Struct('<IIQQQQQQ')
+            else:
+                phoff, = struct.unpack_from('<I', header, 28)
+                phentsize, phnum = struct.unpack_from('<HH', header, 42)
+                layout = struct.Struct('<IIIIIIII')
+            table = self._sahara_read(stream, phoff, phentsize * phnum)
+            for i in range(phnum):
+                fields = layout.unpack_from(table, i * phentsize)
+                offset, filesz = (fields[2], fields[5]) if header[4] == 2 else (fields[1], fields[4])
+                if filesz:
+                    segments.append((offset, filesz))
+        programmer = bytearray(header)
+        for offset, filesz in segments:
+            for i in range(offset, offset + filesz, 0x1000):
+                data = self._sahara_read(stream, i, min(0x1000, offset + filesz - i))
+                programmer[len(programmer):] = bytes(max(0, i - len(programmer)))
+                programmer[i:i + len(data)] = data
+        self.programmer = bytes(programmer)
+        self._sahara_packet(stream, sahara.END_IMAGE_TX, struct.pack('<II', sahara.PROGRAMMER_IMAGE_ID, 0))
+        command, length = struct.unpack('<II', stream.read_exactly(8))
+        stream.read_exactly(length - 8)
+        if command != sahara.DONE:
+            raise SimulatorError(f'期望收到DONE, 实际收到命令{command:#x}')
+        self._sahara_packet(stream, sahara.DONE_RESP, struct.pack('<I', 1))
+        self.mode = 'firehose'
+        logging.debug('模拟设备%s收到引导程序: %d字节', self.image, len(self.programmer))
+
+    # Firehose
+
+    def _respond(self, stream: _Stream, value: str, attributes: dict[str, object] = {}, logs: list[str] = []) -> None:
+        self._delay()
+        stream.write(('<?xml version="1.0" encoding="UTF-8" ?><data>'
+                      + ''.join(f'<log value={quoteattr(i)} />' for i in logs)
+                      + f'<response value="{value}" ' + ' '.join(f'{k}={quoteattr(str(v))}' for k, v in attributes.items()) + ' /></data>').encode())
+
+    def _sector(self, value: str) -> int:
+        match = re.fullmatch(r'\s*NUM_DISKSECTORS\s*([-+])\s*(\d+)\.?\s*', value)
+        if match is None:
+            return int(value.rstrip('.'))
+        return self.disk_sectors + int(match.group(2)) * (1 if match.group(1) == '+' else -1)
+
+    def _check_range(self, start: int, sectors: int) -> str | None:
+        if start < 0 or sectors <= 0 or start + sectors > self.disk_sectors:
+            return f'扇区{start}+{sectors}超出存储范围{self.disk_sectors}'
+        return None
+
+    def _firehose(self, stream: _Stream) -> None:
+        with open(self.image, 'r+b') as f:
+            while self.mode == 'firehose':
+                document = stream.find(b'</data>')
+                document = document[max(document.find(b'<?xml'), 0):]
+                try:
+                    root = ET.fromstring(document)
+                except ET.ParseError as e:
+                    self._respond(stream, 'NAK', logs=[f'无法解析XML: {e}'])
+                    continue
+                for i in root:
+                    self.commands.append(i.tag)
+                    handler = getattr(self, f'_fh_{i.tag}', None)
+                    if handler is None:
+                        self._respond(stream, 'NAK', logs=[f'不支持的命令{i.tag}'])
+                    else:
+                        handler(stream, f, i.attrib)
+
+    def _fh_configure(self, stream: _Stream, f: BinaryIO, attributes: dict[str, str]) -> None:
+        requested = int(attributes.get('MaxPayloadSizeToTargetInBytes', self.max_payload))
+        if requested > self.max_payload:
+            self._respond(stream, 'NAK', {'MaxPayloadSizeToTargetInBytes': self.max_payload, 'MaxPayloadSizeToTargetInBytesSupported': self.max_payload}, [f'MaxPayloadSizeToTargetInBytes={requested}超出支持的大小'])
+        else:
+            self._respond(stream, 'ACK', {'MemoryName': attributes.get('MemoryName', 'emmc'), 'MaxPayloadSizeToTargetInBytes': requested, 'MaxPayloadSizeToTargetInBytesSupported': self.max_payload, 'MaxPayloadSizeFromTargetInBytes': 4096, 'TargetName': 'simulator', 'Version': 1})
+
+    def _fh_nop(self, stream: _Stream, f: BinaryIO, attributes: dict[str, str]) -> None:
+        self._respond(stream, 'ACK')
+
+    def _fh_read(self, stream: _Stream, f: BinaryIO, attributes: dict[str, str]) -> None:
+        start = self._sector(attributes['start_sector'])
+        sectors = int(attributes['num_partition_sectors'])
+        error = self._check_range(start, sectors)
+        if not error is None:
+            self._respond(stream, 'NAK', logs=[error])
+            return
+        self._respond(stream, 'ACK', {'rawmode': 'true'})
+        f.seek(start * self.sector_size)
+        remaining = sectors * self.sector_size
+        while remaining > 0:
+            chunk = f.read(min(remaining, self.max_payload))
+            self._throttle(len(chunk))
+            stream.write(chunk)
+            remaining -= len(chunk)
+        self._respond(stream, 'ACK', {'rawmode': 'false'})
+
+    def _fh_program(self, stream: _Stream, f: BinaryIO, attributes: dict[str, str]) -> None:
+        start = self._sector(attributes['start_sector'])
+        sectors = int(attributes['num_partition_sectors'])
+        error = self._check_range(start, sectors)
+        if not error is None:
+            self._respond(stream, 'NAK', logs=[error])
+            return
+        self._respond(stream, 'ACK', {'rawmode': 'true'})
+        f.seek(start * self.sector_size)
+        remaining = sectors * self.sector_size
+        while remaining > 0:
+            chunk = stream.read(min(remaining, self.max_payload))
+            self._throttle(len(chunk))
+            f.write(chunk)
+            remaining -= len(chunk)
+        f.flush()
+        self._respond(stream, 'ACK', {'rawmode': 'false'})
+
+    def _fh_erase(self, stream: _Stream, f: BinaryIO, attributes: dict[str, str]) -> None:
+        start = self._sector(attributes['start_sector'])
+        sectors = int(attributes['num_partition_sectors'])
+        error = self._check_range(start, sectors)
+        if not error is None:
+            self._respond(stream, 'NAK', logs=[error])
+            return
+        # 模拟ERASED_MEM_CONT=0的eMMC, 擦除后为全0
+        f.seek(start * self.sector_size)
+        remaining = sectors * self.sector_size
+        while remaining > 0:
+            size = min(remaining, 16 * 1024 * 1024)
+            f.write(bytes(size))
+            remaining -= size
+        f.flush()
+        self._respond(stream, 'ACK')
+
+    def _fh_patch(self, stream: _Stream, f: BinaryIO, attributes: dict[str, str]) -> None:
+        if attributes.get('filename') != 'DISK':
+            self._respond(stream, 'ACK')
+            return
+        value = attributes['value']
+        match = re.fullmatch(r'\s*CRC32\((.+),\s*(\d+)\)\s*', value)
+        if match is None:
+            number = self._sector(value)
+        else:
+            f.seek(self._sector(match.group(1)) * self.sector_size)
+            number = zlib.crc32(f.read(int(match.group(2))))
+        size = int(attributes['size_in_bytes'])
+        f.seek(self._sector(attributes['start_sector']) * self.sector_size + int(attributes['byte_offset']))
+        f.write(number.to_bytes(size, 'little', signed=number < 0))
+        f.flush()
+        self._respond(stream, 'ACK')
+
+    def _fh_setbootablestoragedrive(self, stream: _Stream, f: BinaryIO, attributes: dict[str, str]) -> None:
+        self.bootable_drive = int(attributes.get('value', 0))
+        self._respond(stream, 'ACK')
+
+    def _fh_power(self, stream: _Stream, f: BinaryIO, attributes: dict[str, str]) -> None:
+        if attributes.get('value', 'reset').lower() == 'reset':
+            # 重启后回到Sahara模式, 主机下次打开端口时重新发送HELLO; 先更新状态再回复, 主机收到ACK时已经是重启后的状态
+            self.resets += 1
+            self.mode = 'sahara'
+        self._respond(stream, 'ACK')
+
+
+class SimulatedPort:
+    """
+    把SimulatedDevice挂到pty或TCP端口上, 在后台线程中运行
+    """
+    def __init__(self, device: SimulatedDevice, transport: str = DEFAULT_TRANSPORT) -> None:
+        """
+        transport: pty(Windows不支持)或socket
+        """
+        self.device = device
+        self.transport = transport
+        self._stream: _Stream | None = None
+        self._stopped = False
+        if transport == 'pty':
+            if sys.platform == 'win32':
+                raise SimulatorError('Windows不支持pty, 请使用socket')
+            self._master, self._slave = os.openpty()
+            tty.setraw(self._slave)
+            # 包模式下主机打开端口时(pyserial会清空输入缓冲)能收到TIOCPKT_FLUSHREAD, 以此作为一次新会话
+            fcntl.ioctl(self._master, termios.TIOCPKT, struct.pack('i', 1))
+            self.name = os.ttyname(self._slave)
+            target = self._run_pty
+        elif transport == 'socket':
+            self._server = socket.create_server(('127.0.0.1', 0))
+            self.name = f'socket://127.0.0.1:{self._server.getsockname()[1]}'
+            target = self._run_socket
+        else:
+            raise SimulatorError(f'不支持的传输方式{transport}')
+        self._thread = threading.Thread(target=target, name=f'edl-simulator-{self.name}', daemon=True)
+        self._thread.start()
+
+    def _session(self, stream: _Stream) -> None:
+        if not self._stream is None:
+            self._stream.close()
+        self._stream = stream
+        threading.Thread(target=self._serve, args=(stream,), name=f'edl-simulator-session-{self.name}', daemon=True).start()
+
+    def _serve(self, stream: _Stream) -> None:
+        try:
+            self.device.serve(stream)
+        except Exception as e:
+            logging.debug('模拟设备%s出错: %s', self.name, e)
+
+    def _pty_write(self, data: bytes) -> None:
+        with memoryview(data) as view:
+            while view:
+                written = os.write(self._master, view)
+                view = view[written:]
+
+    def _run_pty(self) -> None:
+        while not self._stopped:
+            try:
+                packet = os.read(self._master, 65537)
+            except OSError:
+                break
+            if not packet:
+                break
+            if packet[0] == 0:
+                if not self._stream is None:
+                    self._stream.feed(packet[1:])
+            elif packet[0] & _TIOCPKT_FLUSHREAD:
+                self._session(_Stream(self._pty_write))
+
+    def _run_socket(self) -> None:
+        while not self._stopped:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                break
+            stream = _Stream(connection.sendall)
+            self._session(stream)
+            threading.Thread(target=self._receive, args=(connection, stream), daemon=True).start()
+
+    @staticmethod
+    def _receive(connection: socket.socket, stream: _Stream) -> None:
+        with connection:
+            while True:
+                try:
+                    data = connection.recv(65536)
+                except OSError:
+                    data = b''
+                if not data:
+                    stream.close()
+                    return
+                stream.feed(data)
+
+    def close(self) -> None:
+        self._stopped = True
+        if not self._stream is None:
+            self._stream.close()
+        if self.transport == 'pty':
+            os.close(self._slave)
+            os.close(self._master)
+        else:
+            self._server.close()
+
+
+def start(count: int = 1, directory: str = 'tmp/edl_simulator', transport: str = DEFAULT_TRANSPORT, **kwargs: Any) -> list[SimulatedPort]:
+    """
+    启动多个模拟设备, 每个设备使用directory中各自的镜像
+    kwargs: 传给SimulatedDevice
+    return: 模拟端口, name可直接作为port使用
+    """
+    os.makedirs(directory, exist_ok=True)
+    return [SimulatedPort(SimulatedDevice(os.path.join(directory, f'emmc{i}.img'), **kwargs), transport) for i in range(count)]
+
+
+if __name__ == '__main__':
+    count = 1
+    directory = 'tmp/edl_simulator'
+    options: dict[str, Any] = {}
+    transport = DEFAULT_TRANSPORT
+    for i in sys.argv[1:]:
+        if i.startswith('--count='):
+            count = int(i.split('=', 1)[1])
+        elif i.startswith('--dir='):
+            directory = i.split('=', 1)[1]
+        elif i.startswith('--size='):
+            options['size'] = parse_size(i.split('=', 1)[1])
+        elif i.startswith('--latency='):
+            options['latency'] = float(i.split('=', 1)[1])
+        elif i.startswith('--bandwidth='):
+            options['bandwidth'] = parse_size(i.split('=', 1)[1])
+        elif i == '--socket':
+            transport = 'socket'
+    logging.set_config(print=print, level=logging.level.debug)
+    ports = start(count, directory, transport, **options)
+    for i in ports:
+        print(i.name)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for i in ports:
+            i.close()
+        logging.logger.close()  # type: ignore
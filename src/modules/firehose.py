@@ -0,0 +1,395 @@
+"""
+Firehose协议客户端, 在进程内完成fh_loader的读写分区、发送XML、重启等操作
+主机发送<data>包裹的XML命令, 设备回复任意条<log>和一条<response>; 读写数据时在两次response之间以原始数据传输
+"""
+import io
+import mmap
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Callable
+from xml.sax.saxutils import quoteattr
+import serial
+from modules import logging
+from modules import sparse
+from modules.sahara import SerialLike, port_name
+
+
+class FirehoseError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class FirehoseNAK(FirehoseError):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+ERASE_MIN_SIZE = 1024 * 1024
+"""
+program_sparse(erase_zeros=True)时, 不小于这个大小(字节)的全0 FILL才用erase代替写入; 更小的直接写入比擦除再读回检查更快
+"""
+
+_element = re.compile(rb'<(log|response)\s([^>]*?)/?>')
+_attribute = re.compile(rb'([\w.]+)\s*=\s*"([^"]*)"')
+
+
+class FirehoseClient:
+    def __init__(self, port: SerialLike, memory: str = 'emmc', sector_size: int = 512, max_payload: int = 1048576, on_log: Callable[[str], object] | None = None) -> None:
+        """
+        port: 已打开的串口(或任何有read/write的对象), read需要设置超时
+        memory: 存储类型
+        sector_size: 扇区大小(字节)
+        max_payload: configure时请求的单次传输最大字节数, 设备不支持时使用设备给出的值
+        on_log: 每收到一条设备日志时调用
+        """
+        self.port = port
+        self.memory = memory
+        self.sector_size = sector_size
+        self.max_payload = max_payload
+        self.on_log = on_log
+        self.logs: list[str] = []
+        """
+        最近一条命令期间设备输出的日志
+        """
+        self._buffer = bytearray()
+        self._disk_sectors: dict[int, int] = {}
+        self.configured = False
+
+    def _read_more(self, size: int | None = None) -> None:
+        """
+        size: 确定会收到的字节数(读取扇区数据时); 留空则收到任何数据就返回, 不等待超时
+        """
+        chunk = self.port.read(1 if size is None else max(size, 1))
+        if not chunk:
+            raise FirehoseError('等待设备回复超时' + (f', 最后的日志: {self.logs[-1]}' if self.logs else ''))
+        self._buffer += chunk
+        waiting = getattr(self.port, 'in_waiting', 0)
+        if size is None and waiting:
+            self._buffer += self.port.read(waiting)
+
+    def _next_document(self) -> ET.Element | None:
+        """
+        从缓冲中取出一个完整的<data>...</data>, 数据不完整时返回None
+        """
+        end = self._buffer.find(b'</data>')
+        if end == -1:
+            return None
+        start = self._buffer.find(b'<?xml')
+        document = bytes(self._buffer[start if 0 <= start < end else 0:end + 7])
+        del self._buffer[:end + 7]
+        try:
+            return ET.fromstring(document)
+        except ET.ParseError:
+            # 部分设备的日志中含有未转义的字符, 逐个提取log和response
+            logging.debug('无法解析Firehose回复: %s', document)
+            root = ET.Element('data')
+            for tag, attributes in _element.findall(document):
+                ET.SubElement(root, tag.decode(), {k.decode(): v.decode(errors='replace') for k, v in _attribute.findall(attributes)})
+            return root
+
+    def _read_response(self) -> dict[str, str]:
+        while True:
+            document = self._next_document()
+            if document is None:
+                self._read_more()
+                continue
+            for i in document:
+                if i.tag == 'log':
+                    value = i.get('value', '')
+                    self.logs.append(value)
+                    logging.debug('Firehose: %s', value)
+                    if not self.on_log is None:
+                        self.on_log(value)
+                elif i.tag == 'response':
+                    return dict(i.attrib)
+
+    def send(self, tag: str, attributes: dict[str, object]) -> None:
+        xml = f'<?xml version="1.0" ?><data><{tag} ' + ' '.join(f'{k}={quoteattr(str(v))}' for k, v in attributes.items()) + ' /></data>'
+        self.port.write(xml.encode())
+
+    def command(self, tag: str, attributes: dict[str, object] = {}, check: bool = True) -> dict[str, str]:
+        """
+        发送一条命令并等待response
+        check: 为True时设备回复NAK则抛出FirehoseNAK
+        return: response的属性
+        """
+        self.logs = []
+        self.send(tag, attributes)
+        response = self._read_response()
+        if check and response.get('value') != 'ACK':
+            raise FirehoseNAK(f'{tag}失败: {response}', self.logs)
+        return response
+
+    def configure(self) -> int:
+        """
+        协商单次传输的最大字节数
+        return: 协商后的MaxPayloadSizeToTargetInBytes
+        """
+        attributes: dict[str, object] = {'MemoryName': self.memory, 'Verbose': 0, 'AlwaysValidate': 0, 'MaxDigestTableSizeInBytes': 2048, 'MaxPayloadSizeToTargetInBytes': self.max_payload, 'ZLPAwareHost': 1, 'SkipStorageInit': 0, 'SkipWrite': 0}
+        response = self.command('configure', attributes, check=False)
+        if response.get('value') != 'ACK' and 'MaxPayloadSizeToTargetInBytesSupported' in response:
+            attributes['MaxPayloadSizeToTargetInBytes'] = response['MaxPayloadSizeToTargetInBytesSupported']
+            response = self.command('configure', attributes, check=False)
+        if response.get('value') != 'ACK':
+            raise FirehoseNAK(f'configure失败: {response}', self.logs)
+        self.max_payload = int(response.get('MaxPayloadSizeToTargetInBytes', attributes['MaxPayloadSizeToTargetInBytes']))
+        self.configured = True
+        logging.debug('Firehose configure完成, MaxPayloadSizeToTargetInBytes=%d', self.max_payload)
+        return self.max_payload
+
+    def _ensure_configured(self) -> None:
+        if not self.configured:
+            self.configure()
+
+    def _transfer_attributes(self, start: int, sectors: int, partition: int) -> dict[str, object]:
+        return {'SECTOR_SIZE_IN_BYTES': self.sector_size, 'num_partition_sectors': sectors, 'physical_partition_number': partition, 'start_sector': start}
+
+    def read(self, start: int, sectors: int, output: BinaryIO, partition: int = 0, on_progress: Callable[[int, int], object] | None = None) -> int:
+        """
+        读取扇区并直接写入output
+        start: 起始扇区
+        sectors: 扇区数
+        on_progress: 每收到一块数据后调用, 参数为(已接收字节数, 总字节数)
+        return: 读取的字节数
+        """
+        self._ensure_configured()
+        started = time.perf_counter()
+        total = sectors * self.sector_size
+        self.command('read', self._transfer_attributes(start, sectors, partition))
+        received = 0
+        while received < total:
+            if not self._buffer:
+                self._read_more(min(total - received, self.max_payload))
+            size = min(len(self._buffer), total - received)
+            with memoryview(self._buffer) as view:
+                output.write(view[:size])
+            del self._buffer[:size]
+            received += size
+            if not on_progress is None:
+                on_progress(received, total)
+        response = self._read_response()
+        if response.get('value') != 'ACK':
+            raise FirehoseNAK(f'读取扇区{start}+{sectors}失败: {response}', self.logs)
+        elapsed = time.perf_counter() - started
+        logging.debug('Firehose读取扇区%d+%d: %d字节, 耗时%.3f秒, %.1fMB/s', start, sectors, total, elapsed, total / 1048576 / max(elapsed, 1e-6))
+        return total
+
+    def read_bytes(self, start: int, sectors: int, partition: int = 0) -> bytes:
+        with io.BytesIO() as output:
+            self.read(start, sectors, output, partition)
+            return output.getvalue()
+
+    def read_to_file(self, start: int, sectors: int, filename: str, partition: int = 0, on_progress: Callable[[int, int], object] | None = None) -> int:
+        with open(filename, 'wb') as f:
+            return self.read(start, sectors, f, partition, on_progress)
+
+    def program_data(self, start: int, data: bytes | memoryview, partition: int = 0, label: str = '', on_progress: Callable[[int, int], object] | None = None) -> int:
+        """
+        把一段内存中的数据写入扇区, 最后不足一个扇区的部分补0
+        start: 起始扇区
+        label: 用于日志和错误信息的名称
+        on_progress: 每发送一块数据后调用, 参数为(已发送字节数, 总字节数)
+        return: 写入的字节数(含补齐)
+        """
+        self._ensure_configured()
+        started = time.perf_counter()
+        size = len(data)
+        if size == 0:
+            raise FirehoseError(f'{label}为空, 无法写入')
+        count = -(-size // self.sector_size)
+        total = count * self.sector_size
+        attributes = self._transfer_attributes(start, count, partition)
+        attributes['filename'] = label
+        self.command('program', attributes)
+        with memoryview(data) as view:
+            sent = 0
+            while sent < size:
+                with view[sent:sent + self.max_payload] as chunk:
+                    if len(chunk) % self.sector_size:
+                        self.port.write(bytes(chunk) + bytes(self.sector_size - len(chunk) % self.sector_size))
+                    else:
+                        self.port.write(chunk)
+                    sent += len(chunk)
+                if not on_progress is None:
+                    on_progress(total if sent >= size else sent, total)
+        response = self._read_response()
+        if response.get('value') != 'ACK':
+            raise FirehoseNAK(f'写入{label}到扇区{start}失败: {response}', self.logs)
+        elapsed = time.perf_counter() - started
+        logging.debug('Firehose写入%s到扇区%d: %d字节, 耗时%.3f秒, %.1fMB/s', label, start, total, elapsed, total / 1048576 / max(elapsed, 1e-6))
+        return total
+
+    def program(self, start: int, filename: str, sectors: int | None = None, partition: int = 0, file_sector_offset: int = 0, on_progress: Callable[[int, int], object] | None = None) -> int:
+        """
+        把文件通过mmap直接写入扇区, 不复制到临时文件
+        start: 起始扇区
+        filename: 源文件
+        sectors: 最多写入的扇区数(分区大小), 文件超出时报错; 为0(rawprogram中表示按文件大小)或留空则不检查
+        file_sector_offset: 从文件的第几个扇区开始
+        on_progress: 每发送一块数据后调用, 参数为(已发送字节数, 总字节数)
+        return: 写入的字节数(含补齐)
+        """
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size - file_sector_offset * self.sector_size
+            if size <= 0:
+                raise FirehoseError(f'{filename}为空, 无法写入')
+            if sectors and -(-size // self.sector_size) > sectors:
+                raise FirehoseError(f'{filename}共{-(-size // self.sector_size)}个扇区, 超出分区大小{sectors}个扇区')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view, view[file_sector_offset * self.sector_size:] as data:
+                return self.program_data(start, data, partition, os.path.basename(filename), on_progress)
+
+    def program_sparse(self, start: int, filename: str, sectors: int | None = None, partition: int = 0, on_progress: Callable[[int, int], object] | None = None, erase_zeros: bool = False) -> int:
+        """
+        写入Android sparse镜像: RAW直接从mmap发送, FILL展开后发送, DONT_CARE跳过
+        start: 起始扇区
+        sectors: 最多写入的扇区数(分区大小), 展开后超出时报错; 为0或留空则不检查
+        on_progress: 每发送一块数据后调用, 参数为(已发送字节数, 需要发送的总字节数)
+        erase_zeros: 较大的全0 FILL先用erase擦除并读回第一个扇区检查, 擦除后为0则不再发送数据;
+                     设备不支持erase或擦除后不是0时改为写入0, 之后的FILL也不再尝试
+        return: 写入的字节数(不含跳过的部分, 含用erase代替的部分)
+        """
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            try:
+                image = sparse.parse(view)
+            except sparse.SparseError as e:
+                raise FirehoseError(f'{filename}: {e}')
+            if image.block_size % self.sector_size:
+                raise FirehoseError(f'{filename}的块大小{image.block_size}不是扇区大小的整数倍')
+            if sectors and image.size // self.sector_size > sectors:
+                raise FirehoseError(f'{filename}展开后共{image.size // self.sector_size}个扇区, 超出分区大小{sectors}个扇区')
+            chunks = [i for i in image.chunks if i.type in (sparse.CHUNK_RAW, sparse.CHUNK_FILL)]
+            total = sum(i.blocks for i in chunks) * image.block_size
+            done = 0
+            erased = 0
+            label = os.path.basename(filename)
+            for i in chunks:
+                offset = start + i.block * image.block_size // self.sector_size
+                size = i.blocks * image.block_size
+                base = done
+                progress = None if on_progress is None else (lambda sent, _: on_progress(base + sent, total))  # type: ignore
+                if erase_zeros and i.type == sparse.CHUNK_FILL and i.fill == bytes(4) and size >= ERASE_MIN_SIZE:
+                    if self._erase_zeros(offset, size // self.sector_size, partition):
+                        done += size
+                        erased += size
+                        if not on_progress is None:
+                            on_progress(done, total)
+                        continue
+                    erase_zeros = False
+                if i.type == sparse.CHUNK_RAW:
+                    with view[i.data_offset:i.data_offset + size] as data:
+                        done += self.program_data(offset, data, partition, label, progress)
+                else:
+                    for piece in sparse.iter_fill(i.fill, size):
+                        done += self.program_data(offset + (done - base) // self.sector_size, piece, partition, label, None)
+                        if not on_progress is None:
+                            on_progress(done, total)
+            logging.debug('Firehose写入sparse镜像%s: 共%d字节, 跳过%d字节, 擦除%d字节', label, image.size, image.size - total, erased)
+            return done
+
+    def erase(self, start: int, sectors: int, partition: int = 0) -> None:
+        """
+        擦除扇区(rawprogram中的<erase>), 擦除后的内容由存储决定, eMMC通常为全0
+        """
+        self._ensure_configured()
+        self.command('erase', self._transfer_attributes(start, sectors, partition))
+
+    def _erase_zeros(self, start: int, sectors: int, partition: int) -> bool:
+        """
+        用erase代替写入全0
+        return: 擦除成功且读回的第一个扇区为全0时为True, 否则需要调用者写入0
+        """
+        try:
+            self.erase(start, sectors, partition)
+        except FirehoseNAK as e:
+            logging.debug('设备不支持erase, 改为写入0: %s', e)
+            return False
+        if any(self.read_bytes(start, 1, partition)):
+            logging.debug('擦除后的扇区不是全0, 改为写入0')
+            return False
+        return True
+
+    def patch(self, attributes: dict[str, str]) -> None:
+        self._ensure_configured()
+        self.command('patch', attributes)
+
+    def set_bootable_drive(self, drive: int = 0) -> None:
+        """
+        相当于fh_loader --setactivepartition
+        """
+        self._ensure_configured()
+        self.command('setbootablestoragedrive', {'value': drive})
+
+    def reset(self) -> None:
+        """
+        相当于fh_loader --reset
+        """
+        self.command('power', {'value': 'reset'})
+
+    def run_xml(self, filename: str, search_paths: list[str] = [], read: bool = False, on_progress: Callable[[int, int], object] | None = None) -> None:
+        """
+        执行rawprogram/patch XML, 相当于fh_loader --sendxml
+        filename: XML文件
+        search_paths: 查找program中filename的文件夹, XML所在文件夹总是最后查找
+        read: 为True时把program当作read执行, 结果写入search_paths中的第一个文件夹(相当于--convertprogram2read)
+        """
+        for i in ET.parse(filename).getroot():
+            attributes = dict(i.attrib)
+            partition = int(attributes.get('physical_partition_number', 0))
+            if i.tag == 'program':
+                name = attributes.get('filename', '')
+                if name == '':
+                    continue
+                start = self.resolve_sector(attributes['start_sector'], partition)
+                sectors = int(attributes['num_partition_sectors'])
+                if read:
+                    self.read_to_file(start, sectors, os.path.join((search_paths + [os.path.dirname(filename)])[0], name), partition, on_progress)
+                elif attributes.get('sparse', 'false').lower() == 'true':
+                    self.program_sparse(start, self._find(name, search_paths + [os.path.dirname(filename)]), sectors, partition, on_progress)
+                else:
+                    self.program(start, self._find(name, search_paths + [os.path.dirname(filename)]), sectors, partition, int(attributes.get('file_sector_offset', 0)), on_progress)
+            elif i.tag == 'patch':
+                if attributes.get('filename') == 'DISK':
+                    self.patch(attributes)
+            elif i.tag == 'read':
+                self.read_to_file(self.resolve_sector(attributes['start_sector'], partition), int(attributes['num_partition_sectors']), os.path.join((search_paths + [os.path.dirname(filename)])[0], attributes['filename']), partition, on_progress)
+
+    def disk_sectors(self, partition: int = 0) -> int:
+        """
+        return: 存储的总扇区数(由GPT头中备份GPT头的位置得出)
+        """
+        if not partition in self._disk_sectors:
+            header = self.read_bytes(1, 1, partition)
+            if header[:8] != b'EFI PART':
+                raise FirehoseError('无法读取GPT头, 不能计算NUM_DISKSECTORS')
+            self._disk_sectors[partition] = int.from_bytes(header[32:40], 'little') + 1
+        return self._disk_sectors[partition]
+
+    def resolve_sector(self, value: str, partition: int = 0) -> int:
+        """
+        解析XML中的扇区号, 支持NUM_DISKSECTORS-33.这样的写法
+        """
+        match = re.fullmatch(r'\s*NUM_DISKSECTORS\s*([-+])\s*(\d+)\.?\s*', value)
+        if match is None:
+            return int(value.rstrip('.'))
+        offset = int(match.group(2))
+        return self.disk_sectors(partition) + (offset if match.group(1) == '+' else -offset)
+
+    @staticmethod
+    def _find(name: str, search_paths: list[str]) -> str:
+        for i in search_paths:
+            if os.path.exists(os.path.join(i, name)):
+                return os.path.join(i, name)
+        raise FirehoseError(f'在{search_paths}中找不到{name}')
+
+
+def open_port(port: int | str, timeout: int | float = 10) -> serial.Serial:
+    """
+    port: COM端口号或设备名
+    timeout: 等待设备每次回复的超时时间(秒)
+    """
+    try:
+        return serial.serial_for_url(port_name(port), 115200, timeout=timeout, write_timeout=timeout)
+    except serial.SerialException as e:
+        raise FirehoseError(f'无法打开{port_name(port)}: {e}')
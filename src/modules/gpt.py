@@ -0,0 +1,216 @@
+"""
+GPT分区表解析
+GPT头在第1扇区, 分区项数组的位置、数量和大小由GPT头给出; 所有数值为小端序
+"""
+import bisect
+import os
+import struct
+import uuid
+import zlib
+from array import array
+from typing import Iterator, NamedTuple
+
+
+class GPTError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+SIGNATURE = b'EFI PART'
+
+_HEADER = struct.Struct('<8sIII4xQQQQ16sQIII')
+_ENTRY = struct.Struct('<16s16sQQQ72s')
+
+
+class Header(NamedTuple):
+    revision: int
+    header_size: int
+    current_lba: int
+    backup_lba: int
+    first_usable_lba: int
+    last_usable_lba: int
+    disk_guid: uuid.UUID
+    entries_lba: int
+    entry_count: int
+    entry_size: int
+    entries_crc: int
+    crc: int
+    """
+    GPT头的CRC32, 分区表变化时一定会变化
+    """
+
+    @property
+    def entries_bytes(self) -> int:
+        return self.entry_count * self.entry_size
+
+    def entries_sectors(self, sector_size: int = 512) -> int:
+        return -(-self.entries_bytes // sector_size)
+
+
+class Partition(NamedTuple):
+    name: str
+    start: int
+    """
+    第一个扇区
+    """
+    end: int
+    """
+    最后一个扇区(包含)
+    """
+    attributes: int
+    type_guid: uuid.UUID
+    unique_guid: uuid.UUID
+
+    @property
+    def size(self) -> int:
+        """
+        扇区数
+        """
+        return self.end - self.start + 1
+
+
+def parse_header(header: bytes | memoryview) -> Header:
+    """
+    解析并校验GPT头
+    header: 第1扇区的内容
+    """
+    if len(header) < _HEADER.size:
+        raise GPTError(f'GPT头长度不足: {len(header)}字节')
+    signature, revision, header_size, crc, current, backup, first_usable, last_usable, disk_guid, entries_lba, entry_count, entry_size, entries_crc = _HEADER.unpack_from(header)
+    if signature != SIGNATURE:
+        raise GPTError(f'不是GPT头: 签名为{bytes(signature)!r}')
+    if not _HEADER.size <= header_size <= len(header):
+        raise GPTError(f'GPT头大小错误: {header_size}')
+    with memoryview(header) as view:
+        actual = zlib.crc32(view[20:header_size], zlib.crc32(bytes(4), zlib.crc32(view[:16])))
+    if actual != crc:
+        raise GPTError(f'GPT头CRC错误: 记录为{crc:#010x}, 实际为{actual:#010x}')
+    if entry_size < _ENTRY.size:
+        raise GPTError(f'分区项大小错误: {entry_size}')
+    return Header(revision, header_size, current, backup, first_usable, last_usable, uuid.UUID(bytes_le=disk_guid), entries_lba, entry_count, entry_size, entries_crc, crc)
+
+
+class PartitionTable:
+    """
+    解析后的分区表, 各字段按分区项顺序存放在数组中
+    """
+    __slots__ = ('header', 'names', 'starts', 'ends', 'attributes', '_guids', '_index', '_order', '_sorted_starts')
+
+    def __init__(self, header: Header, entries: bytes | memoryview) -> None:
+        """
+        entries: 分区项数组的内容, 长度不小于header.entries_bytes
+        """
+        if len(entries) < header.entries_bytes:
+            raise GPTError(f'分区项数组长度不足: 需要{header.entries_bytes}字节, 只有{len(entries)}字节')
+        with memoryview(entries) as view, view[:header.entries_bytes] as array_view:
+            actual = zlib.crc32(array_view)
+            if actual != header.entries_crc:
+                raise GPTError(f'分区项数组CRC错误: 记录为{header.entries_crc:#010x}, 实际为{actual:#010x}')
+            self.header = header
+            self.names: list[str] = []
+            self.starts = array('Q')
+            self.ends = array('Q')
+            self.attributes = array('Q')
+            self._guids = bytearray()
+            empty = bytes(16)
+            for offset in range(0, header.entries_bytes, header.entry_size):
+                type_guid, unique_guid, start, end, attributes, name = _ENTRY.unpack_from(array_view, offset)
+                if type_guid == empty:
+                    continue
+                self.names.append(name.decode('utf-16-le').split('\0', 1)[0])
+                self.starts.append(start)
+                self.ends.append(end)
+                self.attributes.append(attributes)
+                self._guids += type_guid + unique_guid
+        self._index = {name: i for i, name in reversed(list(enumerate(self.names)))}
+        self._order = sorted(range(len(self.names)), key=lambda i: self.starts[i])
+        self._sorted_starts = array('Q', (self.starts[i] for i in self._order))
+
+    @property
+    def disk_sectors(self) -> int:
+        """
+        存储的总扇区数(备份GPT头在最后一个扇区)
+        """
+        return self.header.backup_lba + 1
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[Partition]:
+        return (self._partition(i) for i in range(len(self.names)))
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._index
+
+    def __getitem__(self, name: str) -> Partition:
+        if not name in self._index:
+            raise KeyError(name)
+        return self._partition(self._index[name])
+
+    def get(self, name: str) -> Partition | None:
+        return self._partition(self._index[name]) if name in self._index else None
+
+    def _partition(self, i: int) -> Partition:
+        return Partition(self.names[i], self.starts[i], self.ends[i], self.attributes[i], uuid.UUID(bytes_le=bytes(self._guids[i * 32:i * 32 + 16])), uuid.UUID(bytes_le=bytes(self._guids[i * 32 + 16:i * 32 + 32])))
+
+    def find(self, sector: int) -> Partition | None:
+        """
+        return: 包含该扇区的分区, 不在任何分区中时为None
+        """
+        position = bisect.bisect_right(self._sorted_starts, sector) - 1
+        if position < 0:
+            return None
+        i = self._order[position]
+        return self._partition(i) if sector <= self.ends[i] else None
+
+    def to_dict(self) -> dict[str, dict[str, int]]:
+        """
+        return: QT.partition_list使用的格式{'name': {'start': start, 'size': size}, ...}
+        """
+        return {self.names[i]: {'start': self.starts[i], 'size': self.ends[i] - self.starts[i] + 1} for i in range(len(self.names)) if self.names[i] and self._index[self.names[i]] == i}
+
+
+def parse(entries: bytes | memoryview, header: bytes | memoryview) -> PartitionTable:
+    """
+    header: 第1扇区的内容
+    entries: 分区项数组的内容
+    """
+    return PartitionTable(parse_header(header), entries)
+
+
+class PartitionTableCache:
+    """
+    把分区表保存在本地, 下次只需读取1个扇区的GPT头即可确认分区表没有变化
+    以GPT头中的磁盘GUID区分设备, 每台设备一个文件; GPT头(含头CRC和分区项数组CRC)完全一致才使用缓存
+    """
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def _path(self, header: Header) -> str:
+        return os.path.join(self.directory, f'{header.disk_guid}.gpt')
+
+    def load(self, header: bytes | memoryview) -> PartitionTable | None:
+        """
+        header: 刚从设备读取的第1扇区
+        return: 缓存的分区表, 没有缓存或分区表已变化时为None
+        """
+        parsed = parse_header(header)
+        try:
+            with open(self._path(parsed), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if data[:parsed.header_size] != bytes(header[:parsed.header_size]):
+            return None
+        try:
+            return PartitionTable(parsed, memoryview(data)[parsed.header_size:])
+        except GPTError:
+            return None
+
+    def store(self, table: PartitionTable, header: bytes | memoryview, entries: bytes | memoryview) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(table.header)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(header[:table.header.header_size])
+            f.write(entries[:table.header.entries_bytes])
+        os.replace(f'{path}.tmp', path)
@@ -1,8 +1,19 @@
 from enum import Enum
+import atexit
+from contextvars import ContextVar, Token
+from collections import deque
+import functools
+import gzip
 import inspect
+import itertools
+import json
 import os
+import shutil
+import queue
+import sys
+import threading
 import time
-from typing import Any, Callable
+from typing import Any, Callable, NamedTuple
 
 class level(Enum):
     debug = 10
@@ -10,61 +21,498 @@ class level(Enum):
     warning = 30
     error = 40
 
+class _Record(NamedTuple):
+    created: float
+    level: level
+    stack: tuple[tuple[str, str | int], ...]
+    msg: str
+    step: str | None = None
+    serial: str | None = None
+    duration: float | None = None
+
+def _capture_stack() -> tuple[tuple[str, str | int], ...]:
+    """
+    沿f_back向上收集调用链(跳过本模块内的帧), 不读取源码, 代价远小于inspect.stack()
+    return: 从最外层到最内层的(文件名, 函数名或行号)
+    """
+    frames: list[tuple[str, str | int]] = []
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename != __file__:
+            frames.append((code.co_filename, frame.f_lineno if code.co_name == '<module>' else code.co_name))
+        frame = frame.f_back
+    frames.reverse()
+    return tuple(frames)
+
+class _Span:
+    __slots__ = ('name', 'start', 'end', 'failed', 'children')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: float | None = None
+        self.failed = False
+        self.children: list[_Span] = []
+
+    @property
+    def duration(self) -> float | None:
+        return None if self.end is None else self.end - self.start
+
+class _TextSink:
+    """
+    原有的GBK文本日志格式
+    """
+    def __init__(self, filename: str) -> None:
+        self.file = open(filename, 'ab')
+
+    def write(self, record: _Record) -> None:
+        stack_str = ''.join(f"[{os.path.basename(filename).replace('.py', '')}/{name}]" for filename, name in record.stack)
+        write = f'[{time.strftime("%Y_%m_%d_%H-%M-%S", time.localtime(record.created))}][{record.level.name.upper()}]{stack_str}{record.msg}\n'
+        try:
+            self.file.write(write.encode('gbk'))
+        except UnicodeEncodeError:
+            self.file.write(write.encode())
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+def _process_alive(pid: int) -> bool:
+    """
+    进程是否还在运行; Windows上总是返回False, 其他进程正在写入的文件无法改名, 由改名失败跳过
+    """
+    if sys.platform == 'win32':
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JSONLSink:
+    """
+    每行一条JSON的日志, 按大小切分, 切下的分段在后台线程中压缩为.gz
+    字段: ts, session, serial, step, level, duration, caller, msg
+    """
+    _segments = itertools.count(1)
+    """
+    分段序号, 同一进程中的所有JSONLSink共用, 先后创建的Logger切下的分段不会重名
+    """
+
+    def __init__(self, filename: str, session: str, *, max_bytes: int = 8 * 1024 * 1024, backup_count: int = 50) -> None:
+        """
+        filename: 日志文件位置(例如logs/xtceasyrootplus.jsonl), 每个进程实际写入{去掉.jsonl}.{进程号}.jsonl, 同时运行多个进程时互不影响
+        session: 本次会话的标识
+        max_bytes: 单个分段的最大大小
+        backup_count: 最多保留的压缩分段数量, 超出后删除最旧的
+        """
+        self.session = session
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._root = filename[:-6] if filename.endswith('.jsonl') else filename
+        self.filename = f'{self._root}.{os.getpid()}.jsonl'
+        self._compressors: list[threading.Thread] = []
+        self.file = open(self.filename, 'ab')
+        self.size = self.file.tell()
+        directory = os.path.dirname(self.filename) or '.'
+        prefix = os.path.basename(self._root) + '.'
+        for i in sorted(os.listdir(directory)):
+            if not i.startswith(prefix) or not i.endswith('.jsonl'):
+                continue
+            path = os.path.join(directory, i)
+            middle = i[len(prefix):-6]
+            if middle.count('.') == 2:
+                # 上次退出时还没压缩完的分段({时间}.{进程号}.{序号})
+                self._compress_in_background(path)
+            elif middle.isdigit() and int(middle) != os.getpid() and not _process_alive(int(middle)):
+                # 崩溃或被结束的进程留下的文件({进程号}), 改名为分段后压缩; 正在运行的进程的文件不处理
+                try:
+                    segment = self._segment_name(os.path.getmtime(path))
+                    os.replace(path, segment)
+                except OSError:
+                    continue
+                self._compress_in_background(segment)
+
+    def write(self, record: _Record) -> None:
+        caller = record.stack[-1] if record.stack else None
+        line = json.dumps({
+            'ts': round(record.created, 3),
+            'session': self.session,
+            'serial': record.serial,
+            'step': record.step,
+            'level': record.level.name,
+            'duration': None if record.duration is None else round(record.duration, 3),
+            'caller': None if caller is None else f"{os.path.basename(caller[0]).replace('.py', '')}/{caller[1]}",
+            'msg': record.msg
+        }, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+        if self.size > 0 and self.size + len(line) > self.max_bytes:
+            self.rotate()
+        self.file.write(line)
+        self.size += len(line)
+
+    def rotate(self) -> None:
+        self.file.close()
+        self._compress_in_background(self._cut())
+        self.file = open(self.filename, 'ab')
+        self.size = 0
+
+    def _cut(self) -> str:
+        """
+        把当前文件改名为一个分段
+        return: 分段的文件位置
+        """
+        segment = self._segment_name(time.time())
+        os.replace(self.filename, segment)
+        return segment
+
+    def _segment_name(self, created: float) -> str:
+        return f'{self._root}.{time.strftime("%Y%m%d-%H%M%S", time.localtime(created))}.{os.getpid()}.{next(JSONLSink._segments):04d}.jsonl'
+
+    def _compress_in_background(self, segment: str) -> None:
+        thread = threading.Thread(target=self._compress, args=(segment,), name='LoggerCompressor', daemon=True)
+        thread.start()
+        self._compressors = [i for i in self._compressors if i.is_alive()] + [thread]
+
+    def _compress(self, segment: str) -> None:
+        # 先改名认领, 多个进程同时处理同一个遗留分段时只有一个会成功
+        claimed = f'{segment}.{os.getpid()}'
+        try:
+            os.replace(segment, claimed)
+        except OSError:
+            return
+        try:
+            with open(claimed, 'rb') as src, gzip.open(claimed + '.gz.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(claimed + '.gz.tmp', segment + '.gz')
+            os.remove(claimed)
+        except OSError:
+            return
+        self._prune()
+
+    def _prune(self) -> None:
+        directory = os.path.dirname(self.filename) or '.'
+        prefix = os.path.basename(self._root) + '.'
+        segments = sorted(i for i in os.listdir(directory) if i.startswith(prefix) and i.endswith('.jsonl.gz'))
+        for i in segments[:max(len(segments) - self.backup_count, 0)]:
+            try:
+                os.remove(os.path.join(directory, i))
+            except OSError:
+                pass
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        """
+        关闭文件, 写入过内容的文件作为最后一个分段压缩(可能在退出时调用, 不能再启动线程)
+        """
+        self.file.close()
+        for i in self._compressors:
+            i.join()
+        if self.size > 0:
+            self._compress(self._cut())
+        else:
+            os.remove(self.filename)
+
+_span_stack: ContextVar[tuple[_Span, ...]] = ContextVar('span_stack', default=())
+"""
+当前所在的span, 用ContextVar保存, 使每个线程与每个asyncio任务各自独立
+"""
+
+_device: ContextVar[str | None] = ContextVar('device', default=None)
+"""
+当前线程或asyncio任务正在操作的设备序列号, 同时操作多台设备时用来区分日志
+"""
+
+_open_loggers: set['Logger'] = set()
+"""
+有文件需要在退出时关闭的Logger, 由_close_loggers统一关闭(atexit在每个进程只注册一次)
+"""
+
+def _close_loggers() -> None:
+    for i in list(_open_loggers):
+        i.close()
+
+atexit.register(_close_loggers)
+
 class Logger:
-    def __init__(self, filename: str | None = None, *, print: Callable[[Any], Any] = print, level: level = level.warning) -> None:
+    def __init__(self, filename: str | None = None, *, print: Callable[[Any], Any] = print, level: level = level.warning, file_level: level | None = None, queue_size: int = 10000, flush_interval: int | float = 0.5, max_message_length: int = 65536, spill_dir: str | None = None, timing_filename: str | None = None, jsonl_filename: str | None = None, session: str | None = None, ring_size: int = 0, ring_filename: str | None = None, ring_message_length: int = 4096) -> None:
         """
         filename: 写入日志文件的位置, 留空则不写入
         print: 用于打印日志的函数, 留空则使用默认的print来打印日志
         level: 日志等级, 默认为WARNING
+        file_level: 写入文件的日志等级, 留空则与level相同
+        queue_size: 写入队列的最大长度, 队列满时丢弃新日志而不阻塞调用者
+        flush_interval: 后台线程刷新文件缓冲的间隔(秒)
+        max_message_length: 单条日志的最大长度, 超出部分会被截断
+        spill_dir: 超长日志的完整内容写入的文件夹, 留空则直接截断
+        timing_filename: 写入各步骤耗时树的文件位置, 留空则不写入
+        jsonl_filename: 写入JSONL格式日志的文件位置, 留空则不写入
+        session: 本次会话的标识, 留空则使用启动时间与进程号
+        ring_size: 在内存中保留最近多少条日志(不论等级), 出错时写入ring_filename, 为0则不保留
+        ring_filename: 出错时写入最近日志的文件位置
+        ring_message_length: 内存中每条日志写出时的最大长度
         """
         self.filename = filename
         self.print = print
         self.log_level = level
-
-    def _write_file(self, level: level, msg: Any):
+        self.file_level = level if file_level is None else file_level
+        self.flush_interval = flush_interval
+        self.max_message_length = max_message_length
+        self.spill_dir = spill_dir
+        self.timing_filename = timing_filename
+        self.session = f'{time.strftime("%Y%m%d-%H%M%S", time.localtime())}-{os.getpid()}' if session is None else session
+        self.context: dict[str, Any] = {}
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._spill_count = 0
+        self._queue: queue.Queue[_Record | None] = queue.Queue(maxsize=queue_size)
+        self._writer: threading.Thread | None = None
+        self._started = time.perf_counter()
+        self._spans: list[_Span] = []
+        self._spans_lock = threading.Lock()
+        self.ring_filename = ring_filename
+        self.ring_message_length = ring_message_length
+        self._ring: deque[tuple[float, level, str | None, tuple[Any, ...]]] | None = deque(maxlen=ring_size) if ring_size > 0 else None
+        self._sinks: list[_TextSink | JSONLSink] = []
         if not self.filename is None:
-            stack = inspect.stack()
-            stack.reverse()
-            stack_str: str = ''
-            for i in stack[:-3]:
-                stack_str += f'[{os.path.basename(i[1]).replace('.py', '')}/{i[2] if i[3] == '<module>' else i[3]}]'
-            with open(self.filename, 'ab') as f:
-                write = f'[{time.strftime("%Y_%m_%d_%H-%M-%S", time.localtime())}][{level.name.upper()}]{stack_str}{msg}\n'
+            self._sinks.append(_TextSink(self.filename))
+        if not jsonl_filename is None:
+            self._sinks.append(JSONLSink(jsonl_filename, self.session))
+        if self._sinks or not self.timing_filename is None:
+            _open_loggers.add(self)
+        if self._sinks:
+            self._writer = threading.Thread(target=self._writer_loop, name='LoggerWriter', daemon=True)
+            self._writer.start()
+
+    def _writer_loop(self) -> None:
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush()
+                last_flush = time.monotonic()
+                continue
+            if record is None:
+                break
+            self._write_record(record)
+            # 尽量一次取完队列中已有的日志, 合并为一次flush
+            stop = False
+            while True:
                 try:
-                    bwrite = write.encode('gbk')
-                except UnicodeEncodeError:
-                    bwrite = write.encode()
-                f.write(bwrite)
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                self._write_record(record)
+            if stop:
+                break
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = time.monotonic()
+        for i in self._sinks:
+            i.close()
 
-    def _print_log(self, level: level, *args: Any):
-        if len(args) == 1:
-            args = args[0]
+    def _flush(self) -> None:
+        for i in self._sinks:
+            i.flush()
+
+    def _write_record(self, record: _Record) -> None:
+        if self.dropped:
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            for i in self._sinks:
+                i.write(_Record(record.created, level.warning, (), f'日志队列已满, 丢弃了{dropped}条日志'))
+        if len(record.msg) > self.max_message_length:
+            record = record._replace(msg=self._spill(record.msg))
+        for i in self._sinks:
+            i.write(record)
+
+    def _truncate(self, msg: str) -> str:
+        return f'{msg[:self.max_message_length]}...(省略{len(msg) - self.max_message_length}字符)'
+
+    def _spill(self, msg: str) -> str:
+        """
+        将超长日志完整写入spill_dir下的单独文件, 日志文件中只保留开头部分
+        """
+        if self.spill_dir is None:
+            return self._truncate(msg)
+        self._spill_count += 1
+        path = os.path.join(self.spill_dir, f'{self._spill_count}.txt')
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(msg)
+        except OSError:
+            return self._truncate(msg)
+        return f'{self._truncate(msg)}(完整内容见{path})'
+
+    def _write_file(self, level: level, msg: str, step: str | None = None, duration: float | None = None):
+        if not self._writer is None:
+            if step is None:
+                stack = _span_stack.get()
+                step = stack[-1].name if stack else None
+            try:
+                self._queue.put_nowait(_Record(time.time(), level, _capture_stack(), msg, step, _device.get() or self.context.get('serial'), duration))
+            except queue.Full:
+                with self._dropped_lock:
+                    self.dropped += 1
+
+    def close(self) -> None:
+        """
+        写入队列中剩余的日志并关闭文件
+        """
+        _open_loggers.discard(self)
+        if not self._writer is None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._writer = None
+        self.write_timing()
+
+    def dump_ring(self, reason: str = '') -> str | None:
+        """
+        将内存中最近的日志写入ring_filename并清空
+        reason: 写在这一段开头的原因
+        return: 写入的文件位置, 未启用则为None
+        """
+        if self._ring is None or self.ring_filename is None:
+            return None
+        records = list(self._ring)
+        self._ring.clear()
+        with open(self.ring_filename, 'a', encoding='utf-8') as f:
+            f.write(f'===== {time.strftime("%Y_%m_%d_%H-%M-%S", time.localtime())} {reason} 最近{len(records)}条日志 =====\n')
+            for created, record_level, step, args in records:
+                try:
+                    msg = self._format_args(args)[1]
+                except Exception as e:
+                    msg = f'<无法格式化: {e!r}>'
+                if len(msg) > self.ring_message_length:
+                    msg = f'{msg[:self.ring_message_length]}...(省略{len(msg) - self.ring_message_length}字符)'
+                f.write(f'[{time.strftime("%H-%M-%S", time.localtime(created))}.{int(created % 1 * 1000):03d}][{record_level.name.upper()}]{"" if step is None else f"[{step}]"}{msg}\n')
+        return self.ring_filename
+
+    def enter_span(self, name: str) -> _Span:
+        node = _Span(name)
+        stack = _span_stack.get()
+        with self._spans_lock:
+            if stack:
+                stack[-1].children.append(node)
+            else:
+                self._spans.append(node)
+        _span_stack.set(stack + (node,))
+        return node
+
+    def exit_span(self, node: _Span, failed: bool = False) -> None:
+        node.end = time.perf_counter()
+        node.failed = failed
+        stack = _span_stack.get()
+        if node in stack:
+            _span_stack.set(stack[:stack.index(node)])
+        self.log(level.debug, '%s%s, 耗时%.3fs', node.name, '失败' if failed else '完成', node.duration, step=node.name, duration=node.duration)
+
+    def format_timing(self) -> str:
+        """
+        return: 文本形式的耗时树, 每行为 名称 开始时间(相对于会话开始) 耗时
+        """
+        lines: list[str] = []
+        if self.context:
+            lines.append('# ' + ' '.join(f'{k}={v}' for k, v in self.context.items()))
+
+        def walk(nodes: list[_Span], depth: int) -> None:
+            for node in nodes:
+                duration = node.duration
+                lines.append(f"{'  ' * depth}{node.name}  +{node.start - self._started:.3f}s  {'未结束' if duration is None else f'{duration:.3f}s'}{'  失败' if node.failed else ''}")
+                walk(node.children, depth + 1)
+
+        with self._spans_lock:
+            walk(self._spans, 0)
+        return '\n'.join(lines) + '\n'
+
+    def write_timing(self) -> None:
+        if not self.timing_filename is None and self._spans:
+            with open(self.timing_filename, 'w', encoding='utf-8') as f:
+                f.write(self.format_timing())
+
+    def is_enabled(self, level: level) -> bool:
+        """
+        是否有输出(打印或文件)需要该等级的日志
+        """
+        return level.value >= self.log_level.value or (not self._writer is None and level.value >= self.file_level.value)
+
+    def log(self, level: level, *args: Any, step: str | None = None, duration: float | None = None):
+        """
+        记录一条日志, 只有在该等级会被输出时才格式化
+        args: 单个对象; 单个无参可调用对象(延迟求值); 或 %-格式字符串加参数
+        step: 所属步骤, 留空则使用当前span
+        duration: 该步骤的耗时(秒)
+        """
+        if not self._ring is None:
+            # 只保存参数, 真正出错需要写出时才格式化
+            if step is None:
+                stack = _span_stack.get()
+                step = stack[-1].name if stack else None
+            self._ring.append((time.time(), level, step, tuple(self._ring_arg(i) for i in args)))
+        if not self.is_enabled(level):
+            return
+        obj, msg = self._format_args(args)
+        serial = _device.get()
+        if not serial is None:
+            msg = f'({serial}) {msg}'
+            obj = msg
         if level.value >= self.log_level.value:
-            self.print(args)
+            if len(msg) > self.max_message_length:
+                self.print(self._truncate(msg))
+            else:
+                self.print(obj)
+        if not self._writer is None and level.value >= self.file_level.value:
+            self._write_file(level, msg, step, duration)
+        if level.name == 'error' and not self._ring is None:
+            self.dump_ring(msg.splitlines()[0] if msg else '')
 
-    def debug(self, *args: Any):
+    def _ring_arg(self, arg: Any) -> Any:
+        """
+        截断要放入内存的参数中过长的字符串(包括元组里的), 避免占用过多内存
+        """
+        if isinstance(arg, (str, bytes)):
+            return arg[:self.ring_message_length] if len(arg) > self.ring_message_length else arg
+        if isinstance(arg, tuple):
+            try:
+                return type(arg)(self._ring_arg(i) for i in arg)
+            except TypeError:
+                return arg
+        return arg
+
+    @staticmethod
+    def _format_args(args: tuple[Any, ...]) -> tuple[Any, str]:
         if len(args) == 1:
-            args = args[0]
-        self._print_log(level.debug, args)
-        self._write_file(level.debug, args)
+            obj = args[0]
+            if callable(obj):
+                obj = obj()
+        elif len(args) > 1 and type(args[0]) == str:
+            obj = args[0] % args[1:]
+        else:
+            obj = args
+        return obj, obj if type(obj) == str else str(obj)
+
+    def debug(self, *args: Any):
+        self.log(level.debug, *args)
 
     def info(self, *args: Any):
-        if len(args) == 1:
-            args = args[0]
-        self._print_log(level.info, args)
-        self._write_file(level.info, args)
-        
+        self.log(level.info, *args)
+
     def warning(self, *args: Any):
-        if len(args) == 1:
-            args = args[0]
-        self._print_log(level.warning, args)
-        self._write_file(level.warning, args)
-    
+        self.log(level.warning, *args)
+
     def error(self, *args: Any):
-        if len(args) == 1:
-            args = args[0]
-        self._print_log(level.error, args)
-        self._write_file(level.error, args)
+        self.log(level.error, *args)
 
 logger = None
 
@@ -72,48 +520,124 @@ class NeedConfigFirst(Exception):
     def __init__(self) -> None:
         super().__init__('You must use set_config() or set_logger_class() to initialize first!')
 
+class span:
+    """
+    记录一个步骤的开始、结束与耗时, 嵌套使用时形成耗时树
+    可用作上下文管理器(with logging.span('读取boot分区'):)或装饰器(@logging.span('读取分区{name}')),
+    用作装饰器时名称中的{参数名}会被替换为调用时的参数
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._local = threading.local()
+
+    def __enter__(self) -> 'span':
+        if logger is None:
+            raise NeedConfigFirst
+        self._local.__dict__.setdefault('nodes', []).append(logger.enter_span(self.name))
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        node = self._local.nodes.pop()
+        if not logger is None:
+            logger.exit_span(node, failed=not exc_type is None)
+
+    def __call__(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        name = self.name
+        signature = inspect.signature(func) if '{' in name else None
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if signature is None:
+                step = name
+            else:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                step = name.format(**bound.arguments)
+            with span(step):
+                return func(*args, **kwargs)
+        return wrapper
+
+class device:
+    """
+    with块内(同一线程或asyncio任务)产生的日志都标记为该设备: 消息前加上(序列号), JSONL中的serial字段为该序列号
+    """
+    def __init__(self, serial: str) -> None:
+        self.serial = serial
+        self._tokens: list[Token[str | None]] = []
+
+    def __enter__(self) -> 'device':
+        self._tokens.append(_device.set(self.serial))
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        _device.reset(self._tokens.pop())
+
+def set_context(**kwargs: Any) -> None:
+    """
+    设置本次会话的附加信息(如机型), 会写入耗时树的开头
+    """
+    if not logger is None:
+        logger.context.update(kwargs)
+    else:
+        raise NeedConfigFirst
+
+def dump_ring(reason: str = '') -> str | None:
+    if not logger is None:
+        return logger.dump_ring(reason)
+    else:
+        raise NeedConfigFirst
+
+def is_enabled(level: level) -> bool:
+    if not logger is None:
+        return logger.is_enabled(level)
+    else:
+        raise NeedConfigFirst
+
 def debug(*args: Any):
-    if len(args) == 1:
-        args = args[0]
     if not logger is None:
-        logger.debug(args)
+        logger.debug(*args)
     else:
         raise NeedConfigFirst
 
 def info(*args: Any):
-    if len(args) == 1:
-        args = args[0]
     if not logger is None:
-        logger.info(args)
+        logger.info(*args)
     else:
         raise NeedConfigFirst
 
 def warning(*args: Any):
-    if len(args) == 1:
-        args = args[0]
     if not logger is None:
-        logger.warning(args)
+        logger.warning(*args)
     else:
         raise NeedConfigFirst
 
 def error(*args: Any):
-    if len(args) == 1:
-        args = args[0]
     if not logger is None:
-        logger.error(args)
+        logger.error(*args)
     else:
         raise NeedConfigFirst
 
-def set_config(filename: str | None = None, *, print: Callable[[Any], Any] = print, level: level = level.warning):
+def set_config(filename: str | None = None, *, print: Callable[[Any], Any] = print, level: level = level.warning, file_level: level | None = None, max_message_length: int = 65536, spill_dir: str | None = None, timing_filename: str | None = None, jsonl_filename: str | None = None, ring_size: int = 0, ring_filename: str | None = None):
     """
     设置(or初始化)Logger
     filename: 写入日志文件的位置, 留空则不写入
     print: 用于打印日志的函数, 留空则使用默认的print来打印日志
     level: 日志等级, 默认为WARNING
+    file_level: 写入文件的日志等级, 留空则与level相同
+    max_message_length: 单条日志的最大长度, 超出部分会被截断
+    spill_dir: 超长日志的完整内容写入的文件夹, 留空则直接截断
+    timing_filename: 写入各步骤耗时树的文件位置, 留空则不写入
+    jsonl_filename: 写入JSONL格式日志的文件位置(按大小切分并压缩), 留空则不写入
+    ring_size: 在内存中保留最近多少条日志(不论等级), 出错时写入ring_filename, 为0则不保留
+    ring_filename: 出错时写入最近日志的文件位置
     """
     global logger
-    logger = Logger(filename=filename, print=print, level=level)
+    if not logger is None:
+        logger.close()
+    logger = Logger(filename=filename, print=print, level=level, file_level=file_level, max_message_length=max_message_length, spill_dir=spill_dir, timing_filename=timing_filename, jsonl_filename=jsonl_filename, ring_size=ring_size, ring_filename=ring_filename)
 
 def set_logger_class(klass: Logger):
     global logger
-    logger = klass
\ No newline at end of file
+    if not logger is None and not logger is klass:
+        logger.close()
+    logger = klass
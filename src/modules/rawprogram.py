@@ -0,0 +1,202 @@
+"""
+rawprogram/patch XML的内存模型
+可以解析已有的rawprogram*.xml和patch*.xml, 合并成一个刷写计划, 去掉空的program, 把磁盘和文件中都连续的program合并成一次传输, 再生成一个XML交给fh_loader或内置Firehose客户端
+"""
+import os
+import xml.etree.ElementTree as ET
+from typing import NamedTuple
+from xml.sax.saxutils import quoteattr
+from modules import sparse
+
+
+class RawprogramError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class Program(NamedTuple):
+    """
+    一条program(写入)或read(读取)
+    """
+    filename: str
+    start_sector: str
+    """
+    起始扇区, 可能是NUM_DISKSECTORS-33.这样的写法
+    """
+    num_partition_sectors: int
+    """
+    扇区数, 0表示按文件大小(Plan.load找到文件时会换算为实际的扇区数)
+    """
+    physical_partition_number: int = 0
+    file_sector_offset: int = 0
+    sector_size: int = 512
+    label: str = ''
+    sparse: bool = False
+    read: bool = False
+    """
+    为True时生成<read>
+    """
+    attributes: dict[str, str] = {}
+    """
+    XML中的原始属性, 生成XML时原样保留没有建模的属性
+    """
+
+    @property
+    def start(self) -> int | None:
+        """
+        数字形式的起始扇区, 相对于NUM_DISKSECTORS的为None
+        """
+        value = self.start_sector.rstrip('.')
+        return int(value) if value.isdigit() else None
+
+    def follows(self, other: 'Program') -> bool:
+        """
+        是否紧接在other之后(存储上和文件中都连续), 可以与other合并为一次传输
+        """
+        return (self.filename == other.filename and self.read == other.read and not self.sparse and not other.sparse
+                and self.physical_partition_number == other.physical_partition_number and self.sector_size == other.sector_size
+                and not self.start is None and not other.start is None
+                and self.start == other.start + other.num_partition_sectors
+                and self.file_sector_offset == other.file_sector_offset + other.num_partition_sectors)
+
+    def to_xml(self) -> str:
+        start = self.start
+        attributes: dict[str, object] = dict(self.attributes)
+        attributes.update({
+            'SECTOR_SIZE_IN_BYTES': self.sector_size,
+            'file_sector_offset': self.file_sector_offset,
+            'filename': self.filename,
+            'label': self.label,
+            'num_partition_sectors': self.num_partition_sectors,
+            'physical_partition_number': self.physical_partition_number,
+            'size_in_KB': f'{self.num_partition_sectors * self.sector_size / 1024:.1f}',
+            'sparse': 'true' if self.sparse else 'false',
+            'start_sector': self.start_sector,
+        })
+        if not start is None:
+            attributes['start_byte_hex'] = f'{start * self.sector_size:#x}'
+        return f'<{"read" if self.read else "program"} ' + ' '.join(f'{k}={quoteattr(str(v))}' for k, v in attributes.items()) + ' />'
+
+
+class Patch(NamedTuple):
+    """
+    一条patch, 属性原样保留
+    """
+    attributes: dict[str, str]
+
+    def to_xml(self) -> str:
+        return '<patch ' + ' '.join(f'{k}={quoteattr(v)}' for k, v in self.attributes.items()) + ' />'
+
+
+class Plan:
+    """
+    刷写计划: 先执行全部program/read, 再执行全部patch(与QFIL一致, patch修改的是刚写入的GPT)
+    """
+    def __init__(self) -> None:
+        self.programs: list[Program] = []
+        self.patches: list[Patch] = []
+
+    def add_partition(self, name: str, start: int, size: int, filename: str | None = None, read: bool = False, sparse: bool = False) -> None:
+        """
+        添加整个分区的读写
+        size: 扇区数
+        filename: 镜像文件名, 留空则为{name}.img
+        sparse: 镜像是否为Android sparse格式
+        """
+        self.programs.append(Program(f'{name}.img' if filename is None else filename, str(start), size, label=name, sparse=sparse, read=read))
+
+    def load(self, filename: str, search_paths: list[str] = []) -> None:
+        """
+        加入一个rawprogram或patch XML中的全部命令
+        search_paths: 查找镜像文件的文件夹, XML所在文件夹总是最后查找; 用于换算num_partition_sectors为0(按文件大小)的program
+        """
+        try:
+            root = ET.parse(filename).getroot()
+        except (ET.ParseError, OSError) as e:
+            raise RawprogramError(f'无法读取{filename}: {e}')
+        for i in root:
+            if i.tag in ('program', 'read'):
+                try:
+                    program = Program(
+                        i.get('filename', ''), i.get('start_sector', '0'), int(i.get('num_partition_sectors', '0')),
+                        int(i.get('physical_partition_number', '0')), int(i.get('file_sector_offset', '0')), int(i.get('SECTOR_SIZE_IN_BYTES', '512')),
+                        i.get('label', ''), i.get('sparse', 'false').lower() == 'true', i.tag == 'read', dict(i.attrib))
+                except ValueError as e:
+                    raise RawprogramError(f'{filename}中的{i.tag}有错误: {e}')
+                if program.num_partition_sectors == 0 and program.filename != '' and not program.read:
+                    program = _resolve_size(program, search_paths + [os.path.dirname(filename)])
+                self.programs.append(program)
+            elif i.tag == 'patch':
+                self.patches.append(Patch(dict(i.attrib)))
+
+    def optimize(self) -> None:
+        """
+        去掉filename为空的program和不是写入DISK的patch(fh_loader也会跳过), 按起始扇区排序并合并连续的program
+        有相互重叠的program时保持原顺序, 只合并相邻的
+        """
+        programs = [i for i in self.programs if i.filename != '']
+        self.patches = [i for i in self.patches if i.attributes.get('filename') == 'DISK']
+        numbered = [i for i in programs if not i.start is None]
+        if not _overlaps(numbered):
+            programs = sorted(numbered, key=lambda i: (i.physical_partition_number, i.start)) + [i for i in programs if i.start is None]
+        merged: list[Program] = []
+        for i in programs:
+            if merged and i.follows(merged[-1]):
+                merged[-1] = merged[-1]._replace(num_partition_sectors=merged[-1].num_partition_sectors + i.num_partition_sectors)
+            else:
+                merged.append(i)
+        self.programs = merged
+
+    def filenames(self) -> list[str]:
+        return list(dict.fromkeys(i.filename for i in self.programs))
+
+    def to_xml(self) -> str:
+        return '<?xml version="1.0" ?>\n<data>\n' + ''.join(f'  {i.to_xml()}\n' for i in [*self.programs, *self.patches]) + '</data>\n'
+
+    def write(self, filename: str) -> None:
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(self.to_xml())
+
+
+def _resolve_size(program: Program, search_paths: list[str]) -> Program:
+    """
+    把num_partition_sectors为0的program换算为文件的实际扇区数, 找不到文件时原样返回(由调用者报告缺少的文件)
+    """
+    for i in search_paths:
+        path = os.path.join(i, program.filename)
+        if os.path.isfile(path):
+            try:
+                size = sparse.expanded_size(path) if program.sparse else os.path.getsize(path) - program.file_sector_offset * program.sector_size
+            except sparse.SparseError as e:
+                raise RawprogramError(f'{program.filename}: {e}')
+            return program._replace(num_partition_sectors=max(-(-size // program.sector_size), 0))
+    return program
+
+
+def _overlaps(programs: list[Program]) -> bool:
+    ordered = sorted(programs, key=lambda i: (i.physical_partition_number, i.start))
+    for a, b in zip(ordered, ordered[1:]):
+        if a.physical_partition_number == b.physical_partition_number and a.start + a.num_partition_sectors > b.start:  # type: ignore
+            return True
+    return False
+
+
+def load(filenames: list[str], optimize: bool = True, search_paths: list[str] = []) -> Plan:
+    """
+    把多个rawprogram/patch XML合并为一个刷写计划
+    search_paths: 见Plan.load
+    """
+    plan = Plan()
+    for i in filenames:
+        plan.load(i, search_paths)
+    if optimize:
+        plan.optimize()
+    return plan
+
+
+def is_rawprogram(filename: str) -> bool:
+    """
+    是否是超级恢复包中的rawprogram*.xml或patch*.xml
+    """
+    name = os.path.basename(filename)
+    return name.endswith('.xml') and (name.startswith('rawprogram') or name.startswith('patch'))
@@ -0,0 +1,194 @@
+"""
+Sahara协议客户端, 通过串口把引导程序(prog*.mbn)发送给9008模式的设备, 代替QSaharaServer.exe
+所有数值为小端序, 每个包以(命令, 包长度)开头
+"""
+import mmap
+import os
+import struct
+import time
+from typing import Protocol
+import serial
+from modules import logging
+
+
+class SaharaError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class SaharaTimeout(SaharaError):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+HELLO = 0x01
+HELLO_RESP = 0x02
+READ_DATA = 0x03
+END_IMAGE_TX = 0x04
+DONE = 0x05
+DONE_RESP = 0x06
+RESET = 0x07
+RESET_RESP = 0x08
+READ_DATA_64 = 0x12
+RESET_STATE_MACHINE = 0x13
+"""
+让设备回到初始状态并重新发送HELLO
+"""
+
+MODE_IMAGE_TX_PENDING = 0x0
+
+PROGRAMMER_IMAGE_ID = 13
+"""
+与QSaharaServer的-s 13:<mbn>对应
+"""
+
+_HEADER = struct.Struct('<II')
+_HELLO = struct.Struct('<IIII')
+_READ_DATA = struct.Struct('<III')
+_READ_DATA_64 = struct.Struct('<QQQ')
+_END_IMAGE_TX = struct.Struct('<II')
+
+
+class SerialLike(Protocol):
+    def read(self, size: int = 1) -> bytes: ...
+    def write(self, data: bytes | memoryview) -> int | None: ...
+
+
+class Image:
+    """
+    以只读mmap打开的镜像, 用完需要close(Windows上打开期间文件无法被替换)
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self._mmap)
+
+    def close(self) -> None:
+        self.view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> 'Image':
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+def _unpack(layout: struct.Struct, command: int, body: bytes) -> tuple:
+    if len(body) < layout.size:
+        raise SaharaError(f'命令{command:#x}的包太短: {len(body)}字节, 至少需要{layout.size}字节')
+    return layout.unpack_from(body)
+
+
+class SaharaClient:
+    def __init__(self, port: SerialLike) -> None:
+        """
+        port: 已打开的串口(或任何有read/write的对象), read需要设置超时
+        """
+        self.port = port
+
+    def _read_exactly(self, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.port.read(size - len(data))
+            if not chunk:
+                raise SaharaTimeout(f'等待设备回复超时(已收到{len(data)}/{size}字节)')
+            data += chunk
+        return bytes(data)
+
+    def read_packet(self) -> tuple[int, bytes]:
+        """
+        return: 命令, 包头之后的内容
+        """
+        command, length = _HEADER.unpack(self._read_exactly(_HEADER.size))
+        if length < _HEADER.size:
+            raise SaharaError(f'包长度错误: 命令{command:#x}, 长度{length}')
+        return command, self._read_exactly(length - _HEADER.size)
+
+    def send_packet(self, command: int, body: bytes = b'') -> None:
+        self.port.write(_HEADER.pack(command, _HEADER.size + len(body)) + body)
+
+    def hello(self, retries: int = 2) -> tuple[int, int]:
+        """
+        完成握手
+        retries: 没有收到HELLO(例如打开端口前设备已经发出)时, 发送RESET_STATE_MACHINE让设备重发的次数
+        return: 设备的协议版本, 设备的模式
+        """
+        for i in range(retries + 1):
+            try:
+                command, body = self.read_packet()
+                break
+            except SaharaTimeout:
+                if i == retries:
+                    raise
+                logging.debug('没有收到Sahara HELLO, 请求设备重发')
+                self.send_packet(RESET_STATE_MACHINE)
+        if command != HELLO:
+            raise SaharaError(f'期望收到HELLO, 实际收到命令{command:#x}')
+        version, version_supported, max_packet, mode, *_ = _unpack(_HELLO, command, body)
+        logging.debug('Sahara HELLO: 版本%d(兼容%d), 最大包长度%d, 模式%d', version, version_supported, max_packet, mode)
+        self.send_packet(HELLO_RESP, struct.pack('<IIII', min(version, 2), 1, 0, MODE_IMAGE_TX_PENDING) + bytes(24))
+        return version, mode
+
+    def upload(self, image: Image, image_id: int = PROGRAMMER_IMAGE_ID) -> int:
+        """
+        响应设备的读取请求直到镜像传输结束, 然后发送DONE
+        return: 发送的总字节数
+        """
+        started = time.perf_counter()
+        self.hello()
+        sent = 0
+        while True:
+            command, body = self.read_packet()
+            if command == READ_DATA:
+                requested_id, offset, length = _unpack(_READ_DATA, command, body)
+            elif command == READ_DATA_64:
+                requested_id, offset, length = _unpack(_READ_DATA_64, command, body)
+            elif command == HELLO:
+                # 设备在收到HELLO_RESP之前重发的HELLO
+                continue
+            elif command == END_IMAGE_TX:
+                end_id, status = _unpack(_END_IMAGE_TX, command, body)
+                if status != 0:
+                    raise SaharaError(f'设备报告镜像{end_id}传输失败, 状态码{status:#x}')
+                break
+            else:
+                raise SaharaError(f'传输过程中收到未知命令{command:#x}')
+            if requested_id != image_id:
+                raise SaharaError(f'设备请求镜像{requested_id}, 但只提供了镜像{image_id}')
+            if offset + length > image.size:
+                raise SaharaError(f'设备请求的范围{offset}+{length}超出镜像大小{image.size}')
+            with image.view[offset:offset + length] as data:
+                self.port.write(data)
+            sent += length
+        self.send_packet(DONE)
+        command, body = self.read_packet()
+        if command != DONE_RESP:
+            raise SaharaError(f'期望收到DONE_RESP, 实际收到命令{command:#x}')
+        logging.debug('Sahara上传%s完成: %d字节, 耗时%.3f秒', image.path, sent, time.perf_counter() - started)
+        return sent
+
+
+def port_name(port: int | str) -> str:
+    """
+    port: COM端口号, 设备名或pyserial的URL(例如socket://127.0.0.1:40000)
+    """
+    return f'COM{port}' if type(port) == int else str(port)
+
+
+def upload_programmer(port: int | str, mbn: str, timeout: int | float = 5) -> int:
+    """
+    打开端口并上传引导程序, 相当于QSaharaServer -u <port> -s 13:<mbn>
+    port: COM端口号或设备名
+    timeout: 等待设备每次回复的超时时间(秒)
+    return: 发送的总字节数
+    """
+    with logging.span(f'Sahara上传{os.path.basename(mbn)}'):
+        try:
+            with Image(mbn) as image, serial.serial_for_url(port_name(port), 115200, timeout=timeout, write_timeout=timeout) as device:
+                return SaharaClient(device).upload(image)
+        except serial.SerialException as e:
+            raise SaharaError(f'无法打开{port_name(port)}: {e}')
@@ -0,0 +1,250 @@
+"""
+Android sparse镜像的读写
+镜像由文件头和若干chunk组成, chunk分为RAW(原始数据)、FILL(重复的4字节)、DONT_CARE(不写入)和CRC32; 所有数值为小端序
+"""
+import os
+import struct
+from typing import BinaryIO, Iterator, NamedTuple
+
+
+class SparseError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+MAGIC = 0xED26FF3A
+
+CHUNK_RAW = 0xCAC1
+CHUNK_FILL = 0xCAC2
+CHUNK_DONT_CARE = 0xCAC3
+CHUNK_CRC32 = 0xCAC4
+
+_HEADER = struct.Struct('<IHHHHIIII')
+_CHUNK = struct.Struct('<HHII')
+
+
+def block_size_for(size: int) -> int:
+    """
+    size: 镜像大小(字节)
+    return: 能整除size的块大小, 优先使用4096
+    """
+    return 4096 if size % 4096 == 0 else 512
+
+
+class SparseWriter:
+    """
+    以流的方式把原始数据写成sparse镜像, 每个块判断是否全0或重复的4字节
+    输出文件需要可以seek(写完一段RAW后回填chunk头, 关闭时回填文件头); 出错退出with时不回填文件头, 输出不是有效的sparse镜像
+    """
+    def __init__(self, file: BinaryIO, block_size: int = 4096, zeros_as_dont_care: bool = False) -> None:
+        """
+        zeros_as_dont_care: 全0的块记为DONT_CARE(还原时跳过, 目标位置保持原内容, 不适合备份); 默认记为FILL 0, 还原时写回0
+        """
+        if block_size % 4:
+            raise SparseError(f'块大小必须是4的倍数: {block_size}')
+        self.file = file
+        self.block_size = block_size
+        self.zeros_as_dont_care = zeros_as_dont_care
+        self.total_blocks = 0
+        self.total_chunks = 0
+        self.raw_blocks = 0
+        """
+        以RAW保存的块数
+        """
+        self._zero = bytes(block_size)
+        self._pending = bytearray()
+        self._run_type: int | None = None
+        self._run_blocks = 0
+        self._run_fill = b''
+        self._run_header = 0
+        self._start = file.tell()
+        file.write(bytes(_HEADER.size))
+
+    def _end_run(self) -> None:
+        if self._run_type is None:
+            return
+        if self._run_type == CHUNK_RAW:
+            end = self.file.tell()
+            self.file.seek(self._run_header)
+            self.file.write(_CHUNK.pack(CHUNK_RAW, 0, self._run_blocks, _CHUNK.size + self._run_blocks * self.block_size))
+            self.file.seek(end)
+        elif self._run_type == CHUNK_FILL:
+            self.file.write(_CHUNK.pack(CHUNK_FILL, 0, self._run_blocks, _CHUNK.size + 4) + self._run_fill)
+        else:
+            self.file.write(_CHUNK.pack(CHUNK_DONT_CARE, 0, self._run_blocks, _CHUNK.size))
+        self.total_chunks += 1
+        self._run_type = None
+        self._run_blocks = 0
+
+    def _add_block(self, block: bytes) -> None:
+        if block == self._zero and self.zeros_as_dont_care:
+            kind, fill = CHUNK_DONT_CARE, b''
+        elif block[4:] == block[:-4]:
+            kind, fill = CHUNK_FILL, block[:4]
+        else:
+            kind, fill = CHUNK_RAW, b''
+        if kind != self._run_type or fill != self._run_fill:
+            self._end_run()
+            self._run_type = kind
+            self._run_fill = fill
+            if kind == CHUNK_RAW:
+                self._run_header = self.file.tell()
+                self.file.write(bytes(_CHUNK.size))
+        if kind == CHUNK_RAW:
+            self.file.write(block)
+            self.raw_blocks += 1
+        self._run_blocks += 1
+        self.total_blocks += 1
+
+    def write(self, data: bytes | memoryview) -> int:
+        size = len(data)
+        with memoryview(data) as view:
+            offset = 0
+            if self._pending:
+                offset = min(size, self.block_size - len(self._pending))
+                self._pending += view[:offset]
+                if len(self._pending) < self.block_size:
+                    return size
+                self._add_block(bytes(self._pending))
+                self._pending.clear()
+            while size - offset >= self.block_size:
+                self._add_block(bytes(view[offset:offset + self.block_size]))
+                offset += self.block_size
+            self._pending += view[offset:]
+        return size
+
+    def close(self) -> None:
+        """
+        写入最后不足一块的数据(补0)并回填文件头; 不关闭file
+        """
+        if self._pending:
+            self._add_block(bytes(self._pending) + bytes(self.block_size - len(self._pending)))
+            self._pending.clear()
+        self._end_run()
+        end = self.file.tell()
+        self.file.seek(self._start)
+        self.file.write(_HEADER.pack(MAGIC, 1, 0, _HEADER.size, _CHUNK.size, self.block_size, self.total_blocks, self.total_chunks, 0))
+        self.file.seek(end)
+
+    def __enter__(self) -> 'SparseWriter':
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *args: object) -> None:
+        if exc_type is None:
+            self.close()
+
+
+class Chunk(NamedTuple):
+    type: int
+    block: int
+    """
+    在展开后的镜像中的起始块
+    """
+    blocks: int
+    data_offset: int
+    """
+    RAW数据在sparse文件中的位置
+    """
+    fill: bytes
+    """
+    FILL的4字节
+    """
+
+
+class SparseImage(NamedTuple):
+    block_size: int
+    total_blocks: int
+    chunks: list[Chunk]
+
+    @property
+    def size(self) -> int:
+        """
+        展开后的大小(字节)
+        """
+        return self.block_size * self.total_blocks
+
+
+def is_sparse(filename: str) -> bool:
+    with open(filename, 'rb') as f:
+        header = f.read(4)
+    return len(header) == 4 and int.from_bytes(header, 'little') == MAGIC
+
+
+def expanded_size(filename: str) -> int:
+    """
+    return: sparse镜像展开后的大小(字节), 只读取文件头
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        raise SparseError(f'{filename}不是sparse镜像: 文件太小')
+    magic, major, _, _, _, block_size, total_blocks, _, _ = _HEADER.unpack(header)
+    if magic != MAGIC or major != 1:
+        raise SparseError(f'{filename}不是sparse镜像: magic={magic:#x}, 版本{major}')
+    return block_size * total_blocks
+
+
+def parse(data: bytes | memoryview) -> SparseImage:
+    """
+    data: sparse文件的内容(可以是mmap的memoryview)
+    """
+    if len(data) < _HEADER.size:
+        raise SparseError('不是sparse镜像: 文件太小')
+    magic, major, _, header_size, chunk_header_size, block_size, total_blocks, total_chunks, _ = _HEADER.unpack_from(data)
+    if magic != MAGIC or major != 1:
+        raise SparseError(f'不是sparse镜像: magic={magic:#x}, 版本{major}')
+    chunks: list[Chunk] = []
+    offset = header_size
+    block = 0
+    for _ in range(total_chunks):
+        if offset + chunk_header_size > len(data):
+            raise SparseError('sparse镜像不完整')
+        kind, _, blocks, total_size = _CHUNK.unpack_from(data, offset)
+        body = offset + chunk_header_size
+        if kind == CHUNK_RAW:
+            if total_size != chunk_header_size + blocks * block_size or body + blocks * block_size > len(data):
+                raise SparseError(f'RAW chunk大小错误: {total_size}')
+            chunks.append(Chunk(kind, block, blocks, body, b''))
+        elif kind == CHUNK_FILL:
+            chunks.append(Chunk(kind, block, blocks, 0, bytes(data[body:body + 4])))
+        elif kind == CHUNK_DONT_CARE:
+            chunks.append(Chunk(kind, block, blocks, 0, b''))
+        elif kind != CHUNK_CRC32:
+            raise SparseError(f'未知的chunk类型: {kind:#x}')
+        block += blocks
+        offset += total_size
+    if block != total_blocks:
+        raise SparseError(f'chunk总块数{block}与文件头中的{total_blocks}不一致')
+    return SparseImage(block_size, total_blocks, chunks)
+
+
+def iter_fill(fill: bytes, size: int, piece: int = 16 * 1024 * 1024) -> Iterator[bytes]:
+    """
+    把FILL展开为多段数据, 每段不超过piece字节
+    """
+    block = fill * (min(size, piece) // 4)
+    for i in range(0, size, len(block)):
+        yield block if size - i >= len(block) else block[:size - i]
+
+
+def convert(src: str, dst: str, block_size: int | None = None, zeros_as_dont_care: bool = False, buffer_size: int = 1024 * 1024) -> None:
+    """
+    把原始镜像转换为sparse镜像, 出错时删除dst
+    block_size: 留空则按文件大小选择
+    """
+    try:
+        with open(src, 'rb') as f, open(dst, 'wb') as output:
+            if block_size is None:
+                f.seek(0, 2)
+                block_size = block_size_for(f.tell())
+                f.seek(0)
+            with SparseWriter(output, block_size, zeros_as_dont_care) as writer:
+                while True:
+                    data = f.read(buffer_size)
+                    if not data:
+                        break
+                    writer.write(data)
+    except BaseException:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
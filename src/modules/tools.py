@@ -9,16 +9,27 @@ import rich
 from urllib import parse
 from time import sleep
 import time
-import serial.tools.list_ports
 from rich.table import Table
 import zipfile
 import os
 import re
 import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import uuid
 import rich.status
 from modules.patch_boot import patch
-from typing import Any, NoReturn, Literal, TypedDict, Union
+from typing import Any, Callable, Iterator, NoReturn, Literal, TypedDict, Union
 from modules import logging
+from modules import adb_client
+from modules import edl_ports
+from modules import sahara
+from modules import firehose
+from modules import gpt
+from modules import rawprogram
+from modules import sparse
+from modules import backup
 
 class RunProgramException(Exception):
     pass
@@ -37,23 +48,253 @@ class ReturnBytesError(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
 
-def run_wait(args: str) -> ReturnMessageSegments:
+
+class ProgramTimeoutError(RunProgramException):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+_encodings: dict[str, str] = {}
+"""
+每个程序检测出的输出编码, 同一个程序只检测一次
+"""
+
+_line_split = re.compile(rb'\r\n|\r|\n')
+
+def split_lines(pending: bytes, keepends: bool = False) -> tuple[list[bytes], bytes]:
     """
-    运行一个程序并等待
+    按\r\n, \r, \n切分输出
+    keepends: 是否在每行末尾保留换行符(拼接后与原始输出相同)
+    return: 完整的行, 剩余未结束的部分
     """
-    logging.debug(f'运行程序{args}')
-    p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=False)
-    stdout: str | bytes = ''
-    try:
-        stdout = p.stdout.decode('gbk')
-    except UnicodeDecodeError:
+    if not keepends:
+        lines = _line_split.split(pending)
+        return lines, lines.pop()
+    lines = []
+    start = 0
+    for i in _line_split.finditer(pending):
+        lines.append(pending[start:i.end()])
+        start = i.end()
+    return lines, pending[start:]
+
+def decode_line(program: str, line: bytes) -> str:
+    """
+    解码一行输出, 遇到第一行非ASCII内容时检测并记住该程序的编码
+    """
+    if line.isascii():
+        return line.decode('ascii')
+    encoding = _encodings.get(program)
+    for i in ([encoding] if not encoding is None else []) + ['gbk', 'utf-8']:
+        try:
+            decoded = line.decode(i)
+        except UnicodeDecodeError:
+            continue
+        _encodings.setdefault(program, i)
+        return decoded
+    return line.decode(encoding or 'gbk', errors='replace')
+
+def decode_output(program: str, raw: bytes) -> str | bytes:
+    """
+    解码程序的全部输出, 无法解码时返回bytes
+    """
+    encoding = _encodings.get(program)
+    for i in ([encoding] if not encoding is None else []) + ['gbk', 'utf-8']:
         try:
-            stdout = p.stdout.decode()
+            return raw.decode(i)
         except UnicodeDecodeError:
-            stdout = p.stdout
-    logging.debug(LoggingDebugRunningProgramReturn(
-        (args, get_return_message_segments(p.returncode == 0, stdout))))
-    return get_return_message_segments(p.returncode == 0, stdout)
+            pass
+    return raw
+
+_arg_skip = ('--port', '--search_path', '--memoryname', '--zlpawarehost', '--noprompt', '--showpercentagecomplete', '--lun', '--sectorsizeinbytes', '--num_sectors', '--start_sector')
+"""
+对分类没有意义的参数(例如端口号)
+"""
+
+def classify_args(program: str, args: str | list[str]) -> str:
+    """
+    从命令行中提取参数类别, 例如"shell getprop", "install", "--sendxml"
+    program: 程序路径
+    args: 完整的命令行字符串, 或不含程序本身的参数列表
+    """
+    tokens = re.findall(r'"[^"]*"|\S+', args)[1:] if type(args) == str else list(args)
+    # adb/fastboot的-s为设备序列号, QSaharaServer的-u为端口号
+    value_flags = ('-s', '-t', '-p') if os.path.basename(program).lower().startswith(('adb', 'fastboot')) else ('-u',)
+    words: list[str] = []
+    skip_next = False
+    for i in tokens:
+        i = i.strip('"')
+        if skip_next:
+            skip_next = False
+            continue
+        if i in value_flags:
+            skip_next = True
+            continue
+        if i.split('=', 1)[0] in _arg_skip:
+            continue
+        words.append(i)
+    if not words:
+        return ''
+    if words[0].startswith('-'):
+        return words[0].split('=', 1)[0]
+    if words[0] == 'shell' and len(words) > 1:
+        return 'shell ' + words[1].strip('"\'').split(' ', 1)[0]
+    return words[0].split('=', 1)[0]
+
+class ProgramProfiler:
+    """
+    按(程序, 参数类别)统计每次运行外部程序的耗时、启动耗时、返回值与输出大小
+    """
+    def __init__(self) -> None:
+        self.stats: dict[tuple[str, str], dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, program: str, args: str | list[str], wall: float, spawn: float, returncode: int, output_size: int) -> None:
+        key = (os.path.basename(program), classify_args(program, args))
+        with self._lock:
+            stat = self.stats.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0, 'spawn': 0.0, 'failed': 0, 'output': 0})
+            stat['count'] += 1
+            stat['total'] += wall
+            stat['max'] = max(stat['max'], wall)
+            stat['spawn'] += spawn
+            stat['failed'] += 0 if returncode == 0 else 1
+            stat['output'] += output_size
+
+    def rows(self) -> list[list[str]]:
+        with self._lock:
+            items = sorted(self.stats.items(), key=lambda i: i[1]['total'], reverse=True)
+        return [[program, argclass, str(int(i['count'])), f"{i['total']:.2f}s", f"{i['total'] / i['count']:.3f}s", f"{i['max']:.2f}s", f"{i['spawn']:.2f}s", str(int(i['failed'])), f"{int(i['output']) / 1024:.1f}KB"] for (program, argclass), i in items]
+
+    _columns = ['程序', '参数类别', '次数', '总耗时', '平均', '最长', '启动耗时', '失败', '输出']
+
+    def format_report(self) -> str:
+        rows = [self._columns] + self.rows()
+        widths = [max(len(row[i]) for row in rows) for i in range(len(self._columns))]
+        return '\n'.join('  '.join(x.ljust(widths[i]) for i, x in enumerate(row)) for row in rows) + '\n'
+
+    def print_report(self) -> None:
+        table = Table(title='外部程序耗时统计')
+        for i in self._columns:
+            table.add_column(i)
+        for i in self.rows():
+            table.add_row(*i)
+        Console().print(table)
+
+    def write_report(self, filename: str) -> None:
+        if self.stats:
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(self.format_report())
+
+profiler = ProgramProfiler()
+
+class RunningProgram:
+    """
+    运行一个程序, 逐行读取输出
+    用法: for line in RunningProgram(args): ..., 结束后调用wait()得到与run_wait相同的返回值
+    """
+    tail_lines: int = 200
+    """
+    keep_output为False时保留的最后几行输出
+    """
+
+    def __init__(self, args: str, keep_output: bool = False) -> None:
+        """
+        args: 命令行
+        keep_output: 是否保留全部输出用于wait()的返回值, 为False时只保留最后tail_lines行(用于错误信息)
+        """
+        logging.debug('运行程序%s', args)
+        self.args = args
+        self.program = args.split(' ', 1)[0]
+        self.keep_output = keep_output
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.spawn_time = time.perf_counter() - self.started
+        self.output_size = 0
+        self._lines: list[str] | deque[str] = [] if keep_output else deque(maxlen=self.tail_lines)
+        """
+        已解码的输出(保留换行符)
+        """
+        self._consumed = False
+
+    def __iter__(self) -> Iterator[str]:
+        if self._consumed:
+            return
+        self._consumed = True
+        stdout = self.process.stdout
+        pending = b''
+        while True:
+            chunk = stdout.read1(65536)  # type: ignore
+            if not chunk:
+                break
+            self.output_size += len(chunk)
+            lines, pending = split_lines(pending + chunk, True)
+            for i in lines:
+                yield self._decode(i)
+        if pending:
+            yield self._decode(pending)
+
+    def _decode(self, line: bytes) -> str:
+        """
+        每行只解码一次, 保存带换行符的结果, 返回去掉换行符的一行
+        """
+        decoded = decode_line(self.program, line)
+        self._lines.append(decoded)
+        return decoded.rstrip('\r\n')
+
+    def wait(self, on_line: Callable[[str], Any] | None = None, timeout: int | float | None = None) -> ReturnMessageSegments:
+        """
+        读完剩余输出并等待程序结束
+        on_line: 每读到一行输出时调用
+        timeout: 从程序启动起的超时时间(秒), 超时后结束程序并抛出ProgramTimeoutError, 留空则不限时
+        """
+        timed_out = threading.Event()
+        timer: threading.Timer | None = None
+        if not timeout is None:
+            def kill() -> None:
+                timed_out.set()
+                try:
+                    self.process.kill()
+                except OSError:
+                    pass
+            timer = threading.Timer(max(timeout - (time.perf_counter() - self.started), 0), kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            for i in self:
+                if not on_line is None:
+                    on_line(i)
+            returncode = self.process.wait()
+        finally:
+            if not timer is None:
+                timer.cancel()
+        self.process.stdout.close()  # type: ignore
+        stdout = ''.join(self._lines)
+        self._lines.clear()
+        if timed_out.is_set():
+            profiler.record(self.program, self.args, time.perf_counter() - self.started, self.spawn_time, -1, self.output_size)
+            logging.warning('运行程序%s超时(%s秒), 已结束', self.args, timeout)
+            raise ProgramTimeoutError(f'运行{self.args}超时({timeout}秒)', stdout)
+        profiler.record(self.program, self.args, time.perf_counter() - self.started, self.spawn_time, returncode, self.output_size)
+        logging.debug(LoggingDebugRunningProgramReturn(
+            (self.args, get_return_message_segments(returncode == 0, stdout))))
+        return get_return_message_segments(returncode == 0, stdout)
+
+def run_wait(args: str, on_line: Callable[[str], Any] | None = None, timeout: int | float | None = None, keep_output: bool = False) -> ReturnMessageSegments:
+    """
+    运行一个程序并等待
+    on_line: 每读到一行输出时调用, 可用于实时显示进度
+    timeout: 超时时间(秒), 超时后结束程序并抛出ProgramTimeoutError, 留空则不限时
+    keep_output: 是否在返回值中包含全部输出, 为False时只包含最后RunningProgram.tail_lines行; 需要解析输出时传True
+    """
+    return RunningProgram(args, keep_output).wait(on_line, timeout)
+
+def status_progress(status: rich.status.Status, title: str) -> Callable[[str], None]:
+    """
+    生成一个on_line回调, 把输出中的百分比进度显示在状态栏上
+    """
+    def on_line(line: str) -> None:
+        match = re.search(r'(\d+(?:\.\d+)?)%', line)
+        if not match is None:
+            status.update(f'{title} {match.group(1)}%')
+    return on_line
 
 def logging_traceback(title: str = '', level: Literal['error', 'warning'] = 'error'):
     if level == 'error':
@@ -78,6 +319,7 @@ def exit_after_enter() -> NoReturn:
     sys.exit()
 
 
+@logging.span('下载文件{url}')
 def download_file(url: str, filename: str = '', progress_enable: bool = True) -> None:
     logging.debug(f'下载文件{filename}')
     if filename == '':
@@ -132,9 +374,166 @@ def print_logo(version: list[Any]) -> None:
     print(logo)
 
 
+def split_windows_args(cmdline: str) -> list[str]:
+    """
+    按Windows命令行规则拆分参数, 得到程序实际收到的参数列表
+    """
+    args: list[str] = []
+    current = ''
+    in_arg = False
+    quoted = False
+    backslashes = 0
+    for c in cmdline:
+        if c == '\\':
+            backslashes += 1
+            in_arg = True
+            continue
+        if c == '"':
+            current += '\\' * (backslashes // 2)
+            if backslashes % 2:
+                current += '"'
+            else:
+                quoted = not quoted
+            backslashes = 0
+            in_arg = True
+            continue
+        current += '\\' * backslashes
+        backslashes = 0
+        if c in ' \t' and not quoted:
+            if in_arg:
+                args.append(current)
+                current = ''
+                in_arg = False
+            continue
+        current += c
+        in_arg = True
+    current += '\\' * backslashes
+    if in_arg:
+        args.append(current)
+    return args
+
+
+class ADBShellSession:
+    """
+    常驻的adb shell进程, 多条命令共用同一个adb.exe和设备端shell
+    每条命令后输出一行带随机标记的结束行, 据此切分输出并取得返回值
+    进程退出后(例如设备重启)下一条命令会自动重新连接
+    """
+    class SessionClosedError(RunProgramException):
+        def __init__(self, *args: object) -> None:
+            super().__init__(*args)
+
+    def __init__(self, path: str, serial: str | None = None) -> None:
+        """
+        path: adb路径
+        serial: 设备序列号, 留空则使用唯一连接的设备
+        """
+        self.path = path
+        self.serial = serial
+        self.process: subprocess.Popen[bytes] | None = None
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+
+    def is_alive(self) -> bool:
+        return not self.process is None and self.process.poll() is None
+
+    def start(self) -> None:
+        self.close()
+        logging.debug('启动常驻adb shell')
+        self.process = subprocess.Popen(f'{self.path}{'' if self.serial is None else f' -s {self.serial}'} shell', stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._buffer = bytearray()
+
+    def close(self) -> None:
+        process = self.process
+        if process is None:
+            return
+        self.process = None
+        try:
+            process.stdin.write(b'exit\n')  # type: ignore
+            process.stdin.close()  # type: ignore
+        except OSError:
+            pass
+        try:
+            process.wait(2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stdout.close()  # type: ignore
+        logging.debug('常驻adb shell已关闭')
+
+    def __del__(self) -> None:
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def run(self, command: str) -> tuple[int, str | bytes]:
+        """
+        在设备端shell中执行一条命令, stdin为/dev/null, stderr合并到stdout
+        command: 设备端命令(不需要再为Windows命令行加引号)
+        return: 返回值, 输出
+        """
+        with self._lock:
+            if not self.is_alive():
+                self.start()
+            marker = f'__XTCEASYROOTPLUS_{uuid.uuid4().hex}__'
+            needle = f'\n{marker} '.encode()
+            logging.debug('常驻adb shell执行%s', command)
+            started = time.perf_counter()
+            try:
+                self.process.stdin.write(f'{{ {command}\n}} </dev/null 2>&1; printf "\\n{marker} %d\\n" $?\n'.encode())  # type: ignore
+                self.process.stdin.flush()  # type: ignore
+            except OSError:
+                self.close()
+                raise self.SessionClosedError(f'adb shell会话已断开: {command}')
+            searched = 0
+            while True:
+                index = self._buffer.find(needle, searched)
+                if index != -1:
+                    end = self._buffer.find(b'\n', index + len(needle))
+                    if end != -1:
+                        break
+                else:
+                    searched = max(0, len(self._buffer) - len(needle))
+                chunk = self.process.stdout.read1(65536)  # type: ignore
+                if not chunk:
+                    output = decode_output(self.path, bytes(self._buffer))
+                    self.close()
+                    raise self.SessionClosedError(f'adb shell会话已断开: {command}', output)
+                self._buffer += chunk
+            raw = bytes(self._buffer[:index])
+            returncode = int(self._buffer[index + len(needle):end].strip())
+            del self._buffer[:end + 1]
+        profiler.record(f'{self.path}(session)', ['shell', command], time.perf_counter() - started, 0, returncode, len(raw))
+        output = decode_output(self.path, raw)
+        logging.debug(LoggingDebugRunningProgramReturn((f'(session) {command}', get_return_message_segments(returncode == 0, output))))
+        return returncode, output
+
+
 class ADB:
-    def __init__(self, path: str) -> None:
+    timeout: int | float | None = None
+    """
+    adb命令的默认超时时间(秒), 为None则不限时(刷入模块、执行脚本等耗时难以预估)
+    """
+    short_timeout: int | float | None = 30
+    """
+    devices、getprop等必定很快返回的命令的超时时间(秒)
+    """
+
+    def __init__(self, path: str, persistent_shell: bool = False, use_client: bool = False, serial: str | None = None) -> None:
+        """
+        path: adb路径
+        persistent_shell: 是否让shell()使用常驻的adb shell会话
+        use_client: 是否让is_connect(), shell(), push(), reboot()直接通过socket与adb server通信, 不启动adb.exe
+        serial: 设备序列号, 所有命令都只作用于这台设备(adb -s), 留空则使用唯一连接的设备
+        """
         self.path = path
+        self.serial = serial
+        self._props: dict[str, str] | None = None
+        self.session: ADBShellSession | None = ADBShellSession(path, serial) if persistent_shell else None
+        self.client: adb_client.ADBClient | None = adb_client.ADBClient(serial=serial, adb_path=path) if use_client else None
+        self.watcher: adb_client.DeviceWatcher | None = None
+        self._rebooted = False
 
     class RebootMode(Enum):
         edl = 'edl'
@@ -145,8 +544,19 @@ class ADB:
         def __init__(self, *args: object) -> None:
             super().__init__(*args)
 
-    def adb(self, args: str) -> str:
-        output = run_wait(f'{self.path} {args}')
+    @property
+    def _command(self) -> str:
+        return self.path if self.serial is None else f'{self.path} -s {self.serial}'
+
+    def adb(self, args: str, on_line: Callable[[str], Any] | None = None, timeout: int | float | None = -1, keep_output: bool = True) -> str:
+        """
+        timeout: 超时时间(秒), -1为使用ADB.timeout, None为不限时
+        keep_output: 见run_wait, 不需要解析输出的耗时命令(安装、推送)传False
+        """
+        try:
+            output = run_wait(f'{self._command} {args}', on_line, self.timeout if timeout == -1 else timeout, keep_output)
+        except ProgramTimeoutError as e:
+            raise self.ADBError(*e.args)
         stdout = output[1]
         if output[0]:
             if type(stdout) == str:
@@ -156,50 +566,141 @@ class ADB:
         else:
             raise self.ADBError(stdout)
 
-    def _adb(self, args: str) -> ReturnMessageSegments:
-        return run_wait(f'{self.path} {args}')
+    def _adb(self, args: str, on_line: Callable[[str], Any] | None = None, timeout: int | float | None = -1) -> ReturnMessageSegments:
+        return run_wait(f'{self._command} {args}', on_line, self.timeout if timeout == -1 else timeout, True)
+
+    def _client_call(self, args: list[str], call: Callable[[adb_client.ADBClient], Any]) -> Any:
+        """
+        通过adb server客户端执行操作, 错误转换为ADBError, 耗时记录在profiler中
+        """
+        started = time.perf_counter()
+        try:
+            output = call(self.client)  # type: ignore
+        except (adb_client.ADBClientError, OSError) as e:
+            profiler.record(f'{self.path}(client)', args, time.perf_counter() - started, 0, 1, 0)
+            raise self.ADBError(f'{" ".join(args)}: {e}')
+        profiler.record(f'{self.path}(client)', args, time.perf_counter() - started, 0, 0, len(output) if type(output) in (str, bytes) else 0)
+        return output
 
     def reboot(self, reboot: RebootMode | None = None) -> str:
-        return self.adb(f'reboot{'' if reboot is None else f' {reboot.value}'}')
+        self._props = None
+        self._rebooted = True
+        if not self.session is None:
+            self.session.close()
+        with logging.span('重启设备' + ('' if reboot is None else f'至{reboot.value}')):
+            if not self.client is None:
+                mode = '' if reboot is None else reboot.value
+                self._client_call(['reboot', mode], lambda client: client.reboot(mode))
+                return ''
+            return self.adb(f'reboot{'' if reboot is None else f' {reboot.value}'}')
 
     def is_connect(self) -> bool:
-        self.adb('devices')
-        return '\tdevice' in self.adb('devices')
+        if not self.client is None:
+            return adb_client.has_device(dict(self._client_call(['devices'], lambda client: client.devices())), self.client.serial)
+        self.adb('devices', timeout=self.short_timeout)
+        return adb_client.has_device(adb_client.parse_devices(self.adb('devices', timeout=self.short_timeout)), self.serial)
 
-    def wait_for_connect(self, sleep_time: int | float = 0.5) -> None:
-        while True:
-            if self.is_connect():
-                break
-            sleep(sleep_time)
+    @logging.span('等待设备连接')
+    def wait_for_connect(self, sleep_time: int | float | None = None) -> None:
+        """
+        使用adb server客户端时订阅设备状态变化, 否则用一次adb wait-for-device等待
+        reboot()之后先等设备断开(最多10秒), 不使用adb server客户端时这一步用adb devices检查
+        sleep_time: 已弃用, 不再轮询所以没有作用, 只为兼容原来的调用保留
+        """
+        if self._rebooted:
+            # adb reboot返回时设备可能还没有断开, 先等它断开再等重新连接
+            if not self.client is None:
+                self.get_watcher().wait_for_disconnect(self.client.serial, 10)
+            else:
+                deadline = time.monotonic() + 10
+                while time.monotonic() < deadline and self.is_connect():
+                    sleep(0.5)
+        self._rebooted = False
+        if self.is_connect():
+            return
+        # 设备断开过, 重新连接的可能是另一台设备或已经重启
+        self._props = None
+        if not self.session is None:
+            self.session.close()
+        if self.client is None:
+            self.adb('wait-for-device', timeout=None)
+            return
+        self.get_watcher().wait_for_device(self.client.serial)
+
+    def get_watcher(self) -> adb_client.DeviceWatcher:
+        """
+        获取订阅设备状态变化的DeviceWatcher, 需要use_client=True
+        所有ADB实例共用同一个DeviceWatcher(adb_client.get_watcher), 不会随ADB实例增加线程和连接
+        """
+        if self.client is None:
+            raise self.ADBError('设备状态订阅需要使用adb server客户端(use_client=True)')
+        if self.watcher is None:
+            self.watcher = adb_client.get_watcher(self.client)
+        return self.watcher
+
+    _getprop_line = re.compile(rb'^\[([^\]\n]+)\]: \[(.*?)\]$(?=\n\[|\n?\Z)', re.M | re.S)
+    """
+    getprop的一行, 值可能跨多行(只在下一行以[开头或输出结束时才算值结束)
+    """
+
+    def get_props(self, refresh: bool = False) -> dict[str, str]:
+        """
+        用一次adb shell getprop读取全部属性并缓存, 重启后自动失效
+        refresh: 是否忽略缓存重新读取
+        """
+        if self._props is None or refresh:
+            output = self._shell_output('getprop', self.short_timeout)
+            if type(output) == str:
+                raw = output.encode('utf-8')
+                decode: Callable[[bytes], str] = lambda i: i.decode('utf-8')
+            else:
+                # 每个属性单独解码, 个别属性无法解码时不影响其他属性
+                raw = output
+                decode = lambda i: decode_line(self.path, i)
+            # Windows上的adb会把\n转换为\r\n, 经过pty时可能变成\r\r\n
+            raw = re.sub(rb'\r*\n', b'\n', raw)  # type: ignore
+            self._props = {decode(k): decode(v) for k, v in self._getprop_line.findall(raw)}
+        return self._props
+
+    def getprop(self, name: str, refresh: bool = False) -> str:
+        """
+        读取缓存中的属性, 不存在时返回空字符串(与getprop命令一致)
+        """
+        return self.get_props(refresh).get(name, '')
 
     def get_innermodel(self) -> str:
-        return self.adb('shell getprop ro.product.innermodel').replace('\n', '').replace('\r', '')
+        return self.getprop('ro.product.innermodel')
 
     def get_model(self) -> str:
-        return self.adb('shell getprop ro.product.model').replace('\n', '').replace('\r', '')
+        return self.getprop('ro.product.model')
 
     def get_version_of_android(self) -> str:
-        return self.adb('shell getprop ro.build.version.release').replace('\n', '').replace('\r', '')
+        return self.getprop('ro.build.version.release')
 
     def get_version_of_system(self) -> str:
-        return self.adb('shell getprop ro.product.current.softversion').replace('\n', '').replace('\r', '')
+        return self.getprop('ro.product.current.softversion')
+
+    def get_serial(self) -> str:
+        return self.getprop('ro.serialno')
 
     def get_info(self) -> dict[str, str]:
         output = {'innermodel': self.get_innermodel(), 'model': self.get_model(),
                   'version_of_android': self.get_version_of_android(),
                   'version_of_system': self.get_version_of_system(),
-                  'version_of_android_from_sdk': self.get_version_of_android_from_sdk()}
+                  'version_of_android_from_sdk': self.get_version_of_android_from_sdk(),
+                  'serial': self.get_serial()}
         return output
 
-    def get_plmnstatus(self) -> str:
-        return self.adb('shell getprop gsm.xtcplmn.plmnstatus')
+    def get_plmnstatus(self, refresh: bool = False) -> str:
+        return self.getprop('gsm.xtcplmn.plmnstatus', refresh)
 
-    def install(self, path: str, args: list[str] = ['r', 't', 'd']) -> str:
+    @logging.span('安装应用{path}')
+    def install(self, path: str, args: list[str] = ['r', 't', 'd'], on_line: Callable[[str], Any] | None = None) -> str:
         argsstr = ''
         for i in args:
             argsstr = argsstr + '-' + i + ' '
         logging.debug(f'安装应用{path}, 参数:{args}')
-        return self.adb(f'install {argsstr}{path}')
+        return self.adb(f'install {argsstr}{path}', on_line, keep_output=False)
 
     def loop_install(self, path: str, args: list[str] = ['r', 't', 'd'], sleeptime: int | float = 2) -> None:
         """
@@ -217,18 +718,66 @@ class ADB:
                     logging_traceback(f'安装失败, {sleeptime}秒后重试')
             sleep(sleeptime)
 
-    def shell(self, args: str) -> str:
-        return self.adb(f'shell {args}')
+    def shell(self, args: str, timeout: int | float | None = -1) -> str:
+        """
+        timeout: 通过adb.exe执行时的超时时间(秒), -1为使用ADB.timeout, None为不限时
+        """
+        stdout = self._shell_output(args, timeout)
+        if type(stdout) != str:
+            raise ReturnBytesError(stdout)
+        return stdout
+
+    def _shell_output(self, args: str, timeout: int | float | None = -1) -> str | bytes:
+        """
+        与shell相同, 但输出无法解码时返回bytes而不是抛出ReturnBytesError
+        """
+        if self.session is None and self.client is None:
+            try:
+                output = self._adb(f'shell {args}', timeout=timeout)
+            except ProgramTimeoutError as e:
+                raise self.ADBError(*e.args)
+            if not output[0]:
+                raise self.ADBError(output[1])
+            return output[1]
+        command = ' '.join(split_windows_args(args))
+        if not self.session is None:
+            try:
+                returncode, stdout = self.session.run(command)
+            except ADBShellSession.SessionClosedError as e:
+                raise self.ADBError(*e.args)
+        else:
+            returncode, raw = self._client_call(['shell', command], lambda client: client.shell(command))
+            stdout = decode_output(self.path, raw)
+            logging.debug(LoggingDebugRunningProgramReturn((f'(client) shell {command}', get_return_message_segments(returncode in (0, None), stdout))))
+        if not returncode in (0, None):
+            raise self.ADBError(stdout)
+        return stdout
+
+    def close(self) -> None:
+        """
+        关闭常驻adb shell会话(如果有)
+        """
+        if not self.session is None:
+            self.session.close()
 
     def xtc_is_v3(self) -> bool:
-        if 'true' in self.shell('getprop persist.sys.isv3'):
+        if 'true' in self.getprop('persist.sys.isv3'):
             return True
         else:
             return False
 
-    def push(self, input: str, path: str) -> None:
-        self.adb(f'push "{input}" "{path}"')
+    @logging.span('推送文件{input}')
+    def push(self, input: str, path: str, on_line: Callable[[str], Any] | None = None) -> None:
+        if self.client is None:
+            self.adb(f'push "{input}" "{path}"', on_line, keep_output=False)
+            return
+
+        def on_progress(sent: int, total: int) -> None:
+            if not on_line is None:
+                on_line(f'[{sent * 100 // max(total, 1):3d}%] {path}')
+        self._client_call(['push'], lambda client: client.push(input, path, on_progress))
 
+    @logging.span('安装模块{path}')
     def install_module(self, path: str) -> str:
         self.push(path, '/sdcard/temp_module.zip')
         self.shell('"echo -e \'chmod 777 /data/adb/magisk/busybox\\nDATABIN=\\"/data/adb/magisk\\"\\nBBPATH=\\"/data/adb/magisk/busybox\\"\\nUTIL_FUNCTIONS_SH=\\"$DATABIN/util_functions.sh\\"\\nexport OUTFD=1\\nexport ZIPFILE=\\"/sdcard/temp_module.zip\\"\\nexport ASH_STANDALONE=1\\n\\"$BBPATH\\" sh -c \\". \\\\\\"$UTIL_FUNCTIONS_SH\\\\\\"; install_module\\"\' > /sdcard/temp_module_installer.sh"')
@@ -236,6 +785,7 @@ class ADB:
         self.shell('rm -rf /sdcard/temp_module.zip')
         return output
 
+    @logging.span('安装模块{path}')
     def install_module_new(self, path: str) -> str:
         self.push(path, '/sdcard/temp_module.zip')
         output = self.shell(
@@ -243,12 +793,13 @@ class ADB:
         self.shell('rm -rf /sdcard/temp_module.zip')
         return output
 
-    def wait_for_complete(self, sleep_time: int | float = 0.5) -> None:
-        while True:
-            output = self.shell('getprop sys.boot_completed')
-            if '1' in output:
-                break
-            sleep(sleep_time)
+    @logging.span('等待开机完成')
+    def wait_for_complete(self, sleep_time: int = 1) -> None:
+        """
+        在设备端循环检查sys.boot_completed, 只需要一次shell调用
+        sleep_time: 设备端的检查间隔(秒), 旧版toolbox的sleep只支持整数秒
+        """
+        self.shell(f'until [ x$(getprop sys.boot_completed) = x1 ]; do sleep {max(int(sleep_time), 1)}; done', None)
 
     def get_activity(self) -> str:
         output = self.shell(
@@ -256,8 +807,7 @@ class ADB:
         return output
 
     def get_version_of_sdk(self) -> str:
-        # type: ignore
-        return self.shell('getprop ro.build.version.sdk').replace('\n', '').replace('\r', '')
+        return self.getprop('ro.build.version.sdk')
 
     def get_version_of_android_from_sdk(self) -> Literal['2.3', '2.3.3', '3.0', '3.1', '3.2', '4.0', '4.0.3', '4.1', '4.2', '4.3', '4.4', '4.4W', '5.0', '6.0', '7.0', '7.1', '8.0', '8.1', '9', '10', '11', '12', '12', '13', '14', '15']:
         sdk = self.get_version_of_sdk()
@@ -299,28 +849,101 @@ class ADB:
         return 'mState=ON' in output
 
 
+class DeviceRegistry:
+    """
+    按序列号管理多台设备, 每台设备一个绑定了序列号的ADB实例
+    """
+    def __init__(self, path: str, persistent_shell: bool = False, use_client: bool = False) -> None:
+        """
+        path: adb路径
+        persistent_shell, use_client: 创建ADB实例时使用的参数
+        """
+        self.path = path
+        self.persistent_shell = persistent_shell
+        self.use_client = use_client
+        self.devices: dict[str, ADB] = {}
+        self._lock = threading.Lock()
+
+    def serials(self) -> list[str]:
+        """
+        return: 当前已连接(状态为device)的全部设备序列号
+        """
+        if self.use_client:
+            devices = dict(adb_client.ADBClient(adb_path=self.path).devices())
+        else:
+            output = run_wait(f'{self.path} devices', timeout=ADB.short_timeout, keep_output=True)
+            if not output[0] or type(output[1]) != str:
+                raise ADB.ADBError(output[1])
+            devices = adb_client.parse_devices(output[1])
+        return [i for i, state in devices.items() if state == 'device']
+
+    def get(self, serial: str) -> ADB:
+        with self._lock:
+            if not serial in self.devices:
+                self.devices[serial] = ADB(self.path, self.persistent_shell, self.use_client, serial)
+            return self.devices[serial]
+
+    def connected(self) -> list[ADB]:
+        return [self.get(i) for i in self.serials()]
+
+    def close(self) -> None:
+        with self._lock:
+            for i in self.devices.values():
+                i.close()
+
+
+def run_on_devices(devices: list[ADB], flow: Callable[[ADB], Any], max_workers: int | None = None) -> dict[str, Any]:
+    """
+    每台设备一个工作线程, 同时对多台设备执行同一个流程
+    线程内的日志会标记设备序列号; 某台设备出错不影响其他设备
+    devices: 绑定了序列号的ADB实例
+    flow: 对一台设备执行的流程
+    max_workers: 最多同时操作几台设备, 留空则不限制
+    return: {序列号: flow的返回值或抛出的异常}
+    """
+    def worker(adb: ADB) -> Any:
+        with logging.device(str(adb.serial)):
+            try:
+                return flow(adb)
+            except Exception as e:
+                logging_traceback(f'设备{adb.serial}操作失败')
+                return e
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(devices), 1), thread_name_prefix='device') as pool:
+        futures = {str(i.serial): pool.submit(worker, i) for i in devices}
+    return {serial: future.result() for serial, future in futures.items()}
+
+
 def check_edl() -> str | None:
     """
     查找EDL端口, 若找到则返回字符串形式的端口号(例如"10"), 若未找到则返回None
     return: 若找到则返回字符串形式的端口号(例如"10"), 若未找到则返回None
     """
-    for port in serial.tools.list_ports.comports():
-        if 'Qualcomm' in port.description and '9008' in port.description:
-            return port.device[3:]
+    for port in edl_ports.scan().values():
+        if not port.port is None:
+            return str(port.port)
     return None
 
 
-def wait_for_edl(sleeptime: int | float = 0.5) -> int:
+class WaitForEDLError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+@logging.span('等待9008端口')
+def wait_for_edl() -> int:
     """
-    循环查找EDL端口直到找到为止
-    param sleeptime: 寻找端口的冷却时间
-    return: 字符串形式的端口号(例如"10")
+    等待直到出现EDL端口, 串口插拔时立即得到通知
+    等待时端口监视器被停止则改为扫描一次, 仍然没有找到时抛出WaitForEDLError
+    return: 端口号(例如10)
     """
-    while True:
-        check = check_edl()
-        if not check is None:
-            return int(check.replace('\n', '').replace('\r', ''))
-        sleep(sleeptime)
+    port = edl_ports.get_monitor().wait_for(lambda i: not i.port is None)
+    if not port is None:
+        return port.port  # type: ignore
+    found = check_edl()
+    if found is None:
+        raise WaitForEDLError('端口监视器已停止, 没有找到9008端口')
+    return int(found)
 
 
 def print_error(title: str, content: str) -> None:
@@ -333,7 +956,7 @@ def print_error(title: str, content: str) -> None:
     print(table)
 
 def print_table(title: str, content: str) -> None:
-    logging.error(f'完成:{title}\n{content}')
+    logging.info(f'完成:{title}\n{content}')
     console = Console()
     print = console.print
     table = Table()
@@ -342,14 +965,104 @@ def print_table(title: str, content: str) -> None:
     print(table)
 
 
+def print_device_results(title: str, results: dict[str, Any]) -> None:
+    """
+    打印run_on_devices的结果, 每台设备一行
+    """
+    logging.info(f'完成:{title}\n' + '\n'.join(f'{serial}: {"失败 " + str(result) if isinstance(result, Exception) else "成功"}' for serial, result in results.items()))
+    table = Table(title=title)
+    table.add_column('设备')
+    table.add_column('结果')
+    for serial, result in results.items():
+        table.add_row(serial, f'[red]失败:{result}[/red]' if isinstance(result, Exception) else '[green]成功[/green]')
+    Console().print(table)
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    用硬链接把src放到dst, 不支持硬链接(跨磁盘、FAT32等)时才复制
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def partition_xml(name: str, start: int, size: int, filename: str | None = None, sparse: bool = False) -> str:
+    """
+    生成读取/写入单个分区用的XML
+    filename: 镜像文件名, 留空则为{name}.img
+    sparse: 镜像是否为Android sparse格式(fh_loader会跳过DONT_CARE)
+    """
+    return partitions_xml({name: {'start': start, 'size': size}}, None if filename is None else {name: filename}, [name] if sparse else [])
+
+
+def partitions_xml(partitions: dict[str, dict[str, int]], filenames: dict[str, str] | None = None, sparse_names: list[str] = []) -> str:
+    """
+    生成读取/写入多个分区用的XML, 按起始扇区排序以便顺序传输
+    partitions: {'name': {'start': start, 'size': size}, ...}
+    filenames: 各分区的镜像文件名, 未给出的为{name}.img
+    sparse_names: 镜像为Android sparse格式的分区
+    """
+    plan = rawprogram.Plan()
+    for name in partitions:
+        plan.add_partition(name, partitions[name]['start'], partitions[name]['size'], (filenames or {}).get(name), sparse=name in sparse_names)
+    plan.optimize()
+    return plan.to_xml()
+
+
 class QT:
-    def __init__(self, qsspath: str, fhlpath: str, port: int, mbn: str, emmcdlpath: str = 'bin/emmcdl.exe') -> None:
+    native_sahara: bool = False
+    """
+    intosahara()是否使用内置的Sahara客户端(modules.sahara)代替QSaharaServer
+    """
+    native_firehose: bool = False
+    """
+    读写分区、发送XML、退出9008是否使用内置的Firehose客户端(modules.firehose)代替fh_loader
+    """
+    timeout: int | float | None = None
+    """
+    QSaharaServer、emmcdl和fh_loader短命令(读取分区表、重启等)的超时时间(秒), 为None则不限时; 读写分区的fh_loader总是不限时
+    """
+    partition_cache: gpt.PartitionTableCache | None = gpt.PartitionTableCache('data/gpt_cache/')
+    """
+    分区表的本地缓存, GPT头没有变化时get_partition_list()跳过读取分区项数组; 为None则每次都完整读取
+    """
+
+    def __init__(self, qsspath: str, fhlpath: str, port: int, mbn: str, emmcdlpath: str = 'bin/emmcdl.exe', workspace: str | None = None, native_sahara: bool | None = None, native_firehose: bool | None = None) -> None:
+        """
+        workspace: 临时XML、读出的镜像和fh_loader日志存放的文件夹, 每个端口使用不同的文件夹即可同时操作多台设备; 留空则与原来一样使用当前目录和tmp/
+        native_sahara: 是否使用内置的Sahara客户端, 留空则使用QT.native_sahara
+        native_firehose: 是否使用内置的Firehose客户端, 留空则使用QT.native_firehose
+        """
+        if not native_sahara is None:
+            self.native_sahara = native_sahara
+        if not native_firehose is None:
+            self.native_firehose = native_firehose
+        self._firehose: firehose.FirehoseClient | None = None
+        self._firehose_port: Any = None
         self.qsspath = qsspath
         self.fhlpath = fhlpath
         self.port = port
         self.mbn = mbn
         self.emmcdlpath = emmcdlpath
+        self.workspace = workspace
         self.partition_list: dict[str, dict[str, int]] | None = None
+        self.partition_table: gpt.PartitionTable | None = None
+        """
+        get_partition_list()解析出的完整分区表
+        """
+        if not workspace is None:
+            os.makedirs(workspace, exist_ok=True)
+
+    def image_path(self, name: str) -> str:
+        """
+        read_partition读出的镜像文件位置
+        """
+        return f'{name}.img' if self.workspace is None else os.path.join(self.workspace, f'{name}.img')
+
+    def _temp_path(self, filename: str) -> str:
+        return filename if self.workspace is None else os.path.join(self.workspace, filename)
 
     class GetPartitionInfoError(RunProgramException):
         def __init__(self, *args: object) -> None:
@@ -375,8 +1088,11 @@ class QT:
         def __init__(self, *args: object) -> None:
             super().__init__(*args)
 
-    def qsaharaserver(self, args: str):
-        output = run_wait(f'{self.qsspath} {args}')
+    def qsaharaserver(self, args: str, on_line: Callable[[str], Any] | None = None):
+        try:
+            output = run_wait(f'{self.qsspath} {args}', on_line, self.timeout)
+        except ProgramTimeoutError as e:
+            raise self.QSaharaServerError(*e.args)
         stdout = output[1]
         if output[0]:
             if type(stdout) == str:
@@ -386,8 +1102,17 @@ class QT:
         else:
             raise self.QSaharaServerError(stdout)
 
-    def fh_loader(self, args: str) -> str:
-        output = run_wait(f'{self.fhlpath} {args}')
+    def fh_loader(self, args: str, on_line: Callable[[str], Any] | None = None, timeout: int | float | None = None) -> str:
+        """
+        timeout: 超时时间(秒), 留空则不限时(读写大分区的时间难以预估)
+        return: 输出的最后RunningProgram.tail_lines行(读写大分区时输出很长, 不全部保留)
+        """
+        if not self.workspace is None and not '--mainoutputdir' in args:
+            args = f'{args} --mainoutputdir="{self.workspace}"'
+        try:
+            output = run_wait(f'{self.fhlpath} {args}', on_line, timeout)
+        except ProgramTimeoutError as e:
+            raise self.FHLoaderError(*e.args)
         stdout = output[1]
         if output[0]:
             if type(stdout) == str:
@@ -397,7 +1122,15 @@ class QT:
         else:
             raise self.FHLoaderError(stdout)
 
+    @logging.span('进入Sahara模式')
     def intosahara(self) -> str:
+        if self.native_sahara:
+            try:
+                sent = sahara.upload_programmer(self.port, self.mbn)
+            except sahara.SaharaError as e:
+                logging_traceback('进入Sahara模式失败')
+                raise self.QSaharaServerError(e)
+            return f'已上传{self.mbn}({sent}字节)'
         try:
             return self.qsaharaserver(f'-u {str(self.port)} -s 13:"{self.mbn}"')
         except self.QSaharaServerError as e:
@@ -408,14 +1141,104 @@ class QT:
         adb.adb('reboot edl')
         self.intosahara()
 
+    def get_firehose(self) -> firehose.FirehoseClient:
+        """
+        获取内置的Firehose客户端, 第一次调用时打开端口并configure, 之后的操作共用这个连接
+        """
+        if self._firehose is None:
+            self._firehose_port = firehose.open_port(self.port)
+            self._firehose = firehose.FirehoseClient(self._firehose_port)
+        return self._firehose
+
+    def close(self) -> None:
+        """
+        关闭内置Firehose客户端打开的端口(如果有)
+        """
+        if not self._firehose_port is None:
+            self._firehose_port.close()
+        self._firehose = None
+        self._firehose_port = None
+
+    def _native(self, call: Callable[[firehose.FirehoseClient], Any]) -> Any:
+        """
+        执行内置Firehose客户端的操作, 错误转换为FHLoaderError; 任何异常(包括call中写入输出时的错误)都会关闭端口, 下次重新连接
+        """
+        try:
+            return call(self.get_firehose())
+        except (firehose.FirehoseError, OSError) as e:
+            self.close()
+            raise self.FHLoaderError(e)
+        except BaseException:
+            # 传输可能停在中途, 端口中还有未读完的数据
+            self.close()
+            raise
+
+    @staticmethod
+    def _progress(on_line: Callable[[str], Any] | None) -> Callable[[int, int], None] | None:
+        """
+        把(已传输, 总大小)的进度转换为fh_loader一样的百分比输出行, 以便status_progress等回调使用
+        """
+        if on_line is None:
+            return None
+        last: list[int] = [-1]
+
+        def on_progress(done: int, total: int) -> None:
+            percent = done * 100 // max(total, 1)
+            if percent != last[0]:
+                last[0] = percent
+                on_line(f'{percent}%')
+        return on_progress
+
+    @logging.span('退出9008模式')
     def exit9008(self) -> str:
-        return self.fh_loader(rf'--port="\\.\COM{self.port}" --reset --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""')
+        if self.native_firehose:
+            self._native(lambda client: client.reset())
+            self.close()
+            return 'success'
+        return self.fh_loader(rf'--port="\\.\COM{self.port}" --reset --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""', timeout=self.timeout)
+
+    @logging.span('发送XML{xml_path}')
+    def load_xml(self, xml_path: str, memory: str = 'EMMC', on_line: Callable[[str], Any] | None = None) -> str:
+        if self.native_firehose:
+            self._native(lambda client: client.run_xml(xml_path, ['.' if self.workspace is None else self.workspace], True, self._progress(on_line)))
+            return 'success'
+        return self.fh_loader(rf'--port="\\.\COM{self.port}" --memoryname="{memory}" --sendxml="{xml_path}" --convertprogram2read --noprompt', on_line)
 
-    def load_xml(self, xml_path: str, memory: str = 'EMMC') -> str:
-        return self.fh_loader(rf'--port="\\.\COM{self.port}" --memoryname="{memory}" --sendxml="{xml_path}" --convertprogram2read --noprompt')
+    def send_xml(self, xml_files: list[str], search_path: str, on_line: Callable[[str], Any] | None = None) -> str:
+        """
+        按XML刷写(rawprogram/patch), 相当于fh_loader --sendxml=a.xml,b.xml --search_path=...
+        全部XML先合并为一个刷写计划(modules.rawprogram): 先program后patch, 去掉空的program, 合并连续的program
+        xml_files: search_path中的XML文件名
+        """
+        try:
+            plan = rawprogram.load([os.path.join(search_path, i) for i in xml_files], search_paths=[search_path])
+        except rawprogram.RawprogramError as e:
+            raise self.FHLoaderError(e)
+        missing = [i for i in plan.filenames() if not os.path.exists(os.path.join(search_path, i))]
+        if missing:
+            raise self.FHLoaderError(f'在{search_path}中找不到{",".join(missing)}')
+        logging.debug('刷写计划: %d个program, %d个patch', len(plan.programs), len(plan.patches))
+        xml = self._temp_path('sendxml_plan.xml')
+        plan.write(xml)
+        try:
+            if self.native_firehose:
+                self._native(lambda client: client.run_xml(xml, [search_path], False, self._progress(on_line)))
+                return 'success'
+            return self.fh_loader(rf'--port="\\.\COM{self.port}" --sendxml="{os.path.abspath(xml)}" --search_path="{search_path}" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""', on_line)
+        finally:
+            os.remove(xml)
+
+    def set_active_partition(self, drive: int = 0) -> str:
+        if self.native_firehose:
+            self._native(lambda client: client.set_bootable_drive(drive))
+            return 'success'
+        return self.fh_loader(rf'--port="\\.\COM{self.port}" --setactivepartition="{drive}" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc""', timeout=self.timeout)
 
-    def emmcdl(self, args: str) -> str:
-        output = run_wait(f'{self.emmcdlpath} {args}')
+    def emmcdl(self, args: str, on_line: Callable[[str], Any] | None = None) -> str:
+        try:
+            output = run_wait(f'{self.emmcdlpath} {args}', on_line, self.timeout, True)
+        except ProgramTimeoutError as e:
+            raise self.FHLoaderError(*e.args)
         stdout = output[1]
         if output[0]:
             if type(stdout) == str:
@@ -425,20 +1248,59 @@ class QT:
         else:
             raise self.FHLoaderError(stdout)
 
-    def get_partition_list(self) -> dict[str, dict[str, int]]:
-        logging.debug('读取分区列表')
+    def _read_gpt_header(self) -> bytes:
+        if self.native_firehose:
+            return self._native(lambda client: client.read_bytes(1, 1))
         try:
             self.fh_loader(
-                rf'--port="\\.\COM{self.port}" --search_path="tmp/" --convertprogram2read --sendimage="fh_gpt_header_0" --start_sector="1" --lun="0" --num_sectors="1" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc"" --num_sectors=200 --sectorsizeinbytes=512')
+                rf'--port="\\.\COM{self.port}" --search_path="tmp/" --convertprogram2read --sendimage="fh_gpt_header_0" --start_sector="1" --lun="0" --num_sectors="1" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc"" --sectorsizeinbytes=512', timeout=self.timeout)
+        except self.FHLoaderError as e:
+            logging_traceback('读取分区列表失败')
+            raise self.FHLoaderError(e)
+        if self.workspace is None:
+            shutil.move('fh_gpt_header_0', 'tmp/')
+        with open(os.path.join('tmp/' if self.workspace is None else self.workspace, 'fh_gpt_header_0'), 'rb') as f:
+            return f.read()
+
+    def _read_gpt_entries(self, header: gpt.Header) -> bytes:
+        if self.native_firehose:
+            return self._native(lambda client: client.read_bytes(header.entries_lba, header.entries_sectors(client.sector_size)))
+        try:
             self.fh_loader(
-                rf'--port="\\.\COM{self.port}" --search_path="tmp/" --convertprogram2read --sendimage="fh_gpt_entries_0" --start_sector="2" --lun="0" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc"" --num_sectors=200 --sectorsizeinbytes=512')
+                rf'--port="\\.\COM{self.port}" --search_path="tmp/" --convertprogram2read --sendimage="fh_gpt_entries_0" --start_sector="{header.entries_lba}" --lun="0" --noprompt --showpercentagecomplete --zlpawarehost="1" --memoryname=""emmc"" --num_sectors={header.entries_sectors()} --sectorsizeinbytes=512', timeout=self.timeout)
         except self.FHLoaderError as e:
             logging_traceback('读取分区列表失败')
             raise self.FHLoaderError(e)
-        shutil.move('fh_gpt_header_0', 'tmp/')
-        shutil.move('fh_gpt_entries_0', 'tmp/')
-        self.partition_list = get_partition_list_from_files(
-            'tmp/fh_gpt_entries_0', 'tmp/fh_gpt_header_0')[1]
+        if self.workspace is None:
+            shutil.move('fh_gpt_entries_0', 'tmp/')
+        with open(os.path.join('tmp/' if self.workspace is None else self.workspace, 'fh_gpt_entries_0'), 'rb') as f:
+            return f.read()
+
+    @logging.span('读取分区列表')
+    def get_partition_list(self) -> dict[str, dict[str, int]]:
+        """
+        先读取GPT头, 与本地缓存(partition_cache)一致时直接使用缓存, 否则再读取分区项数组
+        """
+        logging.debug('读取分区列表')
+        header = self._read_gpt_header()
+        try:
+            parsed = gpt.parse_header(header)
+            table = None if self.partition_cache is None else self.partition_cache.load(header)
+            if table is None:
+                entries = self._read_gpt_entries(parsed)
+                table = gpt.PartitionTable(parsed, entries)
+                if not self.partition_cache is None:
+                    try:
+                        self.partition_cache.store(table, header, entries)
+                    except OSError:
+                        logging_traceback('保存分区表缓存失败', 'warning')
+            else:
+                logging.debug('GPT头未变化, 使用缓存的分区表%s', parsed.disk_guid)
+        except gpt.GPTError as e:
+            logging_traceback('解析分区表失败')
+            raise self.GetPartitionInfoError(e)
+        self.partition_table = table
+        self.partition_list = table.to_dict()
         return self.partition_list
 
     def _get_partition_list(self) -> dict[str, dict[str, int]]:
@@ -461,145 +1323,397 @@ class QT:
         else:
             raise self.GetPartitionInfoError(output)
 
-    def read_partition(self, name: str, start: int | None = None, size: int | None = None) -> str:
-        logging.debug(f'读取分区{name}, 参数:{locals()}')
-        xml = \
-            """<?xml version="1.0" ?>
-<data>
-  <program SECTOR_SIZE_IN_BYTES="512" file_sector_offset="0" filename="__name__.img" label="__name__" num_partition_sectors="__size__" physical_partition_number="0" size_in_KB="__size_kb__" sparse="false" start_byte_hex="__start_hex__" start_sector="__start__" />
-</data>"""
+    @logging.span('读取分区{name}')
+    def read_partition(self, name: str, start: int | None = None, size: int | None = None, on_line: Callable[[str], Any] | None = None, output: str | None = None) -> str:
+        """
+        output: 镜像保存的位置, 留空则为image_path(name)
+        先读到{output}.tmp, 成功后才替换原有的文件, 读取失败时原有的文件不受影响
+        """
+        logging.debug('读取分区%s, 参数:%s', name, locals())
         if start is None or size is None:
             if self.partition_list is None:
                 self.get_partition_list()
             start = self.partition_list[name]['start']  # type: ignore
             size = self.partition_list[name]['size']  # type: ignore
+        destination = self.image_path(name) if output is None else output
+        temp = f'{destination}.tmp'
+        # fh_loader只能写入工作目录, 读完后再移动到temp(同一磁盘时只是重命名)
+        loader_temp = self._temp_path(f'{name}.img.tmp')
 
-        if os.path.exists(f'{name}.img'):
-            os.remove(f'{name}.img')
-
-        xml = xml.replace('__name__', name)
-        xml = xml.replace('__size__', str(size),)  # type: ignore
-        xml = xml.replace('__size_kb__', str(size/2)+'.0')  # type: ignore
-        xml = xml.replace('__start_hex__', '0x{:02X}'.format(
-            int(start/8)).ljust(10, '0'))  # type: ignore
-        xml = xml.replace('__start__', str(start))  # type: ignore
-
-        with open(f'{name}.xml', 'w') as f:
-            f.write(xml)
-
-        output = self.load_xml(f'{name}.xml')
-
-        os.remove(f'{name}.xml')
-
-        return output
-
-    def read_partitions(self, partitions: dict[str, dict[str, int]], output_path: str | None = None) -> None:
+        try:
+            if self.native_firehose:
+                self._native(lambda client: client.read_to_file(start, size, temp, 0, self._progress(on_line)))  # type: ignore
+                result = 'success'
+            else:
+                xml = self._temp_path(f'{name}.xml')
+                with open(xml, 'w') as f:
+                    f.write(partition_xml(name, start, size, f'{name}.img.tmp'))  # type: ignore
+                try:
+                    result = self.load_xml(xml, on_line=on_line)
+                finally:
+                    os.remove(xml)
+                if os.path.abspath(loader_temp) != os.path.abspath(temp):
+                    shutil.move(loader_temp, temp)
+            os.replace(temp, destination)
+        except BaseException:
+            for i in (temp, loader_temp):
+                if os.path.exists(i):
+                    os.remove(i)
+            raise
+        return result
+
+    def _batch_progress(self, on_line: Callable[[str], Any] | None, sizes: list[int]) -> Callable[[int], Callable[[int, int], None] | None]:
+        """
+        把多个分区的传输进度合并为一个总进度
+        sizes: 各分区的扇区数, 按传输顺序
+        return: 传入分区序号, 返回该分区传输时使用的on_progress
         """
+        progress = self._progress(on_line)
+        total = sum(sizes) * 512
+
+        def for_index(index: int) -> Callable[[int, int], None] | None:
+            if progress is None:
+                return None
+            offset = sum(sizes[:index]) * 512
+            return lambda done, _: progress(offset + done, total)
+        return for_index
+
+    @logging.span('批量读取分区')
+    def read_partitions(self, partitions: dict[str, dict[str, int]], output_path: str | None = None, on_line: Callable[[str], Any] | None = None, as_sparse: bool = False) -> str:
+        """
+        在一次Firehose会话中读取多个分区(fh_loader只运行一次), 按起始扇区顺序传输
         {
             'name': {'start': start, 'size': size},
             'name': {'start': start, 'size': size},
         }
+        output_path: 镜像保存的文件夹, 留空则与read_partition一样保存到image_path(name)
+        as_sparse: 保存为Android sparse镜像(重复的块记为FILL, 不占空间); 内置Firehose客户端边读边转换, fh_loader读完后再转换
         """
+        logging.debug('批量读取分区%s', list(partitions))
         if not output_path is None:
             if not os.path.exists(output_path):
                 os.mkdir(output_path)
-        for i in partitions:
-            output = self.read_partition(i)
-            if not output == 'success':
-                raise self.ReadPartitionError(output)
+        names = sorted(partitions, key=lambda i: partitions[i]['start'])
+        destinations = {i: self.image_path(i) if output_path is None else os.path.join(output_path, f'{i}.img') for i in names}
+        for i in names:
+            if os.path.exists(destinations[i]):
+                os.remove(destinations[i])
+
+        if self.native_firehose:
+            progress = self._batch_progress(on_line, [partitions[i]['size'] for i in names])
+
+            def read_all(client: firehose.FirehoseClient) -> None:
+                for index, i in enumerate(names):
+                    if not as_sparse:
+                        client.read_to_file(partitions[i]['start'], partitions[i]['size'], destinations[i], 0, progress(index))
+                        continue
+                    try:
+                        with open(destinations[i], 'wb') as f, sparse.SparseWriter(f, sparse.block_size_for(partitions[i]['size'] * client.sector_size)) as writer:
+                            client.read(partitions[i]['start'], partitions[i]['size'], writer, 0, progress(index))  # type: ignore
+                    except BaseException:
+                        os.remove(destinations[i])
+                        raise
+            try:
+                self._native(read_all)
+            except self.FHLoaderError as e:
+                raise self.ReadPartitionError(e)
+            return 'success'
+
+        xml = self._temp_path('read_partitions.xml')
+        with open(xml, 'w') as f:
+            f.write(partitions_xml(partitions))
+        try:
+            output = self.load_xml(xml, on_line=on_line)
+        except self.FHLoaderError as e:
+            raise self.ReadPartitionError(e)
+        finally:
+            os.remove(xml)
+        for i in names:
+            if as_sparse:
+                sparse.convert(self.image_path(i), f'{destinations[i]}.sparse')
+                os.remove(self.image_path(i))
+                os.replace(f'{destinations[i]}.sparse', destinations[i])
+            elif not output_path is None:
+                shutil.move(self.image_path(i), destinations[i])
+        return output
+
+    @logging.span('备份分区到{filename}')
+    def backup_partitions(self, partitions: dict[str, dict[str, int]], filename: str, on_line: Callable[[str], Any] | None = None) -> str:
+        """
+        把多个分区读取到一个压缩的备份包(modules.backup)
+        内置Firehose客户端边读边压缩(多线程); fh_loader在一次会话中读取全部分区, 每读完一个分区就在另一个线程中压缩并删除它的镜像
+        {
+            'name': {'start': start, 'size': size},
+        }
+        """
+        names = sorted(partitions, key=lambda i: partitions[i]['start'])
+        writer = backup.BackupWriter(filename)
+        try:
+            if self.native_firehose:
+                progress = self._batch_progress(on_line, [partitions[i]['size'] for i in names])
+
+                def read_all(client: firehose.FirehoseClient) -> None:
+                    for index, i in enumerate(names):
+                        with writer.partition(i, partitions[i]['start'], partitions[i]['size']) as stream:
+                            client.read(partitions[i]['start'], partitions[i]['size'], stream, 0, progress(index))  # type: ignore
+                self._native(read_all)
             else:
-                shutil.copy(f'{i}.img', output)
-
-    def write_partition(self, file: str, name: str, start: int | None = None, size: int | None = None) -> str:
-        logging.debug(f'写入分区{name}, 参数列表:{locals()}')
-        xml = \
-            """<?xml version="1.0" ?>
-<data>
-  <program SECTOR_SIZE_IN_BYTES="512" file_sector_offset="0" filename="__name__.img" label="__name__" num_partition_sectors="__size__" physical_partition_number="0" size_in_KB="__size_kb__" sparse="false" start_byte_hex="__start_hex__" start_sector="__start__" />
-</data>
-"""
+                self._backup_with_fh_loader(partitions, names, writer, on_line)
+        except (self.FHLoaderError, backup.BackupError) as e:
+            writer.abort()
+            raise self.ReadPartitionError(e)
+        except BaseException:
+            writer.abort()
+            raise
+        try:
+            writer.close()
+        except backup.BackupError as e:
+            raise self.ReadPartitionError(e)
+        logging.debug('备份包%s: %d个分区, %d字节', filename, len(names), os.path.getsize(filename))
+        return 'success'
+
+    def _backup_with_fh_loader(self, partitions: dict[str, dict[str, int]], names: list[str], writer: backup.BackupWriter, on_line: Callable[[str], Any] | None) -> None:
+        """
+        fh_loader只运行一次, 按names的顺序读取; 下一个分区的镜像出现(或fh_loader结束)时上一个分区已经读完,
+        由压缩线程加入备份包并删除, 压缩与读取同时进行
+        """
+        images = {i: self._temp_path(f'{i}.backup.img') for i in names}
+        xml = self._temp_path('backup_partitions.xml')
+        with open(xml, 'w') as f:
+            f.write(partitions_xml({i: partitions[i] for i in names}, {i: f'{i}.backup.img' for i in names}))
+        loaded = threading.Event()
+        finished = threading.Event()
+        errors: list[BaseException] = []
+
+        def compress() -> None:
+            try:
+                for index, i in enumerate(names):
+                    following = images[names[index + 1]] if index + 1 < len(names) else None
+                    while not finished.is_set() and (following is None or not os.path.exists(following)):
+                        finished.wait(0.2)
+                    if finished.is_set() and not loaded.is_set():
+                        return
+                    writer.add_file(i, partitions[i]['start'], partitions[i]['size'], images[i])
+                    os.remove(images[i])
+            except BaseException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=compress, name='backup-compress-images', daemon=True)
+        thread.start()
+        try:
+            self.load_xml(xml, on_line=on_line)
+            loaded.set()
+        finally:
+            finished.set()
+            thread.join()
+            os.remove(xml)
+            for i in images.values():
+                if os.path.exists(i):
+                    os.remove(i)
+        if errors:
+            raise errors[0]
+
+    @logging.span('从{filename}还原分区')
+    def restore_partitions(self, filename: str, names: list[str] | None = None, on_line: Callable[[str], Any] | None = None) -> str:
+        """
+        把备份包中的分区写回设备, 分区的位置和大小必须与当前分区表一致
+        names: 要还原的分区, 留空则还原全部
+        """
+        try:
+            reader = backup.BackupReader(filename)
+        except backup.BackupError as e:
+            raise self.WritePartitionError(e)
+        with reader:
+            selected = [reader.partitions[i] for i in (reader.partitions if names is None else names) if i in reader.partitions]
+            if self.partition_list is None:
+                self.get_partition_list()
+            for i in selected:
+                if self.partition_list.get(i.name) != {'start': i.start, 'size': i.sectors}:  # type: ignore
+                    raise self.WritePartitionError(f'备份中的分区{i.name}与设备的分区表不一致')
+            selected.sort(key=lambda i: i.start)
+
+            if self.native_firehose:
+                progress = self._batch_progress(on_line, [i.sectors for i in selected])
+
+                def write_all(client: firehose.FirehoseClient) -> None:
+                    for index, i in enumerate(selected):
+                        on_progress = progress(index)
+                        written = 0
+                        for data in reader.iter_range(i.name):
+                            written += client.program_data(i.start + written // client.sector_size, data, 0, i.name)
+                            if not on_progress is None:
+                                on_progress(written, i.size)
+                try:
+                    self._native(write_all)
+                except (self.FHLoaderError, backup.BackupError) as e:
+                    raise self.WritePartitionError(e)
+                return 'success'
+
+            files: dict[str, dict[str, str | int]] = {}
+            try:
+                for i in selected:
+                    files[i.name] = {'file': self._temp_path(f'{i.name}.restore.img'), 'start': i.start, 'size': i.sectors}
+                    reader.extract(i.name, str(files[i.name]['file']))
+                return self.write_partitions(files, on_line)
+            except backup.BackupError as e:
+                raise self.WritePartitionError(e)
+            finally:
+                for i in files.values():
+                    if os.path.exists(str(i['file'])):
+                        os.remove(str(i['file']))
+
+    @staticmethod
+    def _program_file(client: firehose.FirehoseClient, start: int, file: str, size: int, on_progress: Callable[[int, int], None] | None) -> int:
+        """
+        写入一个镜像, Android sparse镜像跳过DONT_CARE, 较大的全0 FILL用erase代替(见FirehoseClient.program_sparse); 进度按分区大小换算
+        """
+        if not sparse.is_sparse(file):
+            return client.program(start, file, size, 0, 0, on_progress)
+        total = size * client.sector_size
+        return client.program_sparse(start, file, size, 0, None if on_progress is None else lambda done, expanded: on_progress(done * total // max(expanded, 1), total), erase_zeros=True)
+
+    def _stage_images(self, files: dict[str, str]) -> tuple[str, dict[str, str], list[str]]:
+        """
+        让fh_loader直接使用原文件: 所有文件在同一个文件夹时把它作为search_path, 否则硬链接到tmp/(或workspace)
+        files: {分区名: 镜像文件}
+        return: search_path, XML中各分区的filename, 需要在写入后删除的链接
+        """
+        directories = {os.path.dirname(os.path.abspath(i)) for i in files.values()}
+        if len(directories) == 1:
+            return directories.pop(), {i: os.path.basename(files[i]) for i in files}, []
+        search_path = 'tmp/' if self.workspace is None else self.workspace
+        staged: list[str] = []
+        for i in files:
+            target = os.path.join(search_path, f'{i}.img')
+            if not os.path.abspath(files[i]) == os.path.abspath(target):
+                if os.path.exists(target):
+                    os.remove(target)
+                link_or_copy(files[i], target)
+                staged.append(target)
+        return search_path, {i: f'{i}.img' for i in files}, staged
+
+    @logging.span('写入分区{name}')
+    def write_partition(self, file: str, name: str, start: int | None = None, size: int | None = None, on_line: Callable[[str], Any] | None = None) -> str:
+        logging.debug('写入分区%s, 参数列表:%s', name, locals())
         if start is None or size is None:
             if self.partition_list is None:
                 self.get_partition_list()
             start = self.partition_list[name]['start']  # type: ignore
             size = self.partition_list[name]['size']  # type: ignore
 
-        if not os.path.abspath(file) == os.path.abspath(f'tmp/{name}.img'):
-            if os.path.exists(f'tmp/{name}.img'):
-                os.remove(f'tmp/{name}.img')
-            shutil.copy(file, f'tmp/{name}.img')
-
-        xml = xml.replace('__name__', name)
-        xml = xml.replace('__size__', str(size),)  # type: ignore
-        xml = xml.replace('__size_kb__', str(size/2)+'.0')  # type: ignore
-        xml = xml.replace('__start_hex__', '0x{:02X}'.format(
-            int(start/8)).ljust(10, '0'))  # type: ignore
-        xml = xml.replace('__start__', str(start))  # type: ignore
-
-        with open(f'{name}.xml', 'w') as f:
-            f.write(xml)
-
-        output = self.fh_loader(
-            rf'--port=\\.\COM{self.port} --memoryname=emmc --search_path=tmp/ --sendxml={name}.xml --noprompt')
+        if self.native_firehose:
+            self._native(lambda client: self._program_file(client, start, file, size, self._progress(on_line)))  # type: ignore
+            return 'success'
 
-        os.remove(f'{name}.xml')
-        os.remove(f'tmp/{name}.img')
+        search_path, filenames, staged = self._stage_images({name: file})
 
-        return output
+        xml = self._temp_path(f'{name}.xml')
+        with open(xml, 'w') as f:
+            f.write(partition_xml(name, start, size, filenames[name], sparse.is_sparse(file)))  # type: ignore
 
-    def write_partitions(self, partitions: dict[str, dict[str, str | int]]) -> None:
+        try:
+            return self.fh_loader(
+                rf'--port=\\.\COM{self.port} --memoryname=emmc --search_path="{search_path}" --sendxml={xml} --noprompt', on_line)
+        finally:
+            os.remove(xml)
+            for i in staged:
+                os.remove(i)
+
+    @logging.span('批量写入分区')
+    def write_partitions(self, partitions: dict[str, dict[str, str | int]], on_line: Callable[[str], Any] | None = None) -> str:
         """
+        在一次Firehose会话中写入多个分区(fh_loader只运行一次), 按起始扇区顺序传输
         {
             'name': {'file': filepath, 'start': start, 'size': size},
-            'name': {'file': filepath, 'start': start, 'size': size},
+            'name': {'file': filepath},
         }
+        start和size留空则从分区表中获取
         """
+        logging.debug('批量写入分区%s', {i: partitions[i]['file'] for i in partitions})
+        ranges: dict[str, dict[str, int]] = {}
         for i in partitions:
-            output = self.write_partition(
-                partitions[i]['file'], i)  # type: ignore
-            if not output == 'success':
-                raise self.WritePartitionError(output)
+            if 'start' in partitions[i] and 'size' in partitions[i]:
+                ranges[i] = {'start': int(partitions[i]['start']), 'size': int(partitions[i]['size'])}
+            else:
+                if self.partition_list is None:
+                    self.get_partition_list()
+                ranges[i] = self.partition_list[i]  # type: ignore
+        names = sorted(ranges, key=lambda i: ranges[i]['start'])
+
+        if self.native_firehose:
+            progress = self._batch_progress(on_line, [ranges[i]['size'] for i in names])
+
+            def write_all(client: firehose.FirehoseClient) -> None:
+                for index, i in enumerate(names):
+                    self._program_file(client, ranges[i]['start'], str(partitions[i]['file']), ranges[i]['size'], progress(index))
+            try:
+                self._native(write_all)
+            except self.FHLoaderError as e:
+                raise self.WritePartitionError(e)
+            return 'success'
+
+        search_path, filenames, staged = self._stage_images({i: str(partitions[i]['file']) for i in names})
+
+        xml = self._temp_path('write_partitions.xml')
+        with open(xml, 'w') as f:
+            f.write(partitions_xml(ranges, filenames, [i for i in names if sparse.is_sparse(str(partitions[i]['file']))]))
+        try:
+            return self.fh_loader(
+                rf'--port=\\.\COM{self.port} --memoryname=emmc --search_path="{search_path}" --sendxml={xml} --noprompt --showpercentagecomplete', on_line)
+        except self.FHLoaderError as e:
+            raise self.WritePartitionError(e)
+        finally:
+            os.remove(xml)
+            for i in staged:
+                os.remove(i)
+
+
+class EDLScheduler:
+    """
+    同时对多台9008模式的设备执行同一个流程, 每个端口一个工作线程和一个独立工作目录的QT
+    """
+    def __init__(self, make_qt: Callable[[int, str], QT], flow: Callable[[QT], Any], workspace_root: str = 'tmp/', max_workers: int | None = None) -> None:
+        """
+        make_qt: 根据(端口号, 工作目录)创建QT
+        flow: 对一台设备执行的流程
+        workspace_root: 每个端口的工作目录为{workspace_root}COM{端口号}/
+        max_workers: 最多同时操作几台设备, 留空则不限制
+        """
+        self.make_qt = make_qt
+        self.flow = flow
+        self.workspace_root = workspace_root
+        self.max_workers = max_workers
+        self.results: dict[int, Any] = {}
+
+    def _worker(self, port: int) -> Any:
+        with logging.device(f'COM{port}'):
+            try:
+                output = self.flow(self.make_qt(port, os.path.join(self.workspace_root, f'COM{port}')))
+            except Exception as e:
+                logging_traceback(f'COM{port}操作失败')
+                output = e
+        self.results[port] = output
+        return output
+
+    def run(self, ports: list[int]) -> dict[int, Any]:
+        """
+        对已知的端口执行流程并等待全部完成
+        return: {端口号: flow的返回值或抛出的异常}
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers or max(len(ports), 1), thread_name_prefix='edl') as pool:
+            for i in ports:
+                pool.submit(self._worker, i)
+        return {i: self.results[i] for i in ports}
 
 
 def get_partition_list(entries: bytes, header: bytes) -> tuple[int, dict[str, dict[str, int]]]:
     """
     :param entries: fh_gpt_entries_0 的文件内容
     :param header: fh_gpt_header_0 的文件内容
-    :return: total, partitions
+    :return: total(存储的总扇区数), partitions
     """
-
-    # 读取总大小
-    total = int.from_bytes(header[32:36][::-1])
-
-    # 分块
-    parts_byte: list[bytes] = []
-    while True:
-        if len(entries) >= 128:
-            parts_byte.append(entries[0:127])
-            entries = entries[128:]
-        else:
-            parts_byte.append(entries[0:])
-            break
-
-    # 读取分区表
-    partitions: dict[str, dict[str, int]] = {}
-    for i, x in enumerate(parts_byte):
-        name = x[56:].replace(b'\x00', b'').decode()
-        start = int.from_bytes(x[32:36][::-1])
-        if not name == '':
-            partitions[name] = {'start': start}
-
-    # 计算大小
-    for i, x in enumerate(partitions):
-        if not i == len(partitions)-1:  # 如果不是第一项且不是最后一项
-            partitions[x]['size'] = partitions[list(partitions.keys())[
-                # 将上一项的size设置为当前项的start-上一项的start
-                i+1]]['start']-partitions[x]['start']
-        elif i == len(partitions)-1:  # 如果是最后一项
-            partitions[x]['size'] = total-32 - \
-                partitions[x]['start']  # 将当前项的size设置为总大小-32-当前项的start
-
-    return total, partitions
+    table = gpt.parse(entries, header)
+    return table.disk_sectors, table.to_dict()
 
 
 def get_partition_list_from_files(entries: str, header: str) -> tuple[int, dict[str, dict[str, int]]]:
@@ -653,6 +1767,11 @@ def easy_patch_boot() -> None:
 
 
 class MAGISKBOOT:
+    timeout: int | float | None = None
+    """
+    magiskboot命令的超时时间(秒), 为None则不限时
+    """
+
     def __init__(self, path: str) -> None:
         self.path = path
 
@@ -660,8 +1779,11 @@ class MAGISKBOOT:
         def __init__(self, *args: object) -> None:
             super().__init__(*args)
 
-    def magiskboot(self, args: str) -> str:
-        output = run_wait(f'{self.path} {args}')
+    def magiskboot(self, args: str, on_line: Callable[[str], Any] | None = None) -> str:
+        try:
+            output = run_wait(f'{self.path} {args}', on_line, self.timeout, True)
+        except ProgramTimeoutError as e:
+            raise self.MagiskBootError(*e.args)
         stdout = output[1]
         if output[0]:
             if type(stdout) == str:
@@ -700,6 +1822,7 @@ class PatchBootOptions(TypedDict):
 #     ) -> None:
 
 
+@logging.span('修补boot')
 def patch_boot(
     magiskboot_path: str,
     input_path: str,
@@ -939,6 +2062,15 @@ def is_v3(model: str, version: str) -> bool:
 
 
 class FASTBOOT:
+    timeout: int | float | None = None
+    """
+    fastboot命令的默认超时时间(秒), 为None则不限时(擦除、刷入等耗时难以预估)
+    """
+    short_timeout: int | float | None = 30
+    """
+    fastboot devices等必定很快返回的命令的超时时间(秒)
+    """
+
     def __init__(self, path: str) -> None:
         self.path = path
 
@@ -946,8 +2078,14 @@ class FASTBOOT:
         def __init__(self, *args: object) -> None:
             super().__init__(*args)
 
-    def fastboot(self, args: str) -> str:
-        output = run_wait(f'{self.path} {args}')
+    def fastboot(self, args: str, on_line: Callable[[str], Any] | None = None, timeout: int | float | None = -1) -> str:
+        """
+        timeout: 超时时间(秒), -1为使用FASTBOOT.timeout, None为不限时
+        """
+        try:
+            output = run_wait(f'{self.path} {args}', on_line, self.timeout if timeout == -1 else timeout, True)
+        except ProgramTimeoutError as e:
+            raise self.FastbootError(*e.args)
         stdout = output[1]
         if output[0]:
             if type(stdout) == str:
@@ -960,12 +2098,14 @@ class FASTBOOT:
     def reboot(self) -> None:
         self.fastboot('reboot')
 
+    @logging.span('等待Fastboot连接')
     def wait_for_fastboot(self) -> None:
         while True:
-            if 'fastboot' in self.fastboot('devices'):
+            if 'fastboot' in self.fastboot('devices', timeout=self.short_timeout):
                 break
             sleep(0.5)
 
+    @logging.span('刷入{part}')
     def flash(self, part: str, img: str) -> str:
         output = self.fastboot(f'flash {part} {img}')
         if not 'Finished' in output:
@@ -973,6 +2113,7 @@ class FASTBOOT:
         else:
             return 'success'
 
+    @logging.span('擦除{part}')
     def erase(self, part: str) -> str:
         output = self.fastboot(f'erase {part}')
         if not 'Finished' in output: